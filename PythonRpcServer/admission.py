@@ -0,0 +1,219 @@
+import math
+import os
+import threading
+import weakref
+from time import perf_counter
+
+import grpc
+
+import lanes
+import metrics
+import log
+
+logger = log.getLogger(__name__)
+
+# Admission control for both server modes (see lanes.LaneServicer for grpc.aio, AdmissionInterceptor for threads)
+# Each RPC type has a cap on the number of calls that are queued or running, and on the estimated work
+# (in seconds) that they represent. A call that would exceed either cap is rejected immediately with
+# RESOURCE_EXHAUSTED and a 'retry-after-seconds' trailing metadata hint, rather than waiting in a queue
+# until the TaskEngine times out.
+#
+# Limits are configured per lane, and apply to each RPC type in the lane:
+#   ADMISSION_MAX_PENDING_<LANE>       e.g. ADMISSION_MAX_PENDING_CPU=12
+#   ADMISSION_MAX_WORK_SECONDS_<LANE>  e.g. ADMISSION_MAX_WORK_SECONDS_CPU=21600
+# In the threads mode every RPC shares one thread pool, but the limits are still those of the RPC's lane
+
+# Initial estimate of one call's execution time, until the RPC type has completed a call
+DEFAULT_ESTIMATE_SECONDS = {lanes.CPU: 600.0, lanes.DOWNLOAD: 120.0, lanes.FAST: 1.0}
+DEFAULT_MAX_PENDING_PER_WORKER = {lanes.CPU: 4, lanes.DOWNLOAD: 4, lanes.FAST: 16}
+# Queued work (divided over the lane's workers) above which new calls are turned away
+DEFAULT_MAX_WORK_SECONDS_PER_WORKER = {lanes.CPU: 2 * 3600.0, lanes.DOWNLOAD: 1800.0, lanes.FAST: 60.0}
+
+# Weight of the most recent call in the moving average of execution times
+ESTIMATE_SMOOTHING = 0.2
+
+MAX_RETRY_AFTER_SECONDS = 600
+
+RETRY_AFTER_METADATA_KEY = 'retry-after-seconds'
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, rpc, reason, retry_after):
+        self.rpc = rpc
+        self.retry_after = retry_after
+        super().__init__(f"{rpc} rejected: {reason}. Retry after {retry_after} seconds")
+
+
+class _RpcState:
+    def __init__(self, rpc):
+        lane = lanes.laneFor(rpc)
+        name = lanes.RPC_LANES.get(rpc, lanes.DEFAULT_LANE)
+        self.lane = lane
+        self.max_pending = int(os.getenv(f'ADMISSION_MAX_PENDING_{name.upper()}',
+                                         DEFAULT_MAX_PENDING_PER_WORKER[name] * lane.max_workers))
+        self.max_work_seconds = float(os.getenv(f'ADMISSION_MAX_WORK_SECONDS_{name.upper()}',
+                                                DEFAULT_MAX_WORK_SECONDS_PER_WORKER[name] * lane.max_workers))
+        self.estimate = DEFAULT_ESTIMATE_SECONDS[name]
+        self.pending = 0
+        self.pending_work = 0.0
+        self.rejected = 0
+
+
+# Returned by admit(); call done() exactly once when the call has finished (successfully or not)
+class Ticket:
+    def __init__(self, controller, rpc, estimate):
+        self.controller = controller
+        self.rpc = rpc
+        self.estimate = estimate
+        self.elapsed = None
+
+    # Runs fn(*args), timing only the execution (not the wait for a worker)
+    def execute(self, fn, *args):
+        start = perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.elapsed = perf_counter() - start
+
+    def done(self):
+        self.controller._release(self)
+
+
+class AdmissionController:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rpcs = {}
+
+    def _state(self, rpc):
+        state = self.rpcs.get(rpc)
+        if state is None:
+            state = self.rpcs[rpc] = _RpcState(rpc)
+        return state
+
+    # Returns a Ticket, or raises AdmissionRejected
+    def admit(self, rpc):
+        with self.lock:
+            state = self._state(rpc)
+            reason = None
+            if state.pending >= state.max_pending:
+                reason = f"{state.pending} calls already queued or running (limit {state.max_pending})"
+            elif state.pending and state.pending_work + state.estimate > state.max_work_seconds:
+                reason = f"{state.pending_work:.0f}s of work already pending (limit {state.max_work_seconds:.0f}s)"
+            if reason:
+                state.rejected += 1
+                # Roughly when the first queued call on each worker should have completed
+                excess = max(1, state.pending - state.max_pending + 1)
+                retry_after = math.ceil(state.estimate * excess / state.lane.max_workers)
+                retry_after = min(MAX_RETRY_AFTER_SECONDS, max(1, retry_after))
+                metrics.ADMISSION_REJECTED.inc(rpc = rpc)
+                raise AdmissionRejected(rpc, reason, retry_after)
+            state.pending += 1
+            state.pending_work += state.estimate
+            self._updateMetrics(rpc, state)
+            return Ticket(self, rpc, state.estimate)
+
+    # For grpc.aio handlers: returns a Ticket, or ends the call with RESOURCE_EXHAUSTED
+    async def admitOrAbort(self, rpc, context):
+        try:
+            return self.admit(rpc)
+        except AdmissionRejected as e:
+            logger.warning(str(e))
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, str(e),
+                                trailing_metadata=((RETRY_AFTER_METADATA_KEY, str(e.retry_after)),))
+
+    def _release(self, ticket):
+        with self.lock:
+            state = self._state(ticket.rpc)
+            state.pending -= 1
+            state.pending_work = max(0.0, state.pending_work - ticket.estimate)
+            if ticket.elapsed is not None:
+                state.estimate += ESTIMATE_SMOOTHING * (ticket.elapsed - state.estimate)
+            self._updateMetrics(ticket.rpc, state)
+
+    def _updateMetrics(self, rpc, state):
+        metrics.ADMISSION_PENDING.set(state.pending, rpc = rpc)
+        metrics.ADMISSION_FREE.set(max(0, state.max_pending - state.pending), rpc = rpc)
+        metrics.ADMISSION_PENDING_WORK_SECONDS.set(state.pending_work, rpc = rpc)
+
+    # Current state of every RPC type that has been called, e.g. for health checks and schedulers
+    def capacity(self):
+        with self.lock:
+            return {rpc: {
+                'lane': state.lane.name,
+                'pending': state.pending,
+                'maxPending': state.max_pending,
+                'free': max(0, state.max_pending - state.pending),
+                'pendingWorkSeconds': round(state.pending_work, 1),
+                'maxWorkSeconds': state.max_work_seconds,
+                'estimateSeconds': round(state.estimate, 2),
+                'rejected': state.rejected,
+            } for rpc, state in self.rpcs.items()}
+
+
+CONTROLLER = AdmissionController()
+
+
+# For the threads server mode (grpc.server(..., interceptors=[AdmissionInterceptor(CONTROLLER)]))
+# Interceptors run as a call arrives, before it is queued on the server's thread pool, so queued calls are counted
+class AdmissionInterceptor(grpc.ServerInterceptor):
+    def __init__(self, controller):
+        self._controller = controller
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None:
+            return None
+        rpc = handler_call_details.method.rsplit('/', 1)[-1]
+        try:
+            ticket = self._controller.admit(rpc)
+        except AdmissionRejected as e:
+            logger.warning(str(e))
+            return _handler(handler, _rejected(e, handler.response_streaming))
+        return _handler(handler, _admitted(ticket, handler.unary_unary or handler.unary_stream
+                                           or handler.stream_unary or handler.stream_stream, handler.response_streaming))
+
+
+def _handler(handler, behavior):
+    if handler.request_streaming and handler.response_streaming:
+        make = grpc.stream_stream_rpc_method_handler
+    elif handler.request_streaming:
+        make = grpc.stream_unary_rpc_method_handler
+    elif handler.response_streaming:
+        make = grpc.unary_stream_rpc_method_handler
+    else:
+        make = grpc.unary_unary_rpc_method_handler
+    return make(behavior, handler.request_deserializer, handler.response_serializer)
+
+
+def _rejected(e, streaming):
+    def reject(request, context):
+        context.set_trailing_metadata(((RETRY_AFTER_METADATA_KEY, str(e.retry_after)),))
+        context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, str(e))
+
+    def rejectStream(request, context):
+        reject(request, context)
+        yield  # Never reached; makes this a generator like the handler it replaces
+
+    return rejectStream if streaming else reject
+
+
+def _admitted(ticket, behavior, streaming):
+    def run(request, context):
+        try:
+            return ticket.execute(behavior, request, context)
+        finally:
+            done()
+
+    def runStream(request, context):
+        start = perf_counter()
+        try:
+            yield from behavior(request, context)
+        finally:
+            ticket.elapsed = perf_counter() - start
+            done()
+
+    wrapper = runStream if streaming else run
+    # grpc does not call the handler of a call that was cancelled while it was queued; the ticket is then
+    # released when the call (and so the handler) is discarded. Calling done() detaches it, so it runs once.
+    done = weakref.finalize(wrapper, ticket.done)
+    return wrapper
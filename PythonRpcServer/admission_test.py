@@ -0,0 +1,42 @@
+import threading
+from concurrent import futures
+
+import grpc
+
+import admission
+
+
+def test_threads_server_rejects_calls_beyond_the_limit():
+    controller = admission.AdmissionController()
+    controller._state('GetMetricsRPC').max_pending = 1
+    release = threading.Event()
+
+    def slow(request, context):
+        release.wait(5)
+        return request
+
+    handlers = {'GetMetricsRPC': grpc.unary_unary_rpc_method_handler(slow)}
+    server = grpc.server(futures.ThreadPoolExecutor(4), interceptors=[admission.AdmissionInterceptor(controller)])
+    server.add_generic_rpc_handlers((grpc.method_handlers_generic_handler('test.Service', handlers),))
+    port = server.add_insecure_port('127.0.0.1:0')
+    server.start()
+    try:
+        with grpc.insecure_channel(f'127.0.0.1:{port}') as channel:
+            call = channel.unary_unary('/test.Service/GetMetricsRPC')
+            first = call.future(b'first')
+            while controller.capacity()['GetMetricsRPC']['pending'] == 0:
+                release.wait(0.01)
+
+            try:
+                call(b'second')
+                assert False, 'expected RESOURCE_EXHAUSTED'
+            except grpc.RpcError as e:
+                assert e.code() == grpc.StatusCode.RESOURCE_EXHAUSTED
+                assert dict(e.trailing_metadata())[admission.RETRY_AFTER_METADATA_KEY].isdigit()
+
+            release.set()
+            assert first.result() == b'first'
+    finally:
+        server.stop(None)
+    assert controller.capacity()['GetMetricsRPC']['pending'] == 0
+    assert controller.capacity()['GetMetricsRPC']['rejected'] == 1
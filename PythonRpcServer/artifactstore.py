@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+import hasher
+import log
+import metrics
+import utils
+
+logger = log.getLogger(__name__)
+
+# Content addressed store of derived artifacts (wav, mp4, probe and whisper results), so that the same source is
+# processed once, even when it arrives again under another path (e.g. a lecture in two courses or playlists)
+# An artifact's key is the sha256 of the source's contents plus the operation and its parameters:
+#   key = artifactstore.key(input_filepath, 'wav', {'offset': 0.0})
+#   output = artifactstore.getFile(key, '.wav')          # A new temporary file, or None
+#   ...
+#   artifactstore.putFile(key, '.wav', output)
+# Artifacts are hard linked into and out of the store (copied only across file systems), and published with an
+# atomic rename, so a reader never sees a partial file. The least recently used artifacts are removed when the
+# store grows beyond ARTIFACT_STORE_MAX_BYTES (recency is the access time, which getFile sets).
+
+ARTIFACT_STORE = os.getenv('ARTIFACT_STORE', '1') == '1'
+# '' = DATA_DIRECTORY/pythonrpc_artifacts
+ARTIFACT_STORE_PATH = os.getenv('ARTIFACT_STORE_PATH', '')
+ARTIFACT_STORE_MAX_BYTES = int(os.getenv('ARTIFACT_STORE_MAX_BYTES', 20 * 1024 ** 3))
+# Eviction removes artifacts until the store is this fraction of its maximum size
+ARTIFACT_STORE_LOW_WATER = 0.9
+
+_lock = threading.Lock()
+_totalBytes = None  # Unknown until the first put
+
+
+def storePath():
+    if ARTIFACT_STORE_PATH:
+        return ARTIFACT_STORE_PATH
+    data = os.getenv('DATA_DIRECTORY')
+    return os.path.join(data, 'pythonrpc_artifacts') if data else None
+
+
+# Returns the sha256 of filepath's contents (hashed once, see hasher.DIGESTS); if compute is False, only a digest
+# that is already known (or None)
+def sourceDigest(filepath, compute=True):
+    if not compute:
+        return hasher.cachedDigests(filepath, ['sha256']).get('sha256')
+    return hasher.hashFile(filepath, 'sha256')['sha256']
+
+
+# Returns the key of the artifact that operation (with params, a json serializable dict) makes from filepath,
+# or None if the store is disabled or, with compute=False, the source has not been hashed yet
+# (e.g. a probe is cheaper than reading the whole file)
+def key(filepath, operation, params=None, compute=True):
+    if not ARTIFACT_STORE or storePath() is None:
+        return None
+    try:
+        digest = sourceDigest(filepath, compute)
+    except OSError as e:
+        logger.warning(f"artifactstore: cannot hash {filepath}: {e}")
+        return None
+    if digest is None:
+        return None
+    description = json.dumps([digest, operation, params or {}], sort_keys=True)
+    return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+
+def _artifactPath(key, ext):
+    return os.path.join(storePath(), key[:2], key + ext)
+
+
+# Returns a new temporary file (see utils.getTmpFile) with the artifact's contents, or None if it is not stored
+def getFile(key, ext):
+    if key is None:
+        return None
+    path = _artifactPath(key, ext)
+    try:
+        output_filepath = utils.linkToTmpFile(path)
+    except FileNotFoundError:
+        metrics.ARTIFACT_STORE_LOOKUPS.inc(result = 'miss')
+        return None
+    try:
+        # Only the access time, so that the contents still look unchanged (see filecache.signature)
+        os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+    except OSError:
+        pass  # Evicted meanwhile
+    metrics.ARTIFACT_STORE_LOOKUPS.inc(result = 'hit')
+    logger.info(f"artifactstore: {key}{ext} reused as {output_filepath}")
+    return output_filepath
+
+
+# Returns the stored text artifact (e.g. json), or None
+def getText(key, ext='.json'):
+    path = getFile(key, ext)
+    if path is None:
+        return None
+    try:
+        with open(path, 'r') as f:
+            return f.read()
+    finally:
+        utils.removeFile(path)
+
+
+# Publishes filepath (a finished output; it is not modified) as the artifact
+def putFile(key, ext, filepath):
+    if key is None:
+        return
+    path = _artifactPath(key, ext)
+    staging = os.path.join(storePath(), 'tmp_' + utils.getRandomString(12))
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.link(filepath, staging)
+        except OSError:
+            shutil.copyfile(filepath, staging)
+        os.replace(staging, path)
+        size = os.path.getsize(path)
+    except OSError as e:
+        logger.warning(f"artifactstore: cannot store {filepath}: {e}")
+        utils.removeFile(staging)
+        return
+    _added(size)
+
+
+def putText(key, text, ext='.json'):
+    if key is None:
+        return
+    staging = utils.getTmpFile()
+    try:
+        with open(staging, 'w') as f:
+            f.write(text)
+        putFile(key, ext, staging)
+    finally:
+        utils.removeFile(staging)
+
+
+def _added(size):
+    global _totalBytes
+    with _lock:
+        if _totalBytes is not None:
+            _totalBytes += size
+        if _totalBytes is None or _totalBytes > ARTIFACT_STORE_MAX_BYTES:
+            _totalBytes = _evict()
+
+
+# Removes the least recently used artifacts until the store is below its low water mark; returns its size
+def _evict():
+    root = storePath()
+    artifacts = []
+    for directory in os.listdir(root):
+        if directory.startswith('tmp_'):
+            continue
+        try:
+            with os.scandir(os.path.join(root, directory)) as entries:
+                for entry in entries:
+                    st = entry.stat()
+                    artifacts.append((st.st_atime_ns, st.st_size, entry.path))
+        except OSError:
+            pass  # Not a directory, or removed meanwhile
+    total = sum(size for _, size, _ in artifacts)
+    if total <= ARTIFACT_STORE_MAX_BYTES:
+        return total
+    removed = 0
+    for _, size, path in sorted(artifacts):
+        if total <= ARTIFACT_STORE_MAX_BYTES * ARTIFACT_STORE_LOW_WATER:
+            break
+        utils.removeFile(path)
+        total -= size
+        removed += 1
+    logger.info(f"artifactstore: removed {removed} least recently used artifacts; {total} bytes remain")
+    return total
@@ -0,0 +1,51 @@
+import os
+
+import artifactstore
+import filecache
+import utils
+
+
+def store(tmp_path, monkeypatch, max_bytes=1000):
+    monkeypatch.setattr(utils, 'DATA_DIRECTORY', str(tmp_path))
+    monkeypatch.setattr(filecache, 'FILECACHE_PATH', 'none')
+    monkeypatch.setattr(artifactstore, 'ARTIFACT_STORE_PATH', str(tmp_path / 'artifacts'))
+    monkeypatch.setattr(artifactstore, 'ARTIFACT_STORE_MAX_BYTES', max_bytes)
+    monkeypatch.setattr(artifactstore, '_totalBytes', None)
+
+
+def test_artifacts_are_shared_by_identical_sources(tmp_path, monkeypatch):
+    store(tmp_path, monkeypatch)
+    first, second = tmp_path / 'a.mp4', tmp_path / 'b.mp4'
+    first.write_bytes(b'lecture')
+    second.write_bytes(b'lecture')
+    output = tmp_path / 'out.wav'
+    output.write_bytes(b'wav')
+
+    key = artifactstore.key(str(first), 'wav', {'offset': 0.0})
+    assert artifactstore.getFile(key, '.wav') is None
+    artifactstore.putFile(key, '.wav', str(output))
+    os.remove(output)  # The caller owns its output
+
+    assert artifactstore.key(str(second), 'wav', {'offset': 0.0}) == key
+    assert artifactstore.key(str(second), 'wav', {'offset': 1.0}) != key
+    stored = artifactstore.getFile(key, '.wav')
+    with open(stored, 'rb') as f:
+        assert f.read() == b'wav'
+
+    artifactstore.putText(key, '{"a": 1}')
+    assert artifactstore.getText(key) == '{"a": 1}'
+
+
+def test_least_recently_used_artifacts_are_evicted(tmp_path, monkeypatch):
+    store(tmp_path, monkeypatch, max_bytes=250)
+    keys = []
+    for i in range(3):
+        source = tmp_path / f'{i}.mp4'
+        source.write_bytes(bytes([i]))
+        keys.append(artifactstore.key(str(source), 'probe'))
+        artifactstore.putText(keys[-1], 'x' * 100)
+        if i == 1:
+            assert artifactstore.getText(keys[0]) is not None  # 0 is now more recent than 1
+    assert artifactstore.getText(keys[1]) is None
+    assert artifactstore.getText(keys[0]) is not None
+    assert artifactstore.getText(keys[2]) is not None
@@ -0,0 +1,161 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import log
+import metrics
+
+logger = log.getLogger(__name__)
+
+# Low priority background jobs (e.g. the quality encode that follows the preview of ProcessVideoPreviewRPC)
+# The jobs run on their own thread pool, whose threads lower their CPU priority (nice) when they start; the ffmpeg
+# processes they run inherit it, so a background job mostly uses the CPU time that the RPCs leave idle
+# Each job has an id, and its state is kept for a while after it finishes so that clients can query it (GetVideoJobRPC)
+# A job's result can be handed over once (collect); a job created with discard (e.g. utils.removeFile for a result
+# that is a file) has it called on a result that was never collected when the job is forgotten
+
+NUM_BACKGROUND_WORKERS = int(os.getenv('NUM_BACKGROUND_WORKERS', 1))
+# Niceness of the background threads (and their child processes); 0 = normal priority
+BACKGROUND_NICENESS = int(os.getenv('BACKGROUND_NICENESS', 10))
+# Number of finished jobs whose state is kept
+BACKGROUND_JOB_HISTORY = int(os.getenv('BACKGROUND_JOB_HISTORY', 1000))
+# Seconds after which a finished job is forgotten (and a result that was not collected discarded)
+BACKGROUND_JOB_MAX_AGE_SECONDS = float(os.getenv('BACKGROUND_JOB_MAX_AGE_SECONDS', 24 * 3600))
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Job:
+    def __init__(self, name, discard=None):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.state = PENDING
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.finished = None
+        self.event = threading.Event()
+        self.discard = discard
+        self.collected = False
+
+    def isFinished(self):
+        return self.event.is_set()
+
+    # Returns the result of a job that is done, to the first caller only (None after that, or if it is not done)
+    def collect(self):
+        with _lock:
+            return self._take()
+
+    # Callers hold _lock
+    def _take(self):
+        if self.state != DONE or self.collected:
+            return None
+        self.collected = True
+        result, self.result = self.result, None
+        return result
+
+    # Returns True if the job has finished, False after timeout seconds
+    def wait(self, timeout=None):
+        return self.event.wait(timeout)
+
+
+def _lowerPriority():
+    if not BACKGROUND_NICENESS:
+        return
+    try:
+        # On Linux this sets the priority of the calling thread only
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), BACKGROUND_NICENESS)
+    except (AttributeError, OSError) as e:
+        logger.warning(f"Background jobs run at normal priority: {e}")
+
+
+_local = threading.local()
+
+
+# True in the threads that run background jobs (e.g. cpubudget only gives their processes the free cores)
+def isBackgroundThread():
+    return getattr(_local, 'background', False)
+
+
+def _initThread():
+    _local.background = True
+    _lowerPriority()
+
+
+EXECUTOR = metrics.TimedThreadPoolExecutor('background', NUM_BACKGROUND_WORKERS, thread_name_prefix='background',
+                                           initializer=_initThread)
+
+_lock = threading.Lock()
+_jobs = OrderedDict()
+
+
+# Runs fn() in the background; returns its Job, whose result is the value returned by fn
+# on_done (optional) is called with the Job when it has finished (or failed)
+# discard (optional) is called with the result if the job is forgotten before the result was collected
+def submit(name, fn, on_done=None, discard=None):
+    job = Job(name, discard)
+    with _lock:
+        _jobs[job.id] = job
+        forgotten = _trim()
+    _discard(forgotten)
+
+    def run():
+        job.state = RUNNING
+        start = time.time()
+        try:
+            job.result = fn()
+            job.state = DONE
+            logger.info(f"{name}: background job {job.id} done after {time.time() - start:.1f} seconds")
+        except Exception as e:
+            job.error = str(e) or type(e).__name__
+            job.state = FAILED
+            logger.exception(f"{name}: background job {job.id} failed: {e}")
+        finally:
+            job.finished = time.time()
+            job.event.set()
+        if on_done:
+            try:
+                on_done(job)
+            except Exception:
+                logger.exception(f"{name}: on_done callback of background job {job.id} failed")
+
+    EXECUTOR.submit(run)
+    logger.info(f"{name}: background job {job.id} submitted")
+    return job
+
+
+# Returns the Job with this id, or None if it is unknown (or finished long ago)
+def get(jobId):
+    with _lock:
+        forgotten = _trim()
+        job = _jobs.get(jobId)
+    _discard(forgotten)
+    return job
+
+
+# Forgets the oldest finished jobs beyond BACKGROUND_JOB_HISTORY, and those that finished more than
+# BACKGROUND_JOB_MAX_AGE_SECONDS ago; returns the (job, result) of those whose result is to be discarded
+# Callers hold _lock
+def _trim():
+    finished = [job for job in _jobs.values() if job.isFinished()]
+    excess = max(0, len(finished) - BACKGROUND_JOB_HISTORY)
+    expired = time.time() - BACKGROUND_JOB_MAX_AGE_SECONDS
+    forgotten = finished[:excess] + [job for job in finished[excess:] if job.finished < expired]
+    for job in forgotten:
+        del _jobs[job.id]
+    # Taken here, so that a caller still holding the Job cannot collect a result that is being discarded
+    return [(job, job._take()) for job in forgotten if job.discard and job.state == DONE and not job.collected]
+
+
+# Discards the results of forgotten jobs that were never collected
+def _discard(jobs):
+    for job, result in jobs:
+        try:
+            job.discard(result)
+        except Exception:
+            logger.exception(f"{job.name}: discarding the result of background job {job.id} failed")
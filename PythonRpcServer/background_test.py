@@ -0,0 +1,48 @@
+import os
+import threading
+
+import background
+
+
+def test_jobs():
+    release = threading.Event()
+    finished = []
+    job = background.submit('test', lambda: release.wait(10) and 42, on_done=finished.append)
+    assert background.get(job.id) is job
+    assert not job.wait(0.1)
+    release.set()
+    assert job.wait(10)
+    assert (job.state, job.result) == (background.DONE, 42)
+    assert finished == [job]
+
+    failed = background.submit('test', lambda: 1 / 0)
+    assert failed.wait(10)
+    assert failed.state == background.FAILED and 'division' in failed.error
+    assert background.get('missing') is None
+
+
+def test_threads():
+    job = background.submit('test', background.isBackgroundThread)
+    assert job.wait(10) and job.result
+    assert not background.isBackgroundThread()
+
+
+def test_results_are_collected_once(tmp_path):
+    output = tmp_path / 'final.mp4'
+    output.write_bytes(b'mp4')
+    job = background.submit('test', lambda: str(output), discard=os.remove)
+    assert job.wait(10)
+    assert job.collect() == str(output)
+    assert job.collect() is None  # Fetched twice: the second caller does not get the same file
+    assert output.exists()
+
+
+def test_results_that_are_never_collected_are_discarded(tmp_path, monkeypatch):
+    output = tmp_path / 'final.mp4'
+    output.write_bytes(b'mp4')
+    job = background.submit('test', lambda: str(output), discard=os.remove)
+    assert job.wait(10)
+    monkeypatch.setattr(background, 'BACKGROUND_JOB_HISTORY', 0)
+    assert background.get(job.id) is None  # Forgotten, and its file removed
+    assert not output.exists()
+    assert job.collect() is None
@@ -0,0 +1,35 @@
+import os
+from concurrent import futures
+
+# Concurrent processing for the batch RPCs (ComputeFileHashBatchRPC, GetMediaInfoBatchRPC)
+# Backfills and integrity sweeps send thousands of paths; each batch uses its own small thread pool
+# so that the items overlap their disk reads and ffprobe start up times.
+
+# Upper limit on the number of items of one batch that are processed at the same time
+BATCH_MAX_PARALLEL = int(os.getenv('BATCH_MAX_PARALLEL', 4))
+
+
+# Calls fn(item) for every item using up to max_parallel threads (0 or None = BATCH_MAX_PARALLEL)
+# Yields (index, result, error) in completion order; error is the exception raised by fn(item), or None
+# Only max_parallel items are submitted at a time, so a batch of thousands of paths does not create
+# thousands of futures, and no further items are started once context (a grpc context, optional) is inactive.
+def concurrently(items, fn, max_parallel=None, context=None):
+    items = list(items)
+    max_parallel = max(1, min(max_parallel or BATCH_MAX_PARALLEL, BATCH_MAX_PARALLEL))
+    with futures.ThreadPoolExecutor(max_parallel, thread_name_prefix='batch') as pool:
+        pending = {}
+        next_index = 0
+        while pending or next_index < len(items):
+            while next_index < len(items) and len(pending) < max_parallel:
+                if context is not None and not context.is_active():
+                    items = items[:next_index]  # Abandon the rest
+                    break
+                pending[pool.submit(fn, items[next_index])] = next_index
+                next_index += 1
+            if not pending:
+                break
+            done, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                error = future.exception()
+                yield index, None if error else future.result(), error
@@ -0,0 +1,37 @@
+import threading
+import time
+
+import batch
+
+
+def test_results_stream_in_completion_order_with_per_item_errors():
+    def work(item):
+        time.sleep(item / 10.0)
+        if item == 2:
+            raise ValueError('bad item')
+        return item * 10
+
+    results = list(batch.concurrently([3, 1, 2], work, 3))
+    assert [index for index, _, _ in results] == [1, 2, 0]
+    assert results[0][1:] == (10, None)
+    assert str(results[1][2]) == 'bad item'
+    assert results[2][1:] == (30, None)
+
+
+def test_parallelism_is_bounded():
+    lock = threading.Lock()
+    running = [0]
+    peak = [0]
+
+    def work(item):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+        return item
+
+    results = list(batch.concurrently(range(20), work, 2))
+    assert sorted(result for _, result, _ in results) == list(range(20))
+    assert peak[0] == 2
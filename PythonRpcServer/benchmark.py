@@ -0,0 +1,262 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+import cpubudget
+import filecache
+import log
+
+logger = log.getLogger(__name__)
+
+# Microbenchmarks of the PythonRpcServer hot paths, using media generated locally with ffmpeg's lavfi sources
+#   python benchmark.py                                 # all benchmarks, results as JSON on stdout (log on stderr)
+#   python benchmark.py --output after.json --compare before.json
+#   python benchmark.py --only hash,mediainfo --repeat 5
+# Each result has the raw run times and their median, so that runs can be compared across changes.
+# ffmpeg and ffprobe must be on the PATH.
+
+MB = 1024 * 1024
+
+
+# setup (optional) runs before each run, untimed (e.g. to empty a cache)
+def measure(fn, repeat, setup=None):
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = perf_counter()
+        fn()
+        times.append(perf_counter() - start)
+    return times
+
+
+def summary(name, times, **params):
+    median = statistics.median(times)
+    return {'name': name, 'params': params, 'runs': [round(t, 6) for t in times], 'median': round(median, 6),
+            'min': round(min(times), 6), 'max': round(max(times), 6)}
+
+
+# Generates an H.264/AAC mp4 of the given length from the testsrc2 and sine lavfi sources
+def makeVideo(path, seconds, size='1280x720', rate=30):
+    subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y',
+                    '-f', 'lavfi', '-i', f'testsrc2=size={size}:rate={rate}:duration={seconds}',
+                    '-f', 'lavfi', '-i', f'sine=frequency=440:sample_rate=48000:duration={seconds}',
+                    '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-shortest', path],
+                   check=True)
+    return path
+
+
+def makeRandomFile(path, size):
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            block = os.urandom(min(MB, remaining))
+            f.write(block)
+            remaining -= len(block)
+    return path
+
+
+def benchHash(workdir, repeat, quick):
+    import hasher
+    results = []
+    for size_mb in ([1, 16] if quick else [1, 16, 128]):
+        path = makeRandomFile(os.path.join(workdir, f'hash_{size_mb}mb.bin'), size_mb * MB)
+        # The digest cache is emptied before each run, so that every run reads the file
+        times = measure(lambda: hasher.hashFile(path, 'sha256'), repeat, hasher.DIGESTS.clear)
+        result = summary('hash.sha256', times, sizeMB=size_mb)
+        result['MBps'] = round(size_mb / result['median'], 1)
+        results.append(result)
+        times = measure(lambda: hasher.treeHashFile(path), repeat)
+        result = summary('hash.sha256-tree', times, sizeMB=size_mb)
+        result['MBps'] = round(size_mb / result['median'], 1)
+        results.append(result)
+        os.remove(path)
+    return results
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+# utils.download_file against a local HTTP server (measures our copy loop, not the network)
+def benchDownload(workdir, repeat, quick):
+    import utils
+    served = os.path.join(workdir, 'served')
+    os.makedirs(served, exist_ok=True)
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), partial(_QuietHandler, directory=served))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    results = []
+    try:
+        for size_mb in ([8] if quick else [8, 64]):
+            makeRandomFile(os.path.join(served, f'{size_mb}.mp4'), size_mb * MB)
+            url = f'http://127.0.0.1:{httpd.server_address[1]}/{size_mb}.mp4'
+
+            def download():
+                filepath, _ = utils.download_file(url)
+                os.remove(filepath)
+
+            result = summary('download_file', measure(download, repeat), sizeMB=size_mb)
+            result['MBps'] = round(size_mb / result['median'], 1)
+            results.append(result)
+    finally:
+        httpd.shutdown()
+    return results
+
+
+# Speed of the ffmpeg jobs relative to real time (realtime = media seconds per second of wall time)
+def benchFFmpeg(workdir, repeat, quick):
+    import artifactstore
+    import ffmpeg
+    import utils
+    # Otherwise the runs after the first only hard link the stored output
+    artifactstore.ARTIFACT_STORE = False
+    seconds = 10 if quick else 60
+    video = makeVideo(os.path.join(workdir, f'video_{seconds}s.mp4'), seconds)
+    results = []
+    # Each job returns the paths of its outputs
+    def processMedia():
+        result = ffmpeg.processMedia(video, video=True, wav=True)
+        return [result['video'][0], result['wav'][0]]
+
+    for name, job in [('convertVideoToWavWithOffset', lambda: [ffmpeg.convertVideoToWavWithOffset(video, 0)[0]]),
+                      ('processVideo', lambda: [ffmpeg.processVideo(video)[0]]),
+                      ('processVideoSegmented', lambda: [ffmpeg.processVideoSegmented(video, ffmpeg.probe(video))[0]]),
+                      ('processMedia', processMedia)]:
+        def run():
+            for filepath in job():
+                utils.removeFile(filepath)
+
+        result = summary(name, measure(run, repeat), mediaSeconds=seconds, threads=utils.getMaxThreads())
+        result['realtime'] = round(seconds / result['median'], 2)
+        results.append(result)
+    return results
+
+
+# ffprobe itself: the probe cache is emptied before each run
+def benchMediaInfo(workdir, repeat, quick):
+    import artifactstore
+    import ffmpeg
+    artifactstore.ARTIFACT_STORE = False
+    video = makeVideo(os.path.join(workdir, 'video_info.mp4'), 2)
+    return [summary('getMediaInfo', measure(lambda: ffmpeg.getMediaInfo(video), max(repeat, 10), ffmpeg.PROBE_CACHE.clear))]
+
+
+# A synthetic pytesseract image_to_data() dict for a 1280x720 slide: a large title line and smaller body text
+def syntheticOcr(words, rng):
+    data = {'conf': [], 'text': [], 'height': [], 'top': [], 'left': [], 'width': []}
+    for i in range(words):
+        title = i < 6
+        data['conf'].append(rng.randint(60, 99))
+        data['text'].append(rng.choice(['Lecture', 'Graphs', 'Intro', 'the', 'of', 'Algorithms', 'x', 'Data']))
+        data['height'].append(rng.randint(40, 50) if title else rng.randint(14, 22))
+        data['top'].append(rng.randint(40, 60) if title else rng.randint(150, 680))
+        data['left'].append(rng.randint(100, 1100))
+        data['width'].append(rng.randint(30, 160))
+    return data
+
+
+def benchTitleDetection(workdir, repeat, quick):
+    try:
+        import titledetector
+    except ImportError as e:
+        return [{'name': 'title_detection', 'skipped': str(e)}]
+    rng = random.Random(440)
+    results = []
+    for words in ([50] if quick else [50, 500]):
+        data = syntheticOcr(words, rng)
+        # Each run detects the title of 100 slides
+        times = measure(lambda: [titledetector.title_detection(data, 720, 1280) for _ in range(100)], repeat)
+        results.append(summary('title_detection', times, words=words, slides=100))
+    return results
+
+
+BENCHMARKS = {
+    'hash': benchHash,
+    'download': benchDownload,
+    'ffmpeg': benchFFmpeg,
+    'mediainfo': benchMediaInfo,
+    'title': benchTitleDetection,
+}
+
+
+def environment():
+    def firstLine(cmd):
+        try:
+            return subprocess.run(cmd, capture_output=True, text=True).stdout.splitlines()[0]
+        except Exception:
+            return None
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpuCount': os.cpu_count(),
+        'cpuBudget': cpubudget.BUDGET.total,
+        'ffmpeg': firstLine(['ffmpeg', '-version']),
+        'gitCommit': firstLine(['git', 'rev-parse', '--short', 'HEAD']),
+    }
+
+
+# Logs the change in each median relative to a previous run
+def compare(results, baseline):
+    before = {(r['name'], json.dumps(r.get('params'), sort_keys=True)): r for r in baseline['results'] if 'median' in r}
+    for r in results:
+        old = before.get((r['name'], json.dumps(r.get('params'), sort_keys=True)))
+        if old and 'median' in r and old['median'] > 0:
+            change = (r['median'] - old['median']) / old['median'] * 100
+            logger.info(f"{r['name']} {r['params']}: {old['median']:.4f}s -> {r['median']:.4f}s ({change:+.1f}%)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='PythonRpcServer microbenchmarks')
+    parser.add_argument('--only', help=f"comma separated subset of {','.join(BENCHMARKS)}")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--quick', action='store_true', help='smaller inputs')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--compare', help='a previous JSON result file to compare with')
+    args = parser.parse_args(argv)
+    log.setup(stream=sys.stderr)  # stdout may carry the JSON results
+
+    names = args.only.split(',') if args.only else list(BENCHMARKS)
+    workdir = tempfile.mkdtemp(prefix='pythonrpc-benchmark-')
+    # utils.getTmpFile() writes job outputs into DATA_DIRECTORY
+    os.environ.setdefault('DATA_DIRECTORY', workdir)
+    # Cached results (digests, probes) are kept in memory only, never read from or added to the real cache
+    filecache.FILECACHE_PATH = 'none'
+    results = []
+    try:
+        for name in names:
+            logger.info(f"Running {name}...")
+            for result in BENCHMARKS[name](workdir, args.repeat, args.quick):
+                logger.info(json.dumps(result))
+                results.append(result)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'environment': environment(), 'results': results}
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    log.shutdown()
+
+
+if __name__ == '__main__':
+    main()
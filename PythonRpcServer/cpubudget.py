@@ -0,0 +1,181 @@
+import math
+import os
+import threading
+from contextlib import contextmanager
+
+import background
+import metrics
+
+# Process wide CPU budget for the ffmpeg and whisper child processes (instead of each job using JOB_MAX_THREADS
+# regardless of what else is running)
+# The budget is the number of cores this process may use: the CPU affinity of the process, limited by the cgroup
+# CPU quota (docker --cpus, kubernetes cpu limits). Jobs lease threads from it:
+#  - a job gets its threads when it starts a child process: the cores that are free at that moment, or at least
+#    its fair share (budget / number of running jobs) when the node is busy
+#  - a running process cannot change its number of threads, so as jobs start and finish the running children
+#    are re-balanced by pinning each to its own share of the allowed cores (sched_setaffinity, Linux only)
+#  - background jobs (background.py) only get the cores that are free, do not reduce the share of the other jobs,
+#    and are not pinned (they run at a lower priority instead)
+#   with cpubudget.lease() as lease:
+#       runner.run(['ffmpeg', '-threads', str(lease.threads), ...], lease=lease)
+
+# Cores to share; 0 = detect
+CPU_BUDGET = int(os.getenv('CPU_BUDGET', 0))
+# Upper limit on the threads of one job; the budget can only lower it. Be careful about setting this value too high
+# (recommended values 1-4); 0 = no limit other than the budget
+DEFAULT_JOB_MAX_THREADS = 4
+JOB_MAX_THREADS = int(os.getenv('JOB_MAX_THREADS', DEFAULT_JOB_MAX_THREADS))
+# Pin the running child processes to their share of the cores
+CPU_REBALANCE = os.getenv('CPU_REBALANCE', '1') == '1'
+
+
+def allowedCpus():
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:  # Not Linux
+        return list(range(os.cpu_count() or 1))
+
+
+def _readCgroupFile(path):
+    try:
+        with open(path) as f:
+            return f.read().split()
+    except OSError:
+        return None
+
+
+# Cores allowed by the cgroup CPU quota of this process, or None if it has no quota
+def cgroupQuota():
+    # cgroup v2: '0::/path' in /proc/self/cgroup; inside a container the namespace root is /sys/fs/cgroup
+    paths = ['/sys/fs/cgroup/cpu.max']
+    for line in (_readCgroupFile('/proc/self/cgroup') or []):
+        if line.startswith('0::/') and len(line) > 4:
+            paths.insert(0, f'/sys/fs/cgroup{line[3:]}/cpu.max')
+    for path in paths:
+        values = _readCgroupFile(path)
+        if values and len(values) == 2 and values[0] != 'max':
+            try:
+                return int(values[0]) / int(values[1])
+            except (ValueError, ZeroDivisionError):
+                pass
+    # cgroup v1
+    quota = _readCgroupFile('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+    period = _readCgroupFile('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    try:
+        if quota and period and int(quota[0]) > 0:
+            return int(quota[0]) / int(period[0])
+    except (ValueError, ZeroDivisionError):
+        pass
+    return None
+
+
+def detect():
+    cores = len(allowedCpus())
+    quota = cgroupQuota()
+    if quota:
+        cores = min(cores, max(1, math.ceil(quota)))
+    return cores
+
+
+class Lease:
+    def __init__(self, budget, threads, spare=False):
+        self.budget = budget
+        self.threads = threads
+        self.spare = spare
+        self.pids = []
+
+    # Called by runner.run for each child process started with this lease
+    def attach(self, pid):
+        with self.budget.lock:
+            self.pids.append(pid)
+            self.budget.rebalance()
+
+    def detach(self, pid):
+        with self.budget.lock:
+            if pid in self.pids:
+                self.pids.remove(pid)
+                self.budget.rebalance()
+
+    def release(self):
+        self.budget.release(self)
+
+
+class Budget:
+    def __init__(self, total, cpus):
+        self.total = total
+        self.cpus = cpus
+        self.lock = threading.Lock()
+        self.leases = []
+
+    def used(self):
+        with self.lock:
+            return sum(lease.threads for lease in self.leases if not lease.spare)
+
+    # Returns a Lease; the caller calls its release() when its processes have finished
+    # want = the most threads the job can use (None = JOB_MAX_THREADS)
+    # spare = only use the free cores (at least one), without taking a share from the other jobs
+    def acquire(self, want=None, spare=False):
+        limit = min(want or self.total, JOB_MAX_THREADS or self.total)
+        with self.lock:
+            leases = [lease for lease in self.leases if not lease.spare]
+            free = self.total - sum(lease.threads for lease in leases)
+            fair = 0 if spare else self.total // (len(leases) + 1)
+            lease = Lease(self, max(1, min(limit, max(free, fair))), spare)
+            self.leases.append(lease)
+        metrics.CPU_LEASED_THREADS.inc(lease.threads)
+        return lease
+
+    def release(self, lease):
+        with self.lock:
+            if lease not in self.leases:
+                return
+            self.leases.remove(lease)
+            self.rebalance()
+        metrics.CPU_LEASED_THREADS.dec(lease.threads)
+
+    # Pins the child processes of each lease to a share of the allowed cores in proportion to its threads (or
+    # to all the cores when only one lease has processes). Callers hold self.lock
+    def rebalance(self):
+        running = [lease for lease in self.leases if lease.pids and not lease.spare]
+        if not CPU_REBALANCE or not running or not hasattr(os, 'sched_setaffinity'):
+            return
+        count = len(self.cpus)
+        total = sum(lease.threads for lease in running)
+        done = 0
+        for lease in running:
+            start = count * done // total
+            done += lease.threads
+            end = max(start + 1, count * done // total)
+            cpus = self.cpus if len(running) == 1 else {self.cpus[i % count] for i in range(start, end)}
+            for pid in lease.pids:
+                _pin(pid, cpus)
+
+
+# Sets the affinity of every thread of process pid
+def _pin(pid, cpus):
+    try:
+        threads = os.listdir(f'/proc/{pid}/task')
+    except OSError:
+        threads = [pid]
+    for tid in threads:
+        try:
+            os.sched_setaffinity(int(tid), cpus)
+        except OSError:
+            pass  # Exited
+
+
+BUDGET = Budget(CPU_BUDGET or detect(), allowedCpus())
+metrics.CPU_BUDGET_THREADS.set(BUDGET.total)
+
+
+def acquire(want=None):
+    return BUDGET.acquire(want, spare=background.isBackgroundThread())
+
+
+@contextmanager
+def lease(want=None):
+    lease = acquire(want)
+    try:
+        yield lease
+    finally:
+        lease.release()
@@ -0,0 +1,49 @@
+import cpubudget
+
+
+def test_leases_share_the_budget(monkeypatch):
+    monkeypatch.setattr(cpubudget, 'JOB_MAX_THREADS', 0)
+    budget = cpubudget.Budget(8, list(range(8)))
+    first = budget.acquire()
+    assert first.threads == 8  # Alone: everything
+    second = budget.acquire()
+    assert second.threads == 4  # Busy: the fair share
+    third = budget.acquire(want=2)
+    assert third.threads == 2
+    assert budget.used() == 14
+    first.release()
+    second.release()
+    assert budget.acquire().threads == 6  # What is free
+    third.release()
+    third.release()  # Twice is harmless
+    assert budget.used() == 6
+
+
+def test_spare_leases(monkeypatch):
+    monkeypatch.setattr(cpubudget, 'JOB_MAX_THREADS', 0)
+    budget = cpubudget.Budget(8, list(range(8)))
+    first = budget.acquire(want=6)
+    assert budget.acquire(spare=True).threads == 2  # Only what is free
+    assert budget.acquire(spare=True).threads == 2  # and it does not count against the others
+    assert budget.acquire().threads == 4  # The fair share, as if the spare leases did not exist
+    first.release()
+    assert budget.used() == 4
+
+
+def test_job_max_threads_caps_each_lease(monkeypatch):
+    monkeypatch.setattr(cpubudget, 'JOB_MAX_THREADS', cpubudget.DEFAULT_JOB_MAX_THREADS)
+    budget = cpubudget.Budget(16, list(range(16)))
+    assert budget.acquire().threads == cpubudget.DEFAULT_JOB_MAX_THREADS  # Not every core
+    assert budget.acquire(want=8).threads == cpubudget.DEFAULT_JOB_MAX_THREADS
+    small = cpubudget.Budget(2, [0, 1])
+    assert small.acquire().threads == 2  # The budget lowers it
+
+
+def test_cgroup_quota(monkeypatch):
+    files = {'/proc/self/cgroup': ['0::/'], '/sys/fs/cgroup/cpu.max': ['250000', '100000']}
+    monkeypatch.setattr(cpubudget, '_readCgroupFile', files.get)
+    assert cpubudget.cgroupQuota() == 2.5
+    files['/sys/fs/cgroup/cpu.max'] = ['max', '100000']
+    assert cpubudget.cgroupQuota() is None
+    files.update({'/sys/fs/cgroup/cpu/cpu.cfs_quota_us': ['150000'], '/sys/fs/cgroup/cpu/cpu.cfs_period_us': ['100000']})
+    assert cpubudget.cgroupQuota() == 1.5
@@ -0,0 +1,383 @@
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from concurrent import futures
+
+import log
+import metrics
+import utils
+
+try:
+    import fcntl
+except ImportError:  # Not Linux/Unix: downloads are not resumed
+    fcntl = None
+
+logger = log.getLogger(__name__)
+
+# Download engine of utils.download_file, for multi GB Echo and Kaltura recordings
+#  - The first request asks for the first part (a byte range). A server that supports ranges (206 Partial Content)
+#    reports the size of the file; the file is preallocated and the other parts are fetched by DOWNLOAD_PARALLEL
+#    connections at once, each writing at its own offset
+#  - A part that fails (dropped connection, 5xx) is retried, from where it stopped, with exponential backoff
+#  - The parts that are complete are recorded in a sidecar state file next to the partial download; the partial
+#    file is named after the URL, so when the same URL is downloaded again after a crash (or after the retries ran
+#    out) only the missing parts are fetched, once the size and ETag/Last-Modified of the file are confirmed
+#  - A server that ignores ranges (200 OK) gets a single streamed download, restarted from zero on failure
+
+DOWNLOAD_PARALLEL = int(os.getenv('DOWNLOAD_PARALLEL', 4))
+# Size of the ranges; the unit of parallelism and of resuming
+DOWNLOAD_PART_BYTES = int(os.getenv('DOWNLOAD_PART_BYTES', 32 * 1024 * 1024))
+DOWNLOAD_RETRIES = int(os.getenv('DOWNLOAD_RETRIES', 5))
+DOWNLOAD_BACKOFF_SECONDS = float(os.getenv('DOWNLOAD_BACKOFF_SECONDS', 1.0))
+DOWNLOAD_MAX_BACKOFF_SECONDS = 30.0
+# Bytes read from the connection and written to the file at a time
+WRITE_BUFFER_BYTES = 1024 * 1024
+# Partial downloads that were not resumed (e.g. a Kaltura URL includes its session, so a retry with a new session
+# has another URL) are removed once they are older than this, or, oldest first, while they take more than
+# DOWNLOAD_PARTIAL_MAX_BYTES (see cleanup)
+DOWNLOAD_PARTIAL_MAX_AGE_SECONDS = float(os.getenv('DOWNLOAD_PARTIAL_MAX_AGE_SECONDS', 24 * 3600))
+DOWNLOAD_PARTIAL_MAX_BYTES = int(os.getenv('DOWNLOAD_PARTIAL_MAX_BYTES', 20 * 1024 * 1024 * 1024))
+# Seconds between the cleanups that downloads start
+DOWNLOAD_CLEANUP_INTERVAL_SECONDS = 3600
+
+
+class DownloadError(Exception):
+    pass
+
+
+def _partialDirectory():
+    return os.path.join(utils.DATA_DIRECTORY, 'pythonrpc')
+
+
+# Partial downloads of the same URL have the same path, so that they can be resumed
+def _partialPath(url):
+    name = 'download_' + hashlib.sha256(url.encode('utf-8')).hexdigest()[:32]
+    os.makedirs(_partialDirectory(), exist_ok=True)
+    return os.path.join(_partialDirectory(), name)
+
+
+def _get(url, cookies, timeout, start=None, end=None):
+    import requests # Imported on first use; it is slow to import and most replicas never download
+    headers = {}
+    if start is not None:
+        # Ranges are of the bytes as stored, not of a compressed transfer encoding
+        headers = {'Range': f'bytes={start}-{"" if end is None else end}', 'Accept-Encoding': 'identity'}
+    response = requests.get(url, stream=True, allow_redirects=True, cookies=cookies, timeout=timeout, headers=headers)
+    try:
+        response.raise_for_status()
+    except Exception:
+        response.close()
+        raise
+    return response
+
+
+# Connection failures, timeouts, 5xx and 408/429 are worth retrying; other errors (e.g. 403, an expired link) are not
+def _retryable(e):
+    import requests
+    if isinstance(e, requests.HTTPError):
+        status = e.response.status_code if e.response is not None else 0
+        return status >= 500 or status in (408, 429)
+    return isinstance(e, (requests.RequestException, DownloadError))
+
+
+def _backoff(attempt, what, e):
+    delay = min(DOWNLOAD_MAX_BACKOFF_SECONDS, DOWNLOAD_BACKOFF_SECONDS * 2 ** attempt) * random.uniform(0.5, 1.0)
+    metrics.DOWNLOAD_RETRIES.inc()
+    logger.warning(f"download: {what} failed ({e}); retrying in {delay:.1f} seconds")
+    time.sleep(delay)
+
+
+# Total size of the file from the Content-Range of a 206 response ('bytes 0-99/1234'), or None if unknown
+def _totalSize(response):
+    total = response.headers.get('Content-Range', '').rpartition('/')[2]
+    return int(total) if total.isdigit() else None
+
+
+def _validator(response):
+    return response.headers.get('ETag') or response.headers.get('Last-Modified') or ''
+
+
+class _State:
+    def __init__(self, path, url):
+        self.path = path
+        self.url = url
+        self.size = None
+        self.validator = ''
+        self.partBytes = DOWNLOAD_PART_BYTES
+        self.done = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def load(path, url):
+        state = _State(path, url)
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+            if saved.get('url') == url:
+                state.size, state.validator = saved['size'], saved['validator']
+                state.partBytes, state.done = saved['partBytes'], set(saved['done'])
+        except (OSError, ValueError, KeyError):
+            pass
+        return state
+
+    def parts(self):
+        return (self.size + self.partBytes - 1) // self.partBytes if self.size else 0
+
+    def missing(self):
+        return [part for part in range(self.parts()) if part not in self.done]
+
+    def range(self, part):
+        return part * self.partBytes, min(self.size, (part + 1) * self.partBytes) - 1
+
+    def reset(self, size, validator):
+        self.size, self.validator, self.partBytes, self.done = size, validator, DOWNLOAD_PART_BYTES, set()
+        self.save()
+
+    def complete(self, part):
+        with self.lock:
+            self.done.add(part)
+            self.save()
+
+    # Written to a new file that replaces the old one, so a crash never leaves a truncated state
+    def save(self):
+        if self.path is None:  # Not resumable
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'url': self.url, 'size': self.size, 'validator': self.validator,
+                       'partBytes': self.partBytes, 'done': sorted(self.done)}, f)
+        os.replace(tmp, self.path)
+
+
+# Holds an exclusive lock on path while the partial download is in use (a concurrent download of the same URL
+# does not resume, but downloads to a file of its own)
+class _Lock:
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        if fcntl is None:
+            return False
+        while True:
+            self.file = open(self.path, 'a')
+            try:
+                fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self.file.close()
+                self.file = None
+                return False
+            # cleanup() removes lock files (while it holds them); a lock taken on a file that was removed meanwhile
+            # locks nothing, so it is taken again on the file now at path
+            try:
+                if os.fstat(self.file.fileno()).st_ino == os.stat(self.path).st_ino:
+                    return True
+            except FileNotFoundError:
+                pass
+            self.file.close()
+
+    def __exit__(self, *exc):
+        if self.file:
+            self.file.close()
+
+
+def _preallocate(filepath, size):
+    with open(filepath, 'wb') as f:
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)  # Fails now rather than half way if the disk is too small
+        except (AttributeError, OSError):
+            f.truncate(size)
+
+
+# Writes the bytes start..end (inclusive) of url at the same offsets of filepath, retrying from where a failed
+# attempt stopped. response (optional) is an open 206 response for that range
+def _fetchRange(url, cookies, timeout, filepath, start, end, response=None):
+    position = start
+    attempt = 0
+    while True:
+        try:
+            if response is None:
+                response = _get(url, cookies, timeout, position, end)
+                if response.status_code != 206:
+                    response.close()
+                    raise DownloadError(f"range {position}-{end} was answered with {response.status_code}")
+            with response, open(filepath, 'r+b', buffering=WRITE_BUFFER_BYTES) as f:
+                f.seek(position)
+                for chunk in response.iter_content(chunk_size=WRITE_BUFFER_BYTES):
+                    chunk = chunk[:end + 1 - position]
+                    f.write(chunk)
+                    position += len(chunk)
+                    if position > end:
+                        break
+                f.flush()
+                os.fsync(f.fileno())
+            if position <= end:
+                raise DownloadError(f"range {start}-{end} ended after {position - start} bytes")
+            return
+        except Exception as e:
+            response = None
+            if attempt >= DOWNLOAD_RETRIES or not _retryable(e):
+                raise
+            _backoff(attempt, f"range {start}-{end} of {url}", e)
+            attempt += 1
+
+
+# Single stream download (for servers without range support), restarted from zero after a failure
+def _fetchWhole(url, cookies, timeout, filepath, response=None):
+    attempt = 0
+    while True:
+        try:
+            if response is None:
+                response = _get(url, cookies, timeout)
+            with response, open(filepath, 'wb', buffering=WRITE_BUFFER_BYTES) as f:
+                for chunk in response.iter_content(chunk_size=WRITE_BUFFER_BYTES):
+                    f.write(chunk)
+            return
+        except Exception as e:
+            response = None
+            if attempt >= DOWNLOAD_RETRIES or not _retryable(e):
+                raise
+            _backoff(attempt, url, e)
+            attempt += 1
+
+
+# Downloads url to filepath (or a new temporary file); returns (filepath, content type or None)
+def download(url, filepath=None, cookies=None, timeout=60):
+    _cleanupIfDue()
+    partial = _partialPath(url)
+    with _Lock(partial + '.lock') as resumable:
+        if resumable:
+            state = _State.load(partial + '.state', url)
+        else:
+            partial = utils.getTmpFile()
+            state = _State(None, url)
+        if state.size and not (os.path.exists(partial) and os.path.getsize(partial) == state.size):
+            state.size = None
+        try:
+            contentType = _download(url, cookies, timeout, partial, state)
+        except Exception:
+            if not resumable:
+                utils.removeFile(partial)
+            raise
+
+        output = filepath or utils.getTmpFile()
+        os.replace(partial, output)
+        if resumable:
+            utils.removeFile(state.path)  # The lock file is left for cleanup(); removing it here would race
+    return output, contentType
+
+
+def _download(url, cookies, timeout, partial, state):
+    import requests
+    # The first missing part, which also shows whether the server supports ranges (and if the file changed)
+    missing = state.missing() if state.size else [0]
+    start = missing[0] * state.partBytes if missing else 0
+    end = start + state.partBytes - 1
+    try:
+        response = _get(url, cookies, timeout, start, end)
+    except requests.HTTPError as e:
+        if e.response is None or e.response.status_code != 416:  # 416: e.g. an empty file
+            raise
+        response = _get(url, cookies, timeout)
+    contentType = response.headers.get('content-type')
+    size = _totalSize(response) if response.status_code == 206 else None
+
+    if size is None:
+        logger.info(f"download: {url} does not support ranges; single stream")
+        _fetchWhole(url, cookies, timeout, partial, response)
+        return contentType
+
+    if (size, _validator(response)) != (state.size, state.validator) or start >= size:
+        if state.done:
+            logger.info(f"download: {url} changed since the partial download; starting again")
+        state.reset(size, _validator(response))
+        _preallocate(partial, size)
+        missing = state.missing()
+    elif missing:
+        logger.info(f"download: resuming {url} ({len(state.done)} of {state.parts()} parts already done)")
+    # The response covers the first missing part, unless the parts were laid out again
+    if not missing or state.range(missing[0])[0] != start or state.range(missing[0])[1] > end:
+        response.close()
+        response = None
+    if missing:
+        _fetchParts(url, cookies, timeout, partial, state, missing, response)
+    return contentType
+
+
+# Fetches the missing parts, DOWNLOAD_PARALLEL at a time; response is the open response for missing[0] (or None)
+def _fetchParts(url, cookies, timeout, filepath, state, missing, response):
+    def fetch(part, response=None):
+        start, end = state.range(part)
+        _fetchRange(url, cookies, timeout, filepath, start, end, response)
+        state.complete(part)
+
+    with futures.ThreadPoolExecutor(max(1, DOWNLOAD_PARALLEL), thread_name_prefix='download') as pool:
+        jobs = [pool.submit(fetch, missing[0], response)] + [pool.submit(fetch, part) for part in missing[1:]]
+        futures.wait(jobs, return_when=futures.FIRST_EXCEPTION)
+        for job in jobs:
+            job.cancel()
+        errors = [job.exception() for job in jobs if not job.cancelled() and job.exception()]
+    if errors:
+        raise errors[0]
+
+
+_lastCleanup = 0.0
+_cleanupLock = threading.Lock()
+
+
+def _cleanupIfDue():
+    global _lastCleanup
+    with _cleanupLock:
+        if _lastCleanup and time.monotonic() - _lastCleanup < DOWNLOAD_CLEANUP_INTERVAL_SECONDS:
+            return
+        _lastCleanup = time.monotonic()
+    cleanup()
+
+
+# Removes the partial downloads (with their state and lock files) that are older than
+# DOWNLOAD_PARTIAL_MAX_AGE_SECONDS, then the oldest others while they take more than DOWNLOAD_PARTIAL_MAX_BYTES
+# A partial download that is in use (its lock is held) is left alone. Returns the number removed
+def cleanup(now=None):
+    directory = _partialDirectory()
+    groups = {}  # download_<hash> -> [paths], newest mtime, bytes
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.name.startswith('download_'):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                group = groups.setdefault(entry.name.split('.')[0], [[], 0.0, 0])
+                group[0].append(entry.path)
+                group[1] = max(group[1], st.st_mtime)
+                group[2] += st.st_blocks * 512 if hasattr(st, 'st_blocks') else st.st_size
+    except OSError:
+        return 0  # No data directory yet
+
+    now = now or time.time()
+    total = sum(group[2] for group in groups.values())
+    removed = 0
+    for name, (paths, mtime, size) in sorted(groups.items(), key=lambda item: item[1][1]):
+        if now - mtime < DOWNLOAD_PARTIAL_MAX_AGE_SECONDS and total <= DOWNLOAD_PARTIAL_MAX_BYTES:
+            continue
+        with _Lock(os.path.join(directory, name + '.lock')) as locked:
+            if not locked:
+                continue  # In use
+            for path in paths:
+                utils.removeFile(path)
+            utils.removeFile(os.path.join(directory, name + '.lock'))
+        total -= size
+        removed += 1
+    if removed:
+        logger.info(f"download: removed {removed} stale partial downloads; {total} bytes of partial downloads remain")
+    return removed
+
+
+# Runs cleanup() in a background thread (at start up)
+def startCleanup():
+    threading.Thread(target=_cleanupIfDue, name='download-cleanup', daemon=True).start()
@@ -0,0 +1,150 @@
+import fcntl
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import downloader
+import filecache
+import utils
+
+BODY = os.urandom(100 * 1000 + 7)
+
+
+# Serves BODY, with range support unless ranges is False; the first `drop` range responses stop half way
+class Handler(BaseHTTPRequestHandler):
+    ranges = True
+    drop = 0
+    fail = set()
+    requested = []
+
+    def do_GET(self):
+        header = self.headers.get('Range')
+        if not (self.ranges and header):
+            self.respond(200, BODY, {})
+            return
+        first, _, last = header[len('bytes='):].partition('-')
+        start, end = int(first), min(int(last or len(BODY) - 1), len(BODY) - 1)
+        Handler.requested.append(start)
+        if start in Handler.fail:
+            self.send_error(503)
+            return
+        self.respond(206, BODY[start:end + 1], {'Content-Range': f'bytes {start}-{end}/{len(BODY)}'})
+
+    def respond(self, status, body, headers):
+        self.send_response(status)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', '"v1"')
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if Handler.drop > 0:
+            Handler.drop -= 1
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, 'DATA_DIRECTORY', str(tmp_path))
+    monkeypatch.setattr(filecache, 'FILECACHE_PATH', 'none')
+    monkeypatch.setattr(downloader, 'DOWNLOAD_PART_BYTES', 16 * 1000)
+    monkeypatch.setattr(downloader, 'DOWNLOAD_BACKOFF_SECONDS', 0.01)
+    monkeypatch.setattr(Handler, 'ranges', True)
+    monkeypatch.setattr(Handler, 'drop', 0)
+    monkeypatch.setattr(Handler, 'fail', set())
+    monkeypatch.setattr(Handler, 'requested', [])
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}/lecture.mp4'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_parts_are_downloaded_in_parallel(server, tmp_path):
+    filepath, extension = utils.download_file(server, str(tmp_path / 'out'))
+    assert read(filepath) == BODY
+    assert extension == '.mp4'
+    assert sorted(Handler.requested) == list(range(0, len(BODY), downloader.DOWNLOAD_PART_BYTES))
+    assert [name for name in os.listdir(tmp_path / 'pythonrpc') if name.startswith('download_')] == [
+        os.path.basename(downloader._partialPath(server)) + '.lock']  # Only the lock, removed by cleanup()
+
+
+def test_dropped_connections_are_retried(server):
+    Handler.drop = 3
+    filepath, _ = downloader.download(server)
+    assert read(filepath) == BODY
+
+
+def test_servers_without_ranges_get_a_single_stream(server):
+    Handler.ranges = False
+    Handler.drop = 1
+    filepath, _ = downloader.download(server)
+    assert read(filepath) == BODY
+
+
+def test_failed_downloads_resume_with_the_missing_parts(server, monkeypatch):
+    monkeypatch.setattr(downloader, 'DOWNLOAD_RETRIES', 1)
+    Handler.fail = {32 * 1000, 80 * 1000}
+    with pytest.raises(requests.HTTPError):
+        downloader.download(server)
+
+    Handler.fail = set()
+    Handler.requested = []
+    filepath, _ = downloader.download(server)
+    assert read(filepath) == BODY
+    assert sorted(Handler.requested) == [32 * 1000, 80 * 1000]
+
+
+def test_stale_partial_downloads_are_removed(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, 'DATA_DIRECTORY', str(tmp_path))
+    directory = tmp_path / 'pythonrpc'
+    directory.mkdir()
+    old = time.time() - 2 * downloader.DOWNLOAD_PARTIAL_MAX_AGE_SECONDS
+    for name in ['download_old', 'download_old.state', 'download_busy', 'download_new', 'tmp_other']:
+        (directory / name).write_bytes(b'x' * 100)
+        if not name.startswith('download_new'):
+            os.utime(directory / name, (old, old))
+
+    with downloader._Lock(str(directory / 'download_busy.lock')):
+        assert downloader.cleanup() == 1
+        assert sorted(os.listdir(directory)) == ['download_busy', 'download_busy.lock', 'download_new', 'tmp_other']
+
+        monkeypatch.setattr(downloader, 'DOWNLOAD_PARTIAL_MAX_BYTES', 0)  # Over the limit: the oldest go first
+        assert downloader.cleanup() == 1
+        assert sorted(os.listdir(directory)) == ['download_busy', 'download_busy.lock', 'tmp_other']
+
+
+def test_locks_follow_the_lock_file(tmp_path, monkeypatch):
+    path = str(tmp_path / 'download_x.lock')
+    flock = fcntl.flock
+    calls = []
+
+    def removedBeforeLocking(f, operation):
+        if not calls:
+            os.remove(path)  # As cleanup() does, between the open and the lock
+        calls.append(f)
+        flock(f, operation)
+
+    open(path, 'a').close()
+    monkeypatch.setattr(downloader.fcntl, 'flock', removedBeforeLocking)
+    with downloader._Lock(path) as owner:
+        assert owner and len(calls) == 2  # Locked again, on the file now at path
+        monkeypatch.setattr(downloader.fcntl, 'flock', flock)
+        with downloader._Lock(path) as second:
+            assert not second
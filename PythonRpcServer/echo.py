@@ -4,6 +4,10 @@ import os
 import json
 from mediaprovider import MediaProvider, InvalidPlaylistInfoException
 
+import log
+
+logger = log.getLogger(__name__)
+
 class EchoProvider(MediaProvider):
     def getPlaylistItems(self, request):
         res = self.get_syllabus(request.Url, stream = request.Stream)
@@ -81,7 +85,7 @@ class EchoProvider(MediaProvider):
                 medias.append(mediaJson)
                 
             except Exception as e:
-                print('Exception', str(e))
+                logger.warning(f"Exception {e}")
         
 
         return {"medias": medias, "downloadHeader": encode(request1.cookies)}
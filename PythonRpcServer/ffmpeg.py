@@ -1,80 +1,490 @@
+import os
+import shutil
+from concurrent import futures
 from ffmpy import FFmpeg
-import subprocess
 from time import perf_counter 
 import utils
 import json
+import runner
+import metrics
+import filecache
+import cpubudget
+import mediaheader
+import background
+import artifactstore
+from progress import ProgressTracker, PartsTracker, ffmpegLineHandler
+import log
+
+logger = log.getLogger(__name__)
 
 default_max_threads = 3
 
-def convertVideoToWavWithOffset(input_filepath, offset):
+# libx264 preset of the low res mp4, and of the quick first encode of processVideoPreview
+VIDEO_PRESET = os.getenv('FFMPEG_VIDEO_PRESET', 'medium')
+PREVIEW_PRESET = os.getenv('FFMPEG_PREVIEW_PRESET', 'superfast')
+
+# Low res mp4 options (processVideo, processMedia)
+AUDIO_ENCODE_OPTIONS = '-c:a aac -ar 48000'
+
+def videoEncodeOptions(preset=VIDEO_PRESET):
+    return f'-c:v libx264 -b:v 500K -s 768x432 -preset {preset}'
+
+def videoOutputOptions(preset=VIDEO_PRESET):
+    return f'{videoEncodeOptions(preset)} {AUDIO_ENCODE_OPTIONS} -f mp4 -movflags faststart'
+
+VIDEO_OUTPUT_OPTIONS = videoOutputOptions()
+# 16 kHz mono wav for whisper (processMedia)
+WAV_OUTPUT_OPTIONS = '-c:a pcm_s16le -ac 1 -ar 16000 -f wav'
+
+# Inputs that already match the output profile are remuxed (or hard linked) instead of transcoded
+# (e.g. small H.264/AAC Kaltura flavors and YouTube downloads, or a wav that is already 16 kHz mono)
+FAST_PATHS = os.getenv('FFMPEG_FAST_PATHS', '1') == '1'
+# processVideo passes through H.264 video up to this size and bit rate (bits/s)
+PASSTHROUGH_MAX_WIDTH = 768
+PASSTHROUGH_MAX_HEIGHT = 432
+PASSTHROUGH_MAX_VIDEO_BITRATE = int(os.getenv('PASSTHROUGH_MAX_VIDEO_BITRATE', 800000))
+
+# processVideo can encode inputs of at least SEGMENT_MIN_SECONDS in segments, using SEGMENT_PARALLEL ffmpeg
+# processes at a time (see processVideoSegmented). Off by default, as the joined output is not the same file as
+# a single encode: 1 = never segment, 0 = as many processes as the job's CPU lease allows, N = N processes
+SEGMENT_PARALLEL = int(os.getenv('FFMPEG_SEGMENT_PARALLEL', 1))
+SEGMENT_MIN_SECONDS = float(os.getenv('FFMPEG_SEGMENT_MIN_SECONDS', 600))
+# Longest segment; shorter inputs are cut into about two segments per process, but none shorter than 10 seconds
+SEGMENT_MAX_SECONDS = float(os.getenv('FFMPEG_SEGMENT_MAX_SECONDS', 120))
+# Threads of each segment's encoder (libx264 makes better use of a core per segment than of threads)
+SEGMENT_THREADS = int(os.getenv('FFMPEG_SEGMENT_THREADS', 1))
+# Read durations and the 'fields' media info of MP4/MOV, WAV and MPEG-TS files from their headers (mediaheader.py)
+# instead of running ffprobe
+NATIVE_PROBE = os.getenv('NATIVE_PROBE', '1') == '1'
+
+# Runs the ffmpeg command described by ff
+# If progress (a callback, see progress.py) is given, ffmpeg reports its progress on stdout
+# and duration (in seconds, may be None) is used to estimate percent done and time remaining
+# context (optional) is the grpc context; ffmpeg is stopped if the call is cancelled (see runner.py)
+# lease (optional) is the cpubudget.Lease of the threads given to ff
+def runFFmpeg(ff, progress=None, duration=None, context=None, lease=None):
+    args = runner.ffmpegArgs(ff)
+    if not progress:
+        runner.run(args, context=context, lease=lease)
+        return
+    tracker = ProgressTracker(duration, progress)
+    runner.run(args[:1] + ['-progress', 'pipe:1'] + args[1:], on_stdout=ffmpegLineHandler(tracker), context=context, lease=lease)
+    tracker.finish()
+
+# Returns the parsed ffprobe output of getMediaInfo (fields mode), or {} if the input could not be probed
+def probe(input_filepath, context=None):
+    try:
+        return json.loads(getMediaInfo(input_filepath, context, 'fields'))
+    except Exception as e:
+        logger.warning(f"probe('{input_filepath}'): {e}")
+        return {}
+
+def probeDuration(info):
+    try:
+        return float(info.get('format', {}).get('duration'))
+    except (TypeError, ValueError):
+        return None
+
+def _streams(info, codec_type):
+    # Cover art is reported as a video stream
+    return [s for s in info.get('streams', []) if s.get('codec_type') == codec_type
+            and not s.get('disposition', {}).get('attached_pic')]
+
+# True if the probed input is already a small H.264/AAC mp4, that processVideo can remux without transcoding
+def isPassthroughVideo(info):
+    formats = info.get('format', {}).get('format_name', '').split(',')
+    video, audio = _streams(info, 'video'), _streams(info, 'audio')
+    if 'mp4' not in formats or len(video) != 1 or len(audio) > 1:
+        return False
+    v = video[0]
+    try:
+        bitrate = int(v.get('bit_rate') or info['format'].get('bit_rate') or 0)
+        small = int(v.get('width', 0)) <= PASSTHROUGH_MAX_WIDTH and int(v.get('height', 0)) <= PASSTHROUGH_MAX_HEIGHT
+    except ValueError:
+        return False
+    return (v.get('codec_name') == 'h264' and v.get('pix_fmt') == 'yuv420p' and small
+            and 0 < bitrate <= PASSTHROUGH_MAX_VIDEO_BITRATE
+            and all(a.get('codec_name') == 'aac' for a in audio))
+
+# True if the probed input is already a 16 kHz mono 16 bit wav
+def isWhisperWav(info):
+    audio = _streams(info, 'audio')
+    return (info.get('format', {}).get('format_name') == 'wav' and len(audio) == 1 and not _streams(info, 'video')
+            and audio[0].get('codec_name') == 'pcm_s16le' and audio[0].get('channels') == 1
+            and str(audio[0].get('sample_rate')) == '16000')
+
+# Returns the duration of the media in seconds, or None if it is unknown
+def getDuration(input_filepath):
+    info = mediaheader.parse(input_filepath) if NATIVE_PROBE else None
+    if info:
+        return float(info['format']['duration'])
+    try:
+        result = runner.output(
+            ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', input_filepath])
+        return float(result.strip())
+    except Exception as e:
+        logger.warning(f"getDuration('{input_filepath}'): {e}")
+        return None
+
+def convertVideoToWavWithOffset(input_filepath, offset, progress=None, context=None):
+    output_filepath = None
+    lease = None
     try:
         start_time = perf_counter()
         if offset is None:
             offset = 0.0
-        
-        nthreads = utils.getMaxThreads()
-        
-        print(f"convertVideoToWavWithOffset('{input_filepath}',{offset}) using {nthreads} thread(s).")
+
+        info = probe(input_filepath, context) if FAST_PATHS else {}
+        ext = '.wav'
+        if isWhisperWav(info) and not offset:
+            # Already in the right format: a hard link is as good as a copy
+            output_filepath = utils.linkToTmpFile(input_filepath)
+            metrics.FAST_PATH_JOBS.inc(job = 'convertVideoToWavWithOffset', method = 'link')
+            logger.info(f"convertVideoToWavWithOffset('{input_filepath}',{offset}) Linked {output_filepath}")
+            return output_filepath, ext
+
+        # The same conversion of the same contents may already be stored (see artifactstore.py)
+        store_key = artifactstore.key(input_filepath, 'wav', {'offset': float(offset)})
+        output_filepath = artifactstore.getFile(store_key, ext)
+        if output_filepath:
+            return output_filepath, ext
+
         output_filepath = utils.getTmpFile()
         # For less verbosity try, global_options= '-hide_banner -loglevel error -nostats'
         # See https://github.com/Ch00k/ffmpy/blob/master/ffmpy.py
-
-        ext = '.wav'
+        remux = isWhisperWav(info)
+        lease = cpubudget.acquire(1 if remux else None)
+        logger.info(f"convertVideoToWavWithOffset('{input_filepath}',{offset}) using {lease.threads} thread(s).")
         ff = FFmpeg(
-            global_options=f"-hide_banner -loglevel error -nostats -threads {nthreads}",
+            global_options=f"-hide_banner -loglevel error -nostats -threads {lease.threads}",
             inputs={
                 input_filepath: '-ss {}'.format(offset)},
-            outputs={output_filepath: '-c:a pcm_s16le -ac 1 -y -ar 16000 -f wav'}
+            outputs={output_filepath: '-c:a copy -y -f wav' if remux else '-c:a pcm_s16le -ac 1 -y -ar 16000 -f wav'}
         )
-        print(f"Starting. Audio output will be saved in {output_filepath}")
-        ff.run()
+        logger.info(f"Starting. Audio output will be saved in {output_filepath}{' (remux)' if remux else ''}")
+        duration = None
+        if progress:
+            duration = probeDuration(info) or getDuration(input_filepath)
+            duration = max(0.0, duration - offset) if duration else None
+        runFFmpeg(ff, progress, duration, context, lease)
+        artifactstore.putFile(store_key, ext, output_filepath)
+        if remux:
+            metrics.FAST_PATH_JOBS.inc(job = 'convertVideoToWavWithOffset', method = 'remux')
         end_time = perf_counter()
-        print(f"convertVideoToWavWithOffset('{input_filepath}',{offset}) Complete. Duration {int(end_time - start_time)} seconds")
+        logger.info(f"convertVideoToWavWithOffset('{input_filepath}',{offset}) Complete. Duration {int(end_time - start_time)} seconds")
         return output_filepath, ext
     except Exception as e:
-        print("Exception:" + str(e))
+        logger.error("Exception:" + str(e))
+        utils.removeFile(output_filepath) # Partial output
         raise e
+    finally:
+        if lease:
+            lease.release()
 
 # Creates a low res mp4
-def processVideo(input_filepath):
+# preset = the libx264 preset (PREVIEW_PRESET is several times faster, at a lower quality for the same bit rate)
+def processVideo(input_filepath, progress=None, context=None, preset=VIDEO_PRESET):
+    output_filepath = None
+    lease = None
     try:
         start_time = perf_counter()
 
-        nthreads = utils.getMaxThreads()
-
-        print(f"processVideo('{input_filepath}') using {nthreads} threads")
+        info = probe(input_filepath, context)
+        remux = FAST_PATHS and isPassthroughVideo(info)
+        duration = probeDuration(info)
+        # A remux is about as cheap as reading the stored artifact
+        store_key = None if remux else _videoKey(input_filepath, preset)
+        output_filepath = artifactstore.getFile(store_key, '.mp4')
+        if output_filepath:
+            return output_filepath, '.mp4'
+        if (not remux and (SEGMENT_PARALLEL or cpubudget.BUDGET.total) > 1 and duration and duration >= SEGMENT_MIN_SECONDS
+                and _streams(info, 'video')):
+            output_filepath, ext = processVideoSegmented(input_filepath, info, progress, context, preset)
+            artifactstore.putFile(store_key, ext, output_filepath)
+            return output_filepath, ext
+        lease = cpubudget.acquire(1 if remux else None)
+        logger.info(f"processVideo('{input_filepath}') using {lease.threads} threads{' (remux)' if remux else ''}")
         output_filepath = utils.getTmpFile()
         ext = '.mp4'
         ff = FFmpeg(
-            global_options= f"-hide_banner -loglevel error -nostats -threads {nthreads}",
+            global_options= f"-hide_banner -loglevel error -nostats -threads {lease.threads}",
             inputs={input_filepath: None},
-            outputs={
-                output_filepath: '-c:v libx264 -f mp4 -b:v 500K -s 768x432 -movflags faststart -ar 48000 -preset medium'}
+            # The source is already small H.264/AAC: copy the streams and move the index to the front
+            outputs={output_filepath: '-map 0:v:0 -map 0:a:0? -c copy -f mp4 -movflags faststart' if remux
+                     else f'{videoOutputOptions(preset)} -threads {lease.threads}'}  # -threads: the encoder's threads
         )
-        ff.run()
+        runFFmpeg(ff, progress, (duration or getDuration(input_filepath)) if progress else None, context, lease)
+        artifactstore.putFile(store_key, ext, output_filepath)
+        if remux:
+            metrics.FAST_PATH_JOBS.inc(job = 'processVideo', method = 'remux')
         end_time = perf_counter()
-        print(f"processVideo('{input_filepath}') Complete. Duration {int(end_time - start_time)} seconds")
+        logger.info(f"processVideo('{input_filepath}') Complete. Duration {int(end_time - start_time)} seconds")
         return output_filepath, ext
     except Exception as e:
-        print("Exception:" + str(e))
+        logger.error("Exception:" + str(e))
+        utils.removeFile(output_filepath) # Partial output
         raise e
+    finally:
+        if lease:
+            lease.release()
+
+# Key of processVideo's output in the artifact store
+def _videoKey(input_filepath, preset=VIDEO_PRESET):
+    return artifactstore.key(input_filepath, 'mp4', {'options': videoOutputOptions(preset)})
+
+# Passed to the processes of a job group instead of the grpc context, so that they are all stopped as soon as
+# one of them fails (or the call is cancelled)
+class _JobGroupContext:
+    def __init__(self, context):
+        self.context = context
+        self.failed = False
+
+    def is_active(self):
+        return not self.failed and (self.context is None or self.context.is_active())
+
+    def time_remaining(self):
+        return None if self.context is None else self.context.time_remaining()
+
+# Runs the ffmpeg commands (argument lists) with up to parallel processes at a time
+# Commands whose index is in tracked report their progress to parts (a PartsTracker, optional)
+# lease (optional) is the cpubudget.Lease shared by the commands
+def _runParallel(commands, parallel, context=None, parts=None, tracked=(), lease=None):
+    group = _JobGroupContext(context)
+
+    def run(index, cmd):
+        try:
+            if parts is not None and index in tracked:
+                runner.run(cmd[:1] + ['-progress', 'pipe:1'] + cmd[1:], on_stdout=ffmpegLineHandler(parts.part(index)),
+                           context=group, lease=lease)
+            else:
+                runner.run(cmd, context=group, lease=lease)
+        except Exception:
+            group.failed = True
+            raise
+
+    with futures.ThreadPoolExecutor(parallel, thread_name_prefix='ffmpeg') as pool:
+        jobs = [pool.submit(run, index, cmd) for index, cmd in enumerate(commands)]
+        errors = [job.exception() for job in jobs if job.exception()]
+    if errors:
+        # The first failure rather than the processes that it stopped
+        raise next((e for e in errors if not isinstance(e, runner.Cancelled)), errors[0])
+
+# processVideo for long inputs: wall clock time scales with the number of cores rather than with libx264's threads
+#  1. The video stream is cut, without re-encoding, into segments that each start at a keyframe
+#  2. The segments are encoded by parallel ffmpeg processes, with the same options (so they have
+#     identical parameters); another process encodes the whole audio stream, which is cheap, in one piece so that
+#     the AAC encoder does not add padding at each join
+#  3. The concat demuxer joins the encoded segments, and they are muxed with the audio into one faststart mp4
+# info is the probe() result of the input
+def processVideoSegmented(input_filepath, info, progress=None, context=None, preset=VIDEO_PRESET):
+    start_time = perf_counter()
+    duration = probeDuration(info)
+    workdir = utils.getTmpFile()
+    output_filepath = utils.getTmpFile()
+    ffmpeg = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostats', '-y']
+    threads = ['-threads', str(SEGMENT_THREADS)]
+    lease = cpubudget.acquire()
+    parallel = SEGMENT_PARALLEL or max(1, lease.threads // SEGMENT_THREADS)
+    segment_seconds = max(10.0, min(SEGMENT_MAX_SECONDS, duration / (2 * parallel)))
+    try:
+        os.makedirs(workdir)
+        runner.run(ffmpeg + ['-i', input_filepath, '-an', '-sn', '-dn', '-c', 'copy', '-f', 'segment',
+                             '-segment_time', f'{segment_seconds:.3f}', '-segment_format', 'matroska',
+                             '-reset_timestamps', '1', os.path.join(workdir, 'source_%05d.mkv')], context=context, lease=lease)
+        sources = sorted(f for f in os.listdir(workdir) if f.startswith('source_'))
+        logger.info(f"processVideo('{input_filepath}') encoding {len(sources)} segments of {segment_seconds:.0f} seconds "
+                    f"using {parallel} processes")
+
+        commands = []
+        for source in sources:
+            encoded = os.path.join(workdir, source.replace('source_', 'encoded_').replace('.mkv', '.mp4'))
+            # -threads before -i is for the decoder, after it for the encoder
+            commands.append(ffmpeg + threads + ['-i', os.path.join(workdir, source)] + threads
+                            + videoEncodeOptions(preset).split(' ') + ['-an', '-f', 'mp4', encoded])
+        audio = None
+        if _streams(info, 'audio'):
+            audio = os.path.join(workdir, 'audio.m4a')
+            # First, as it is the longest job
+            commands.insert(0, ffmpeg + ['-i', input_filepath, '-vn', '-sn', '-dn'] + AUDIO_ENCODE_OPTIONS.split(' ')
+                            + ['-f', 'mp4', audio])
+        parts = PartsTracker(ProgressTracker(duration, progress)) if progress else None
+        _runParallel(commands, parallel, context, parts, tracked=range(1 if audio else 0, len(commands)), lease=lease)
+
+        segment_list = os.path.join(workdir, 'segments.txt')
+        with open(segment_list, 'w') as f:
+            for cmd in commands[1 if audio else 0:]:
+                f.write(f"file '{cmd[-1]}'\n")
+        inputs = ['-f', 'concat', '-safe', '0', '-i', segment_list] + (['-i', audio] if audio else [])
+        maps = ['-map', '0:v'] + (['-map', '1:a'] if audio else [])
+        runner.run(ffmpeg + inputs + maps + ['-c', 'copy', '-f', 'mp4', '-movflags', 'faststart', output_filepath],
+                   context=context, lease=lease)
+        if parts:
+            parts.finish()
+        metrics.FAST_PATH_JOBS.inc(job = 'processVideo', method = 'segmented')
+        logger.info(f"processVideo('{input_filepath}') Complete. Duration {int(perf_counter() - start_time)} seconds")
+        return output_filepath, '.mp4'
+    except Exception:
+        utils.removeFile(output_filepath) # Partial output
+        raise
+    finally:
+        lease.release()
+        shutil.rmtree(workdir, ignore_errors=True)
 
-def getMediaInfo(input_filepath):
+# processVideo in two stages, so that a video can be played long before its medium preset encode is ready:
+#  1. A PREVIEW_PRESET encode, which is returned right away
+#  2. The processVideo encode, as a low priority background job (see background.py), written to a file of its own
+#     (the caller owns the preview and may move it, as the TaskEngine does with every file it receives)
+# Returns (filepath, ext, job); job is the background.Job of stage 2 (its result is the path of the final video,
+# which GetVideoJobRPC hands over once), or None if the first output is already final (an input that is remuxed)
+def processVideoPreview(input_filepath, progress=None, context=None):
+    info = probe(input_filepath, context)
+    if FAST_PATHS and isPassthroughVideo(info):
+        output_filepath, ext = processVideo(input_filepath, progress, context)
+        return output_filepath, ext, None
+    output_filepath = artifactstore.getFile(_videoKey(input_filepath), '.mp4')
+    if output_filepath:
+        return output_filepath, '.mp4', None
+    preview_filepath, ext = processVideo(input_filepath, progress, context, preset=PREVIEW_PRESET)
+    # The caller may move or delete the input once it has the preview
+    source_filepath = utils.linkToTmpFile(input_filepath)
+
+    def final():
+        try:
+            output_filepath, _ = processVideo(source_filepath)
+            return output_filepath
+        finally:
+            utils.removeFile(source_filepath)
+
+    # The final video is handed to the first GetVideoJobRPC that finds it done, or removed if none does
+    return preview_filepath, ext, background.submit(f"processVideoPreview({input_filepath})", final,
+                                                    discard=utils.removeFile)
+
+# ffprobe arguments of each getMediaInfo mode
+MEDIA_INFO_ARGS = {
+    # Everything ffprobe reports (GetMediaInfoRPC)
+    'full': "-hide_banner -loglevel fatal -show_error -show_format -show_streams -show_programs -show_chapters -show_private_data -print_format json",
+    # Only the format duration and the stream codecs (enough for the fast paths above)
+    'fields': "-hide_banner -loglevel fatal -show_error -show_entries "
+              "format=format_name,duration,bit_rate:stream=index,codec_type,codec_name,width,height,pix_fmt,bit_rate,"
+              "sample_rate,channels:stream_disposition=attached_pic -print_format json",
+}
+
+# Probe results, kept until the file changes (see filecache.py)
+PROBE_CACHE = filecache.FileCache('ffprobe', int(os.getenv('PROBE_CACHE_MAX_ENTRIES', 50000)))
+
+# mode is a key of MEDIA_INFO_ARGS
+def getMediaInfo(input_filepath, context=None, mode='full'):
     #Exception printing and timing is now handled by caller -see LogWorker
     # In seconds
     #https://gist.github.com/nrk/2286511
-    staticargs = "-hide_banner -loglevel fatal -show_error -show_format -show_streams -show_programs -show_chapters -show_private_data -print_format json"
-    jsonresult = subprocess.check_output(
-        ['ffprobe','-i', input_filepath] + staticargs.split(' '),
-        encoding='utf-8'
-    )
-    print(f'{input_filepath}: {jsonresult}')
+    if mode not in MEDIA_INFO_ARGS:
+        raise ValueError(f"Unknown media info mode '{mode}'")
+    # Reading the headers is cheaper than storing the result in the cache
+    info = mediaheader.parse(input_filepath) if NATIVE_PROBE and mode == 'fields' else None
+    if info:
+        return json.dumps(info)
+    cached = PROBE_CACHE.get(input_filepath, mode)
+    if cached is not None:
+        return cached
+    try:
+        sig = filecache.signature(input_filepath)
+    except OSError:
+        sig = None
+    # Another copy of the same contents may have been probed; only worth checking if they are already hashed
+    store_key = artifactstore.key(input_filepath, 'probe', {'mode': mode}, compute=False)
+    stored = artifactstore.getText(store_key)
+    if stored is not None:
+        if sig is not None:
+            PROBE_CACHE.put(input_filepath, stored, mode, sig)
+        return stored
+    jsonresult = runner.output(['ffprobe','-i', input_filepath] + MEDIA_INFO_ARGS[mode].split(' '), context)
+    logger.debug('%s: %s', input_filepath, jsonresult)
     # Check if is a valid json object
     try:
         json.loads(jsonresult)
     except json.JSONDecodeError:
-        jsonresult = '{}'
-
+        return '{}'
+    if sig is not None:
+        PROBE_CACHE.put(input_filepath, jsonresult, mode, sig)
+    artifactstore.putText(store_key, jsonresult)
     return jsonresult
 
-# example  r = ffmpeg.getMediaInfo('/data/5ff44cac-fbfe-4745-bcae-9dbb181cf0f2.mp4') 
\ No newline at end of file
+# example  r = ffmpeg.getMediaInfo('/data/5ff44cac-fbfe-4745-bcae-9dbb181cf0f2.mp4') 
+
+# Makes several outputs with a single ffmpeg run, so that the input is demuxed and decoded once rather than
+# once per output (ProcessVideoRPC, ConvertVideoToWavRPCWithOffset, and the wav inside transcribe.py):
+#   video:      the low res mp4 of processVideo
+#   wav:        the 16 kHz mono wav of convertVideoToWavWithOffset, starting at wav_offset seconds
+#   thumbnails: this number of jpg images, evenly spaced through the media, thumbnail_width pixels wide
+# The media info (as getMediaInfo) is read first; ffprobe only reads the container headers.
+# Returns {'video': (path, ext) or None, 'wav': (path, ext) or None, 'thumbnails': [(path, ext)...], 'mediaInfo': json}
+def processMedia(input_filepath, video=True, wav=True, wav_offset=0.0, thumbnails=0, thumbnail_width=320,
+                 progress=None, context=None):
+    start_time = perf_counter()
+    mediaInfo = getMediaInfo(input_filepath, context)
+    info = json.loads(mediaInfo)
+    streams = [s.get('codec_type') for s in info.get('streams', [])]
+    try:
+        duration = float(info.get('format', {}).get('duration'))
+    except (TypeError, ValueError):
+        duration = None
+
+    result = {'video': None, 'wav': None, 'thumbnails': [], 'mediaInfo': mediaInfo}
+    outputs = {}
+    # Outputs that are already in the artifact store are not made again; keys of the outputs to store
+    store_keys = {}
+    if video:
+        store_key = _videoKey(input_filepath)
+        stored = artifactstore.getFile(store_key, '.mp4')
+        result['video'] = (stored or utils.getTmpFile(), '.mp4')
+        if not stored:
+            outputs[result['video'][0]] = '-map 0:v:0? -map 0:a:0? ' + VIDEO_OUTPUT_OPTIONS
+            store_keys[result['video']] = store_key
+    if wav and 'audio' in streams:
+        store_key = artifactstore.key(input_filepath, 'wav', {'offset': float(wav_offset or 0.0)})
+        stored = artifactstore.getFile(store_key, '.wav')
+        result['wav'] = (stored or utils.getTmpFile(), '.wav')
+        if not stored:
+            outputs[result['wav'][0]] = f'-map 0:a:0 -ss {wav_offset or 0.0} ' + WAV_OUTPUT_OPTIONS
+            store_keys[result['wav']] = store_key
+    thumbnail_pattern = None
+    if thumbnails > 0 and 'video' in streams and duration:
+        thumbnail_pattern = utils.getTmpFile() + '_%03d.jpg'
+        rate = thumbnails / duration
+        outputs[thumbnail_pattern] = f'-map 0:v:0 -vf fps={rate:.6f},scale={thumbnail_width}:-2 -frames:v {thumbnails} -q:v 4'
+    if not outputs:
+        if result['video'] or result['wav']:
+            return result
+        raise Exception(f"processMedia('{input_filepath}'): nothing to do (streams: {streams})")
+
+    lease = cpubudget.acquire()
+    logger.info(f"processMedia('{input_filepath}') {len(outputs)} output(s) using {lease.threads} threads")
+    if result['video'] and result['video'] in store_keys:
+        outputs[result['video'][0]] += f' -threads {lease.threads}'  # The encoder's threads
+    ff = FFmpeg(
+        global_options=f"-hide_banner -loglevel error -nostats -threads {lease.threads} -y",
+        inputs={input_filepath: None},
+        outputs=outputs)
+    try:
+        runFFmpeg(ff, progress, duration, context, lease)
+        for output, store_key in store_keys.items():
+            artifactstore.putFile(store_key, output[1], output[0])
+        if thumbnail_pattern:
+            for i in range(1, thumbnails + 1):
+                path = thumbnail_pattern % i
+                if os.path.exists(path):
+                    result['thumbnails'].append((path, '.jpg'))
+    except Exception as e:
+        logger.error(f"processMedia('{input_filepath}') Exception:{e}")
+        for output in (result['video'], result['wav']):
+            if output:
+                utils.removeFile(output[0]) # Partial output
+        if thumbnail_pattern:
+            for i in range(1, thumbnails + 1):
+                utils.removeFile(thumbnail_pattern % i)
+        raise
+    finally:
+        lease.release()
+    end_time = perf_counter()
+    logger.info(f"processMedia('{input_filepath}') Complete. Duration {int(end_time - start_time)} seconds")
+    return result
@@ -0,0 +1,45 @@
+import time
+
+import pytest
+from ffmpy import FFmpeg
+
+import ffmpeg
+import runner
+
+
+def mp4(width=640, height=360, bit_rate='400000', audio='aac'):
+    streams = [{'codec_type': 'video', 'codec_name': 'h264', 'pix_fmt': 'yuv420p', 'width': width, 'height': height,
+                'bit_rate': bit_rate}]
+    if audio:
+        streams.append({'codec_type': 'audio', 'codec_name': audio})
+    return {'format': {'format_name': 'mov,mp4,m4a,3gp,3g2,mj2', 'duration': '10.0'}, 'streams': streams}
+
+
+def test_passthrough_video():
+    assert ffmpeg.isPassthroughVideo(mp4())
+    assert ffmpeg.isPassthroughVideo(mp4(audio=None))
+    assert not ffmpeg.isPassthroughVideo(mp4(width=1280, height=720))
+    assert not ffmpeg.isPassthroughVideo(mp4(bit_rate='5000000'))
+    assert not ffmpeg.isPassthroughVideo(mp4(audio='opus'))
+    assert not ffmpeg.isPassthroughVideo({})
+
+
+def test_whisper_wav():
+    wav = {'format': {'format_name': 'wav'},
+           'streams': [{'codec_type': 'audio', 'codec_name': 'pcm_s16le', 'channels': 1, 'sample_rate': '16000'}]}
+    assert ffmpeg.isWhisperWav(wav)
+    wav['streams'][0]['sample_rate'] = '44100'
+    assert not ffmpeg.isWhisperWav(wav)
+
+
+def test_parallel_jobs_stop_on_failure():
+    start = time.time()
+    with pytest.raises(runner.ProcessError):
+        ffmpeg._runParallel([['sleep', '30'], ['false']], 2)
+    assert time.time() - start < 10
+
+
+def test_ffmpeg_args_keep_quotes_and_backslashes():
+    path = "/data/it's a \\ lecture.mp4"
+    ff = FFmpeg(global_options='-y', inputs={path: None}, outputs={'/tmp/out.wav': ['-ac', '1']})
+    assert runner.ffmpegArgs(ff) == ['ffmpeg', '-y', '-i', path, '-ac', '1', '/tmp/out.wav']
@@ -0,0 +1,165 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import log
+import metrics
+
+logger = log.getLogger(__name__)
+
+# Persistent cache of values computed from a file's contents (e.g. ffprobe output), keyed by the file's path
+# and validated against its size, mtime and inode, so that a replaced or modified file is never served a stale
+# value. Entries live in a small in-memory LRU (for microsecond hits) in front of an sqlite database in
+# DATA_DIRECTORY, which survives restarts and is also trimmed to the least recently used entries.
+# A cache created with identity=True is keyed by the file's device and inode instead of its path, so that its
+# values follow a file that is renamed, moved within the file system or hard linked (e.g. file digests).
+
+# '' = DATA_DIRECTORY/pythonrpc_cache.sqlite3; 'none' = in-memory only
+FILECACHE_PATH = os.getenv('FILECACHE_PATH', '')
+FILECACHE_MEMORY_ENTRIES = int(os.getenv('FILECACHE_MEMORY_ENTRIES', 2000))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    cache TEXT NOT NULL,
+    path TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    value TEXT NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (cache, path, variant)
+);
+CREATE INDEX IF NOT EXISTS entries_lru ON entries (cache, last_used);
+"""
+
+_db = None
+_dbLock = threading.Lock()
+
+
+def _databasePath():
+    if FILECACHE_PATH:
+        return None if FILECACHE_PATH == 'none' else FILECACHE_PATH
+    data = os.getenv('DATA_DIRECTORY')
+    return os.path.join(data, 'pythonrpc_cache.sqlite3') if data else None
+
+
+# The shared sqlite connection, or None if there is no persistent store. Callers hold _dbLock
+def _database():
+    global _db
+    if _db is None:
+        path = _databasePath()
+        if path is None:
+            return None
+        try:
+            _db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            _db.execute('PRAGMA journal_mode=WAL')
+            _db.execute('PRAGMA synchronous=NORMAL')
+            _db.executescript(SCHEMA)
+        except sqlite3.Error as e:
+            logger.warning(f"filecache: cannot open {path}, caching in memory only: {e}")
+            _db = False
+    return _db or None
+
+
+# Identifies the contents of a file without reading it
+def signature(filepath):
+    st = os.stat(filepath)
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+class FileCache:
+    # name identifies the cache in the shared database and in the metrics; max_entries bounds its stored entries
+    def __init__(self, name, max_entries, identity=False):
+        self.name = name
+        self.max_entries = max_entries
+        self.identity = identity
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()  # (path, variant) -> (signature, value)
+        self.puts = 0
+
+    # Returns (key path, signature) of filepath as it is now; raises OSError
+    def _key(self, filepath):
+        if not self.identity:
+            path = os.path.realpath(filepath)
+            return path, signature(path)
+        st = os.stat(filepath)
+        return f'{st.st_dev}:{st.st_ino}', (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    # Returns the cached value for filepath (as it is now), or None
+    def get(self, filepath, variant=''):
+        try:
+            path, sig = self._key(filepath)
+        except OSError:
+            return None
+        key = (path, variant)
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None and entry[0] == sig:
+                self.memory.move_to_end(key)
+                metrics.FILECACHE_LOOKUPS.inc(cache = self.name, result = 'memory')
+                return entry[1]
+        value = None
+        with _dbLock:
+            db = _database()
+            if db is not None:
+                try:
+                    row = db.execute('SELECT size, mtime_ns, inode, value FROM entries WHERE cache=? AND path=? AND variant=?',
+                                     (self.name, path, variant)).fetchone()
+                    if row is not None and tuple(row[:3]) == sig:
+                        value = row[3]
+                        db.execute('UPDATE entries SET last_used=? WHERE cache=? AND path=? AND variant=?',
+                                   (time.time(), self.name, path, variant))
+                except sqlite3.Error as e:
+                    logger.warning(f"filecache({self.name}): {e}")
+        metrics.FILECACHE_LOOKUPS.inc(cache = self.name, result = 'disk' if value is not None else 'miss')
+        if value is not None:
+            self._remember(key, sig, value)
+        return value
+
+    # Stores value (a string) for filepath, unless the file changed while the value was being computed
+    # (pass the signature() taken before computing it)
+    def put(self, filepath, value, variant='', sig=None):
+        try:
+            path, current = self._key(filepath)
+        except OSError:
+            return
+        if sig is not None and sig != current:
+            return
+        self._remember((path, variant), current, value)
+        with _dbLock:
+            db = _database()
+            if db is None:
+                return
+            try:
+                db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                           (self.name, path, variant) + current + (value, time.time()))
+                self.puts += 1
+                if self.puts % 100 == 1:
+                    self._evict(db)
+            except sqlite3.Error as e:
+                logger.warning(f"filecache({self.name}): {e}")
+
+    def _remember(self, key, sig, value):
+        with self.lock:
+            self.memory[key] = (sig, value)
+            self.memory.move_to_end(key)
+            while len(self.memory) > FILECACHE_MEMORY_ENTRIES:
+                self.memory.popitem(last=False)
+
+    # Deletes the least recently used entries beyond max_entries
+    def _evict(self, db):
+        db.execute('DELETE FROM entries WHERE cache=? AND rowid IN '
+                   '(SELECT rowid FROM entries WHERE cache=? ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                   (self.name, self.name, self.max_entries))
+
+    # Forgets every entry of this cache
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+        with _dbLock:
+            db = _database()
+            if db is not None:
+                db.execute('DELETE FROM entries WHERE cache=?', (self.name,))
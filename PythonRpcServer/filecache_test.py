@@ -0,0 +1,38 @@
+import time
+
+import filecache
+
+
+def test_values_are_dropped_when_the_file_changes(tmp_path, monkeypatch):
+    monkeypatch.setattr(filecache, 'FILECACHE_PATH', str(tmp_path / 'cache.sqlite3'))
+    monkeypatch.setattr(filecache, '_db', None)
+    cache = filecache.FileCache('test', 10)
+    media = tmp_path / 'a.mp4'
+    media.write_bytes(b'one')
+
+    assert cache.get(str(media)) is None
+    cache.put(str(media), 'probe-one')
+    assert cache.get(str(media)) == 'probe-one'
+
+    # A new cache object has an empty memory, so this hit comes from the database
+    assert filecache.FileCache('test', 10).get(str(media)) == 'probe-one'
+    assert filecache.FileCache('other', 10).get(str(media)) is None
+
+    media.write_bytes(b'two!')
+    assert cache.get(str(media)) is None
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, monkeypatch):
+    monkeypatch.setattr(filecache, 'FILECACHE_PATH', str(tmp_path / 'cache.sqlite3'))
+    monkeypatch.setattr(filecache, '_db', None)
+    cache = filecache.FileCache('test', 2)
+    paths = []
+    for i in range(3):
+        path = tmp_path / f'{i}.mp4'
+        path.write_bytes(bytes([i]))
+        paths.append(str(path))
+        cache.put(str(path), f'value{i}')
+        time.sleep(0.01)
+    cache._evict(filecache._database())
+    cache.memory.clear()
+    assert [cache.get(p) for p in paths] == [None, 'value1', 'value2']
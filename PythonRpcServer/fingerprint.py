@@ -0,0 +1,295 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import wave
+
+import numpy as np
+
+import artifactstore
+import ffmpeg
+import log
+import utils
+
+logger = log.getLogger(__name__)
+
+# Audio fingerprints, to find recordings of the same lecture that do not have the same bytes (another Kaltura entry
+# or Echo media id, a re-upload, another container or bit rate), so that an existing transcript can be reused
+# instead of running whisper again
+#  1. The 16 kHz mono wav (as ConvertVideoToWavRPCWithOffset) is cut into frames; in each of the speech bands of
+#     BAND_EDGES_HZ, the loudest frequency of a frame is a peak if no frame within PEAK_NEIGHBORHOOD is louder
+#  2. Each peak is paired with the next FAN_OUT peaks up to PAIR_MAX_FRAMES later; a pair's hash is its two
+#     frequencies and their distance in time, which survive re-encoding, and its offset is the first peak's frame
+#  3. Two recordings match when many of their hashes occur at the same offset difference (which is also how much
+#     later one of them starts)
+# The index is an sqlite database of (hash, recording, offset), looked up by hash
+
+SAMPLE_RATE = 16000
+FRAME_SAMPLES = 1024
+HOP_SAMPLES = 512  # 32 ms
+BAND_EDGES_HZ = [250, 500, 750, 1000, 1500, 2000, 3000, 4000]
+PEAK_NEIGHBORHOOD = 15  # frames before and after
+FAN_OUT = 4
+PAIR_MAX_FRAMES = 63  # 2 seconds; the hash has 6 bits for it
+# Changing any of the above changes the hashes: bump the version so that stored fingerprints are not reused
+VERSION = 1
+
+# '' = DATA_DIRECTORY/pythonrpc_fingerprints.sqlite3
+FINGERPRINT_INDEX_PATH = os.getenv('FINGERPRINT_INDEX_PATH', '')
+# A recording matches if at least this many hashes, and this fraction of the hashes of the shorter one, align
+FINGERPRINT_MIN_MATCHES = int(os.getenv('FINGERPRINT_MIN_MATCHES', 10))
+FINGERPRINT_MIN_SCORE = float(os.getenv('FINGERPRINT_MIN_SCORE', 0.05))
+
+# Samples read from the wav at a time (about 1 minute), so that long lectures need little memory
+READ_FRAMES = HOP_SAMPLES * 2048
+
+
+def frameSeconds(frames):
+    return frames * HOP_SAMPLES / SAMPLE_RATE
+
+
+# Returns (values, bins): the loudest magnitude (log) and its frequency bin in each band, per frame
+def _bandMaxima(samples_iter):
+    window = np.hanning(FRAME_SAMPLES).astype(np.float32)
+    edges = [int(hz * FRAME_SAMPLES / SAMPLE_RATE) for hz in BAND_EDGES_HZ]
+    values, bins = [], []
+    carry = np.zeros(0, np.float32)
+    for block in samples_iter:
+        samples = np.concatenate([carry, block])
+        count = (len(samples) - FRAME_SAMPLES) // HOP_SAMPLES + 1
+        if count <= 0:
+            carry = samples
+            continue
+        frames = np.lib.stride_tricks.as_strided(samples, (count, FRAME_SAMPLES),
+                                                 (samples.strides[0] * HOP_SAMPLES, samples.strides[0]))
+        spectrum = np.log1p(np.abs(np.fft.rfft(frames * window, axis=1)))
+        blockValues = np.empty((count, len(edges) - 1), np.float32)
+        blockBins = np.empty((count, len(edges) - 1), np.int32)
+        for band, (lo, hi) in enumerate(zip(edges[:-1], edges[1:])):
+            loudest = spectrum[:, lo:hi].argmax(axis=1)
+            blockBins[:, band] = loudest + lo
+            blockValues[:, band] = spectrum[np.arange(count), loudest + lo]
+        values.append(blockValues)
+        bins.append(blockBins)
+        carry = samples[count * HOP_SAMPLES:].copy()
+    if not values:
+        return np.zeros((0, len(edges) - 1), np.float32), np.zeros((0, len(edges) - 1), np.int32)
+    return np.concatenate(values), np.concatenate(bins)
+
+
+# Returns the peaks as (frames, bins), in time order
+def _peaks(values, bins):
+    if len(values) == 0:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+    padded = np.pad(values, ((PEAK_NEIGHBORHOOD, PEAK_NEIGHBORHOOD), (0, 0)), constant_values=-np.inf)
+    neighborhood = np.lib.stride_tricks.sliding_window_view(padded, 2 * PEAK_NEIGHBORHOOD + 1, axis=0).max(axis=2)
+    # Quiet frames (silence, hiss) have no useful peaks
+    isPeak = (values >= neighborhood) & (values > values.mean())
+    frames, bands = np.nonzero(isPeak)
+    return frames.astype(np.int64), bins[frames, bands].astype(np.int64)
+
+
+# Returns (hashes, offsets) of the peak pairs (uint32 arrays)
+def _hashes(frames, bins):
+    hashes, offsets = [], []
+    for k in range(1, FAN_OUT + 1):
+        dt = frames[k:] - frames[:-k]
+        pairs = (dt > 0) & (dt <= PAIR_MAX_FRAMES)
+        hashes.append((bins[:-k][pairs] << 15) | (bins[k:][pairs] << 6) | dt[pairs])
+        offsets.append(frames[:-k][pairs])
+    if not hashes:
+        return np.zeros(0, np.uint32), np.zeros(0, np.uint32)
+    return np.concatenate(hashes).astype(np.uint32), np.concatenate(offsets).astype(np.uint32)
+
+
+def _wavSamples(wav_filepath):
+    with wave.open(wav_filepath, 'rb') as w:
+        if (w.getnchannels(), w.getsampwidth(), w.getframerate()) != (1, 2, SAMPLE_RATE):
+            raise ValueError(f"{wav_filepath} is not a 16 kHz mono 16 bit wav")
+        while True:
+            data = w.readframes(READ_FRAMES)
+            if not data:
+                break
+            yield np.frombuffer(data, '<i2').astype(np.float32)
+
+
+class Fingerprint:
+    def __init__(self, hashes, offsets, duration):
+        self.hashes = hashes
+        self.offsets = offsets
+        self.duration = duration
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+# Fingerprint of a 16 kHz mono 16 bit wav
+def fingerprintWav(wav_filepath):
+    with wave.open(wav_filepath, 'rb') as w:
+        duration = w.getnframes() / float(w.getframerate() or 1)
+    frames, bins = _peaks(*_bandMaxima(_wavSamples(wav_filepath)))
+    hashes, offsets = _hashes(frames, bins)
+    return Fingerprint(hashes, offsets, duration)
+
+
+# Fingerprint of any media file with audio; kept in the artifact store, as the wav it is computed from
+def fingerprintFile(input_filepath, context=None):
+    store_key = artifactstore.key(input_filepath, 'fingerprint', {'version': VERSION})
+    stored = artifactstore.getFile(store_key, '.npz')
+    if stored:
+        try:
+            with np.load(stored) as data:
+                return Fingerprint(data['hashes'], data['offsets'], float(data['duration']))
+        finally:
+            utils.removeFile(stored)
+
+    wav_filepath, _ = ffmpeg.convertVideoToWavWithOffset(input_filepath, 0.0, context=context)
+    try:
+        fingerprint = fingerprintWav(wav_filepath)
+    finally:
+        utils.removeFile(wav_filepath)
+    if store_key:
+        output_filepath = utils.getTmpFile()
+        try:
+            with open(output_filepath, 'wb') as f:
+                np.savez(f, hashes=fingerprint.hashes, offsets=fingerprint.offsets, duration=fingerprint.duration)
+            artifactstore.putFile(store_key, '.npz', output_filepath)
+        finally:
+            utils.removeFile(output_filepath)
+    return fingerprint
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS recordings (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    hashes INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    added REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS hashes (
+    hash INTEGER NOT NULL,
+    recording INTEGER NOT NULL,
+    offset INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS hashes_hash ON hashes (hash);
+CREATE INDEX IF NOT EXISTS hashes_recording ON hashes (recording);
+"""
+
+# Hashes per sqlite query (below its limit on the number of parameters)
+QUERY_BATCH = 500
+
+
+class Index:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+
+    # Adds (or replaces) the fingerprint of the recording identified by key (e.g. the id of its transcription)
+    def add(self, key, fingerprint):
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                self._remove(key)
+                cursor = self.db.execute('INSERT INTO recordings (key, hashes, duration, added) VALUES (?, ?, ?, ?)',
+                                         (key, len(fingerprint), fingerprint.duration, time.time()))
+                recording = cursor.lastrowid
+                self.db.executemany('INSERT INTO hashes VALUES (?, ?, ?)',
+                                    zip(fingerprint.hashes.tolist(), [recording] * len(fingerprint),
+                                        fingerprint.offsets.tolist()))
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def remove(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        row = self.db.execute('SELECT id FROM recordings WHERE key=?', (key,)).fetchone()
+        if row:
+            self.db.execute('DELETE FROM hashes WHERE recording=?', (row[0],))
+            self.db.execute('DELETE FROM recordings WHERE id=?', (row[0],))
+
+    # Returns the indexed recordings that match fingerprint, best first:
+    # [{'key', 'score': fraction of the hashes that align, 'matches': aligned hashes, 'offset': seconds}]
+    # offset is where fingerprint's recording starts in the matched one
+    def lookup(self, fingerprint, limit=5, exclude=None):
+        if not len(fingerprint):
+            return []
+        order = np.argsort(fingerprint.hashes, kind='stable')
+        queryHashes, queryOffsets = fingerprint.hashes[order], fingerprint.offsets[order].astype(np.int64)
+        unique = np.unique(queryHashes)
+        found = []
+        with self.lock:
+            for start in range(0, len(unique), QUERY_BATCH):
+                batch = unique[start:start + QUERY_BATCH].tolist()
+                found += self.db.execute(f"SELECT hash, recording, offset FROM hashes WHERE hash IN "
+                                         f"({','.join('?' * len(batch))})", batch).fetchall()
+            recordings = {row[0]: row[1:] for row in self.db.execute('SELECT id, key, hashes FROM recordings')}
+        if not found:
+            return []
+        rows = np.array(found, np.int64)
+        # Every pair of equal hashes votes for (recording, offset difference)
+        first = np.searchsorted(queryHashes, rows[:, 0], 'left')
+        last = np.searchsorted(queryHashes, rows[:, 0], 'right')
+        repeat = last - first
+        rowIndex = np.repeat(np.arange(len(rows)), repeat)
+        queryIndex = np.concatenate([np.arange(a, b) for a, b in zip(first, last)])
+        votes = np.stack([rows[rowIndex, 1], rows[rowIndex, 2] - queryOffsets[queryIndex]], axis=1)
+        pairs, counts = np.unique(votes, axis=0, return_counts=True)
+
+        # A copy that starts part of a frame later has some peaks one frame later: adjacent differences count together
+        votes = {(recording, delta): count for (recording, delta), count in zip(pairs.tolist(), counts.tolist())}
+        best = {}
+        for (recording, delta), count in votes.items():
+            count += votes.get((recording, delta + 1), 0)
+            if count > best.get(recording, (0, 0))[0]:
+                best[recording] = (count, delta)
+        results = []
+        for recording, (count, delta) in best.items():
+            key, hashes = recordings.get(recording, (None, 0))
+            if key is None or key == exclude:
+                continue
+            score = count / max(1, min(hashes, len(fingerprint)))
+            if count >= FINGERPRINT_MIN_MATCHES and score >= FINGERPRINT_MIN_SCORE:
+                results.append({'key': key, 'score': round(score, 4), 'matches': count, 'offset': frameSeconds(delta)})
+        results.sort(key=lambda r: (r['score'], r['matches']), reverse=True)
+        return results[:limit]
+
+
+_index = None
+_indexLock = threading.Lock()
+
+
+def indexPath():
+    if FINGERPRINT_INDEX_PATH:
+        return FINGERPRINT_INDEX_PATH
+    data = os.getenv('DATA_DIRECTORY')
+    return os.path.join(data if data else tempfile.gettempdir(), 'pythonrpc_fingerprints.sqlite3')
+
+
+def index():
+    global _index
+    with _indexLock:
+        if _index is None:
+            _index = Index(indexPath())
+        return _index
+
+
+# Fingerprints input_filepath and returns (fingerprint, matches) (see Index.lookup); if key is given, the fingerprint
+# is then added to the index under key (matches do not include key itself)
+def fingerprintAndMatch(input_filepath, key=None, limit=5, context=None):
+    fingerprint = fingerprintFile(input_filepath, context)
+    matches = index().lookup(fingerprint, limit, exclude=key)
+    if key:
+        index().add(key, fingerprint)
+    logger.info(f"fingerprint('{input_filepath}'): {len(fingerprint)} hashes, {len(matches)} matches"
+                + (f", best {matches[0]['key']} ({matches[0]['score']})" if matches else ''))
+    return fingerprint, matches
@@ -0,0 +1,43 @@
+import wave
+
+import numpy as np
+
+import fingerprint
+
+
+# seconds of random tones (a new set of frequencies and loudness every quarter second, rising and falling like
+# syllables), as a stand in for a lecture
+def tones(seconds, seed):
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(0.25 * fingerprint.SAMPLE_RATE)) / fingerprint.SAMPLE_RATE
+    envelope = np.hanning(len(t))
+    parts = [rng.uniform(0.2, 1) * envelope * sum(np.sin(2 * np.pi * f * t) for f in rng.uniform(300, 3800, 3))
+             for _ in range(int(seconds * 4))]
+    return np.concatenate(parts) * 8000
+
+
+def write_wav(path, samples):
+    with wave.open(str(path), 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(fingerprint.SAMPLE_RATE)
+        w.writeframes(np.clip(samples, -32768, 32767).astype('<i2').tobytes())
+    return str(path)
+
+
+def test_near_duplicates_are_found(tmp_path):
+    lecture = tones(60, seed=1)
+    index = fingerprint.Index(str(tmp_path / 'index.sqlite3'))
+    index.add('original', fingerprint.fingerprintWav(write_wav(tmp_path / 'a.wav', lecture)))
+    index.add('other', fingerprint.fingerprintWav(write_wav(tmp_path / 'b.wav', tones(60, seed=2))))
+
+    # The same lecture, starting 2 seconds later, quieter and with some noise
+    noise = np.random.default_rng(3).normal(0, 300, len(lecture) - 32000)
+    copy = fingerprint.fingerprintWav(write_wav(tmp_path / 'c.wav', lecture[32000:] * 0.7 + noise))
+    matches = index.lookup(copy)
+    assert [m['key'] for m in matches] == ['original']
+    assert abs(matches[0]['offset'] - 2.0) < 0.1
+    assert index.lookup(copy, exclude='original') == []
+
+    index.remove('original')
+    assert index.lookup(copy) == []
@@ -1,24 +1,182 @@
 import hashlib
+import json
+import mmap
+import os
+from concurrent import futures
+
+import cpubudget
+import filecache
+import log
+import metrics
+
+logger = log.getLogger(__name__)
 
 #eventually this may replace the C# method
 # However today the C# file hash is calculated inside the Database project, which does not depende on the RPC projec
 
-# This implementation can be extended to create multiple digests using a single read through the file
+# Several digests are computed from a single read through the file
 # A major advantage of calculating this in python is that we can perform this under ionice and nice(cpu) constraints
-def hashFile(filepath, algorithms):
 
-    if algorithms != "sha256" :
-        raise Exception(f"digest not yet implemented: alg=({algorithms})")
+ALGORITHMS = {
+    'sha256': hashlib.sha256,
+    'sha1': hashlib.sha1,
+    'md5': hashlib.md5,
+    'blake2b': hashlib.blake2b,
+}
+
+# Large reads into one reused buffer; hashlib releases the GIL while it digests each block
+BLOCK_SIZE = 1024 * 1024
+
+# Tree hash (see treeHashFile): the file is cut into chunks of HASH_TREE_CHUNK_BYTES that are hashed in parallel,
+# so a very large recording is not limited to the speed of one core. Its digest is not the file's sha256.
+TREE_ALGORITHM = 'sha256-tree'
+HASH_TREE_CHUNK_BYTES = int(os.getenv('HASH_TREE_CHUNK_BYTES', 8 * 1024 * 1024))
+# Threads hashing the chunks; 0 = as many as the CPU budget lends (see cpubudget.py)
+HASH_TREE_THREADS = int(os.getenv('HASH_TREE_THREADS', 0))
+
+# The chunk digests of the tree hashed files, kept until the file changes (e.g. to re-verify or resume parts of it)
+TREES = filecache.FileCache('hashtree', int(os.getenv('HASH_TREE_CACHE_MAX_ENTRIES', 10000)), identity=True)
+
+# Digests that were already computed, one entry per file and algorithm. The cache is keyed by the file's device and
+# inode, and checked against its size and mtime before any byte is read, so a file that is moved or hard linked
+# keeps its digests and a modified file is hashed again (see filecache.py)
+DIGEST_CACHE = os.getenv('DIGEST_CACHE', '1') == '1'
+DIGESTS = filecache.FileCache('digest', int(os.getenv('DIGEST_CACHE_MAX_ENTRIES', 100000)), identity=True)
+
 
-    sha256 = hashlib.sha256()
+# Returns the algorithm names of a comma separated list (e.g. "sha256,md5"), in order and without duplicates
+# Raises ValueError if one of them is not in ALGORITHMS (or TREE_ALGORITHM)
+def parseAlgorithms(algorithms):
+    known = list(ALGORITHMS) + [TREE_ALGORITHM]
+    names = []
+    for name in (algorithms or '').split(','):
+        name = name.strip().lower()
+        if not name:
+            continue
+        if name not in known:
+            raise ValueError(f"Unknown digest algorithm '{name}' (expected one or more of {', '.join(known)})")
+        if name not in names:
+            names.append(name)
+    if not names:
+        raise ValueError(f"No digest algorithm requested (expected one or more of {', '.join(known)})")
+    return names
 
-    blocksize = 64 * 1024
 
-    with open(filepath, 'rb') as f:
+# Returns {algorithm: hex digest} for each algorithm in the comma separated list
+# Digests found in DIGESTS are not computed again, unless verify is set: then the file is read in any case, and
+# a digest that differs from the cached one (contents changed without a new mtime, or a damaged disk) is logged
+# The tree hash needs a read of its own, in parallel chunks; the other digests share one sequential read
+def hashFile(filepath, algorithms, verify=False):
+    names = parseAlgorithms(algorithms)
+    cached = cachedDigests(filepath, names)
+    if not verify and len(cached) == len(names):
+        return cached
+
+    sig = filecache.signature(filepath)
+    wanted = names if verify else [name for name in names if name not in cached]
+    digests = _hashSequential(filepath, [name for name in wanted if name != TREE_ALGORITHM])
+    if TREE_ALGORITHM in wanted:
+        digests[TREE_ALGORITHM] = treeHashFile(filepath)['root']
+    for name, digest in digests.items():
+        if name in cached and cached[name] != digest:
+            metrics.DIGEST_MISMATCHES.inc(algorithm = name)
+            logger.error(f"hashFile({filepath}): {name} is {digest}, but {cached[name]} was cached for the same size and mtime")
+        if DIGEST_CACHE:
+            DIGESTS.put(filepath, digest, name, sig)
+    cached.update(digests)
+    return {name: cached[name] for name in names}
+
+
+# Returns {algorithm: hex digest} of the digests of filepath (as it is now) that are cached; reads no file data
+def cachedDigests(filepath, algorithms):
+    if not DIGEST_CACHE:
+        return {}
+    digests = {}
+    for name in algorithms:
+        digest = DIGESTS.get(filepath, name)
+        if digest is not None:
+            digests[name] = digest
+    return digests
+
+
+def _hashSequential(filepath, names):
+    if not names:
+        return {}
+    digests = {name: ALGORITHMS[name]() for name in names}
+    hashes = list(digests.values())
+
+    buffer = bytearray(BLOCK_SIZE)
+    view = memoryview(buffer)
+    with open(filepath, 'rb', buffering=0) as f:
         while True:
-            block = f.read(blocksize)
-            if not block:
+            n = f.readinto(buffer)
+            if not n:
                 break
-            sha256.update(block)
-   
-    return sha256.hexdigest()
+            block = view[:n]
+            for h in hashes:
+                h.update(block)
+
+    return {name: h.hexdigest() for name, h in digests.items()}
+
+
+# Leaves and inner nodes are hashed with different prefixes, so that a chunk cannot pass for a pair of digests
+def chunkDigest(data):
+    h = hashlib.sha256(b'\x00')
+    h.update(data)
+    return h.digest()
+
+
+# Combines the chunk digests pairwise, level by level (an odd digest moves up a level as it is), into the root
+def merkleRoot(digests):
+    level = list(digests) or [chunkDigest(b'')]
+    while len(level) > 1:
+        pairs = [hashlib.sha256(b'\x01' + level[i] + level[i + 1]).digest() for i in range(0, len(level) - 1, 2)]
+        level = pairs + level[len(level) - len(level) % 2:]
+    return level[0]
+
+
+# Returns {index: digest (bytes)} of the chunks of filepath (all of them, or those in indexes that it has)
+# The file is mapped rather than read, so the hashing threads work on the page cache without copies
+def _chunkDigests(filepath, chunk_size, indexes=None, threads=None):
+    size = os.path.getsize(filepath)
+    count = (size + chunk_size - 1) // chunk_size
+    indexes = range(count) if indexes is None else [i for i in indexes if 0 <= i < count]
+    if not indexes:
+        return {}
+    with open(filepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        def digest(index):
+            with memoryview(mapped) as view:
+                with view[index * chunk_size:(index + 1) * chunk_size] as chunk:
+                    return chunkDigest(chunk)
+
+        with cpubudget.lease(HASH_TREE_THREADS or None) as lease:
+            with futures.ThreadPoolExecutor(threads or lease.threads, thread_name_prefix='hasher') as pool:
+                return dict(zip(indexes, pool.map(digest, indexes)))
+
+
+# Tree hash of filepath: {'algorithm', 'size', 'chunkSize', 'root': hex digest, 'chunks': [hex digest of each chunk]}
+# The result is also kept in TREES (see getTree)
+def treeHashFile(filepath, chunk_size=None, threads=None):
+    chunk_size = chunk_size or HASH_TREE_CHUNK_BYTES
+    sig = filecache.signature(filepath)
+    chunks = list(_chunkDigests(filepath, chunk_size, threads=threads).values())
+    tree = {'algorithm': TREE_ALGORITHM, 'size': sig[0], 'chunkSize': chunk_size,
+            'root': merkleRoot(chunks).hex(), 'chunks': [c.hex() for c in chunks]}
+    TREES.put(filepath, json.dumps(tree), str(chunk_size), sig)
+    return tree
+
+
+# Returns the tree hash of filepath that treeHashFile stored, if the file has not changed since, or None
+def getTree(filepath, chunk_size=None):
+    tree = TREES.get(filepath, str(chunk_size or HASH_TREE_CHUNK_BYTES))
+    return json.loads(tree) if tree is not None else None
+
+
+# Returns the indexes of the chunks of filepath that do not match tree (a treeHashFile result)
+# indexes (optional) limits the check to those chunks, e.g. the parts of a download that were just written
+def verifyChunks(filepath, tree, indexes=None):
+    if indexes is None:
+        indexes = range(len(tree['chunks']))
+    indexes = [i for i in indexes if 0 <= i < len(tree['chunks'])]
+    actual = _chunkDigests(filepath, tree['chunkSize'], indexes)
+    return [i for i in indexes if actual.get(i, b'').hex() != tree['chunks'][i]]
@@ -0,0 +1,69 @@
+import hashlib
+
+import pytest
+
+import filecache
+import hasher
+
+
+def test_digests_from_one_read(tmp_path, monkeypatch):
+    monkeypatch.setattr(filecache, 'FILECACHE_PATH', 'none')
+    monkeypatch.setattr(filecache, '_db', None)
+    monkeypatch.setattr(hasher, 'DIGESTS', filecache.FileCache('digest', 100, identity=True))  # Nothing cached yet
+    monkeypatch.setattr(hasher, 'BLOCK_SIZE', 1000)  # Several blocks
+    data = bytes(range(256)) * 20
+    path = tmp_path / 'a.bin'
+    path.write_bytes(data)
+    digests = hasher.hashFile(str(path), 'sha256, MD5,blake2b,sha256')
+    assert list(digests) == ['sha256', 'md5', 'blake2b']
+    assert digests['sha256'] == hashlib.sha256(data).hexdigest()
+    assert digests['md5'] == hashlib.md5(data).hexdigest()
+    assert digests['blake2b'] == hashlib.blake2b(data).hexdigest()
+
+
+def test_unknown_algorithms():
+    with pytest.raises(ValueError, match='crc32'):
+        hasher.parseAlgorithms('sha256,crc32')
+    with pytest.raises(ValueError):
+        hasher.parseAlgorithms('')
+
+
+def test_tree_hash(tmp_path, monkeypatch):
+    monkeypatch.setattr(filecache, 'FILECACHE_PATH', 'none')
+    monkeypatch.setattr(filecache, '_db', None)
+    data = bytes(range(256)) * 10  # 2560 bytes: chunks of 1000, 1000 and 560
+    path = tmp_path / 'a.bin'
+    path.write_bytes(data)
+    tree = hasher.treeHashFile(str(path), chunk_size=1000, threads=2)
+    leaves = [hasher.chunkDigest(data[i:i + 1000]) for i in range(0, len(data), 1000)]
+    pair = hashlib.sha256(b'\x01' + leaves[0] + leaves[1]).digest()
+    assert tree['chunks'] == [leaf.hex() for leaf in leaves]
+    assert tree['root'] == hashlib.sha256(b'\x01' + pair + leaves[2]).hexdigest()
+    assert hasher.getTree(str(path), 1000) == tree
+
+    assert hasher.verifyChunks(str(path), tree) == []
+    path.write_bytes(data[:1500] + b'x' + data[1501:])
+    assert hasher.verifyChunks(str(path), tree) == [1]
+    assert hasher.verifyChunks(str(path), tree, [0, 2]) == []
+    assert hasher.getTree(str(path), 1000) is None  # The file changed
+
+
+def test_digests_are_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(filecache, 'FILECACHE_PATH', 'none')
+    monkeypatch.setattr(filecache, '_db', None)
+    reads = []
+    sequential = hasher._hashSequential
+    monkeypatch.setattr(hasher, '_hashSequential', lambda path, names: reads.append(names) or sequential(path, names))
+    path = tmp_path / 'a.bin'
+    path.write_bytes(b'one')
+    first = hasher.hashFile(str(path), 'sha256')
+    moved = tmp_path / 'b.bin'
+    path.rename(moved)  # Same inode: still cached
+    assert hasher.hashFile(str(moved), 'sha256') == first
+    assert hasher.hashFile(str(moved), 'md5,sha256')['sha256'] == first['sha256']
+    assert reads == [['sha256'], ['md5']]
+
+    assert hasher.hashFile(str(moved), 'sha256', verify=True) == first
+    moved.write_bytes(b'two')
+    assert hasher.hashFile(str(moved), 'sha256') == {'sha256': hashlib.sha256(b'two').hexdigest()}
+    assert len(reads) == 4
@@ -0,0 +1,84 @@
+import os
+import shutil
+import threading
+
+import cpubudget
+import log
+import metrics
+import runner
+import transcribe
+
+logger = log.getLogger(__name__)
+
+# Health, readiness and capacity of this replica (see GetCapacityRPC)
+# The scheduler uses it to send work to the least loaded node.
+
+# Read the whisper model and run each binary once at startup, so that the first real job does not pay for it
+WARMUP_ON_START = os.getenv('WARMUP_ON_START', '1') == '1'
+
+MODEL_READ_BLOCKSIZE = 8 * 1024 * 1024
+
+_warmed = set()
+
+
+def _tools():
+    return [('ffmpeg', 'ffmpeg'), ('ffprobe', 'ffprobe'), ('whisper', transcribe.WHISPER_EXECUTABLE)]
+
+
+# Pulls the whisper model into the page cache and checks that each binary can be started
+def warmUp():
+    for name, executable in _tools():
+        try:
+            runner.run([executable, '-h'] if name == 'whisper' else [executable, '-version'])
+        except Exception as e:
+            logger.warning(f"warmUp: {name} is not usable: {e}")
+    try:
+        with open(transcribe.MODEL, 'rb') as f:
+            while f.read(MODEL_READ_BLOCKSIZE):
+                pass
+        _warmed.add(transcribe.MODEL)
+    except OSError as e:
+        logger.warning(f"warmUp: Could not read whisper model {transcribe.MODEL}: {e}")
+
+
+def startWarmUp():
+    if WARMUP_ON_START:
+        threading.Thread(target=warmUp, name='warmup', daemon=True).start()
+
+
+# Returns a list of {name, path, present, warm} for the binaries and the whisper model
+def tools():
+    result = []
+    for name, executable in _tools():
+        path = shutil.which(executable)
+        result.append({'name': name, 'path': path or executable, 'present': path is not None,
+                       'warm': os.path.basename(executable) in runner.LAST_SUCCESS})
+    result.append({'name': 'whisper-model', 'path': transcribe.MODEL, 'present': os.path.isfile(transcribe.MODEL),
+                   'warm': transcribe.MODEL in _warmed
+                   or os.path.basename(transcribe.WHISPER_EXECUTABLE) in runner.LAST_SUCCESS})
+    return result
+
+
+# pools: the thread pools that run RPCs (metrics.TimedThreadPoolExecutor); the lanes in aio mode
+def capacity(pools):
+    try:
+        free_bytes = shutil.disk_usage(metrics.DATA_DIRECTORY).free if metrics.DATA_DIRECTORY else -1
+    except OSError:
+        free_bytes = -1
+    try:
+        load = list(os.getloadavg())
+    except OSError:
+        load = []
+    allTools = tools()
+    return {
+        'ready': all(t['present'] for t in allTools),
+        'lanes': [{'name': p.lane, 'maxWorkers': p.max_workers, 'running': p.running, 'waiting': p.waiting,
+                   'freeSlots': p.free_slots()} for p in pools],
+        'runningJobs': metrics.inFlight(),
+        'dataDirectoryFreeBytes': free_bytes,
+        'loadAverage': load,
+        'cpuCount': os.cpu_count() or 1,
+        'cpuBudget': cpubudget.BUDGET.total,
+        'cpuLeased': cpubudget.BUDGET.used(),
+        'tools': allTools,
+    }
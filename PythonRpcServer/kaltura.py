@@ -6,12 +6,15 @@ import hashlib
 import json
 import os
 from time import perf_counter 
-import traceback
 
 
 from utils import download_file
 from mediaprovider import MediaProvider, InvalidPlaylistInfoException
 
+import log
+
+logger = log.getLogger(__name__)
+
 DATA_DIR = os.getenv('DATA_DIRECTORY')
 KALTURA_PARTNER_ID = int(os.getenv('KALTURA_PARTNER_ID', default=0))
 KALTURA_TOKEN_ID = os.getenv('KALTURA_TOKEN_ID', default=None)
@@ -206,7 +209,7 @@ class KalturaProvider(MediaProvider):
             if url.path.startswith('/playlist/'):
                 return servername, True, url.path.split('/')[-1]
         except Exception as e:
-            print("Failed to parse request.Url:" + str(e))
+            logger.warning("Failed to parse request.Url:" + str(e))
             pass # Fall through
 
         raise InvalidPlaylistInfoException("Invalid resource:"+request.Url)
@@ -230,7 +233,7 @@ class KalturaProvider(MediaProvider):
         for m in validMedia:
             if len(m.get('parentEntryId')) > 0:
                 mapping[ m.get('parentEntryId') ] = m
-        print(f"{len(mapping)} parent-child mappings for {len(validMedia)} valid media (duration>0)")
+        logger.info(f"{len(mapping)} parent-child mappings for {len(validMedia)} valid media (duration>0)")
         result = []
         for m in validMedia:
             if len( m.get('parentEntryId') ) == 0:
@@ -246,7 +249,7 @@ class KalturaProvider(MediaProvider):
         # We could be getting a channel or a playlist
         # Ignore Url param if the original URL provided (if known) looks like a Kaltura playlist URL
         # We try a playlist first
-        print('getPlaylistItems' + str(request))
+        logger.info('getPlaylistItems' + str(request))
         start_time = perf_counter()
         result = []
         try:
@@ -255,44 +258,43 @@ class KalturaProvider(MediaProvider):
                 request)
             partnerInfo = self.getPartnerInfo(servername)
 
-            print(f"server={servername},partner= {partnerInfo}, playlist={isPlaylist},id={id}")
+            logger.info(f"server={servername},partner= {partnerInfo}, playlist={isPlaylist},id={id}")
 
             resInitial = self.getMediaInfosForKalturaPlaylist(partnerInfo, id) if isPlaylist else \
                 self.getMediaInfosForKalturaChannel(partnerInfo, id)
 
             resFiltered = self.organizeParentMedia(resInitial)
-            print(f'Found {len(resFiltered)} items ({len(resInitial)} before filtering)')
+            logger.info(f'Found {len(resFiltered)} items ({len(resInitial)} before filtering)')
             result = json.dumps(resFiltered)
             
         except InvalidPlaylistInfoException as e:
-            print(f"getPlaylistItems({request}) Exception:{e}")
+            logger.warning(f"getPlaylistItems({request}) Exception:{e}")
             raise e
         except Exception as e:
-            print(f"getPlaylistItems({request}) Exception:{e}")
-            traceback.print_exc()
+            logger.exception(f"getPlaylistItems({request}) Exception:{e}")
             raise InvalidPlaylistInfoException(
                 "Error during Channel/Playlist processing " + str(e))
         end_time = perf_counter()
-        print(f"getPlaylistItems({request}) returning '{self.truncate(self.sanitize(result))}'. Processing ({end_time-start_time:.2f}) seconds.")
+        logger.info(f"getPlaylistItems({request}) returning '{self.truncate(self.sanitize(result))}'. Processing ({end_time-start_time:.2f}) seconds.")
         return result
 
     # Main entry point - overrides stub in MediaProvider super class
     def getMedia(self, request):
         try:
             start_time = perf_counter()
-            print(f"getMedia({request}) starting")
+            logger.info(f"getMedia({request}) starting")
             
             videoUrl = request.videoUrl.replace('/flavorParamIds/',f"/ks/{self.ks}/flavorParamIds/");
             
             result =  self.downloadLecture(videoUrl)
             end_time = perf_counter()
-            print(f"getMedia({request}) returning '{self.truncate(self.sanitize(result))}'. Processing ({end_time-start_time:.2f}) seconds.")
+            logger.info(f"getMedia({request}) returning '{self.truncate(self.sanitize(result))}'. Processing ({end_time-start_time:.2f}) seconds.")
 
             return result
         except Exception as e:
-            print(f"getMedia({request}) Exception:{e}" )
+            logger.error(f"getMedia({request}) Exception:{e}" )
             raise e
 
 if KALTURA_PARTNER_ID == 0 or not KALTURA_TOKEN_ID or not KATLURA_APP_TOKEN:
-    print("INVALID KALTURA CREDENTIALS, check KALTURA environment variables.")
+    logger.warning("INVALID KALTURA CREDENTIALS, check KALTURA environment variables.")
 
@@ -0,0 +1,172 @@
+import asyncio
+import functools
+import inspect
+import os
+import metrics
+
+# Execution lanes for the grpc.aio server mode (see server.serve_aio)
+# Every RPC is assigned to a lane and each lane has its own thread pool, so a slow job in one lane
+# (e.g. three whisper transcriptions) can never delay a short call waiting in another lane (e.g. ffprobe)
+
+# Downloads and playlist fetches spend most of their time waiting on the network, so this lane can be wide
+NUM_DOWNLOAD_WORKERS = int(os.getenv('NUM_DOWNLOAD_WORKERS', 8))
+# ffmpeg and whisper subprocesses; the existing NUM_PYTHON_WORKERS setting keeps its meaning of "number of heavy jobs"
+NUM_CPU_WORKERS = int(os.getenv('NUM_PYTHON_WORKERS', 3))
+# Short calls (ffprobe, file hashing, health checks)
+NUM_FAST_WORKERS = int(os.getenv('NUM_FAST_WORKERS', 4))
+
+DOWNLOAD = 'download'
+CPU = 'cpu'
+FAST = 'fast'
+
+RPC_LANES = {
+    'GetKalturaChannelEntriesRPC': DOWNLOAD,
+    'DownloadKalturaVideoRPC': DOWNLOAD,
+    'GetEchoPlaylistRPC': DOWNLOAD,
+    'DownloadEchoVideoRPC': DOWNLOAD,
+    'GetYoutubePlaylistRPC': DOWNLOAD,
+    'DownloadYoutubeVideoRPC': DOWNLOAD,
+    # Mostly waits for a background job (see background.py)
+    'GetVideoJobRPC': DOWNLOAD,
+
+    'ConvertVideoToWavRPCWithOffset': CPU,
+    'ProcessVideoRPC': CPU,
+    'ProcessMediaRPC': CPU,
+    'ProcessVideoPreviewRPC': CPU,
+    'TranscribeAudioRPC': CPU,
+    'AudioFingerprintRPC': CPU,
+    'ConvertVideoToWavStreamRPC': CPU,
+    'ProcessVideoStreamRPC': CPU,
+    'TranscribeAudioStreamRPC': CPU,
+    'TranscribeAudioResultRPC': CPU,
+    'TranscribeAudioResultStreamRPC': CPU,
+
+    'ComputeFileHash': FAST,
+    'GetMediaInfoRPC': FAST,
+    'ProbeMediaRPC': FAST,
+    'ComputeFileHashBatchRPC': FAST,
+    'GetMediaInfoBatchRPC': FAST,
+    'GetScenesRPC': FAST,
+    'ToPhraseHintsRPC': FAST,
+    'GetMetricsRPC': FAST,
+    'GetCapacityRPC': FAST,
+}
+
+# RPCs that are not listed above are assumed to be expensive
+DEFAULT_LANE = CPU
+
+
+class Lane:
+    def __init__(self, name, max_workers):
+        self.name = name
+        self.max_workers = max_workers
+        self.executor = metrics.TimedThreadPoolExecutor(name, max_workers, thread_name_prefix=f"lane-{name}")
+
+    def free_slots(self):
+        return self.executor.free_slots()
+
+    # Runs the blocking function fn(*args) on this lane's thread pool and awaits the result
+    # on_done (optional) is called when fn has returned (or was cancelled before it started), which may be after
+    # the awaiting call was cancelled: a thread that is running cannot be stopped
+    async def run(self, fn, *args, on_done=None):
+        try:
+            future = self.executor.submit(functools.partial(fn, *args))
+        except BaseException:
+            if on_done:
+                on_done()
+            raise
+        if on_done:
+            future.add_done_callback(lambda _: on_done())
+        return await asyncio.wrap_future(future)
+
+    # Iterates the blocking generator fn(*args) on this lane's thread pool and yields its items
+    # on_done (optional) is called when the generator has finished, as in run()
+    async def stream(self, fn, *args, on_done=None):
+        loop = asyncio.get_running_loop()
+        items = asyncio.Queue()
+        finished = object()
+
+        def drain():
+            try:
+                for item in fn(*args):
+                    loop.call_soon_threadsafe(items.put_nowait, item)
+            finally:
+                loop.call_soon_threadsafe(items.put_nowait, finished)
+
+        task = asyncio.ensure_future(self.run(drain, on_done=on_done))
+        while True:
+            item = await items.get()
+            if item is finished:
+                break
+            yield item
+        await task  # Re-raises any exception from the generator
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+LANES = {
+    DOWNLOAD: Lane(DOWNLOAD, NUM_DOWNLOAD_WORKERS),
+    CPU: Lane(CPU, NUM_CPU_WORKERS),
+    FAST: Lane(FAST, NUM_FAST_WORKERS),
+}
+
+
+def laneFor(rpcName):
+    return LANES[RPC_LANES.get(rpcName, DEFAULT_LANE)]
+
+
+# The servicer methods are written against the synchronous grpc.ServicerContext API.
+# This presents a grpc.aio context with the same methods so the same code runs in both server modes.
+class LaneContext:
+    def __init__(self, context):
+        self._context = context
+
+    def __getattr__(self, name):
+        return getattr(self._context, name)
+
+    def is_active(self):
+        return not self._context.done()
+
+    def add_callback(self, callback):
+        self._context.add_done_callback(lambda _: callback())
+        return True
+
+
+# Wraps a synchronous servicer so that each RPC becomes a coroutine that runs on its assigned lane
+# If an admission controller is given (see admission.py), calls are admitted or rejected as they arrive,
+# before they are queued on a lane
+class LaneServicer:
+    def __init__(self, servicer, admission=None):
+        self._servicer = servicer
+        self._admission = admission
+
+    async def _admit(self, name, context):
+        if self._admission is None:
+            return None
+        return await self._admission.admitOrAbort(name, context)
+
+    def __getattr__(self, name):
+        method = getattr(self._servicer, name)
+        lane = laneFor(name)
+
+        # The ticket is released when the worker thread has finished, not when the call ends: a cancelled call's
+        # job keeps its thread (and its ffmpeg or whisper process) until it notices, so it still counts
+        if inspect.isgeneratorfunction(method):
+            async def stream_handler(request, context):
+                ticket = await self._admit(name, context)
+                async for item in lane.stream(ticket.execute if ticket else _call, method, request, LaneContext(context),
+                                              on_done=ticket.done if ticket else None):
+                    yield item
+            return stream_handler
+
+        async def handler(request, context):
+            ticket = await self._admit(name, context)
+            return await lane.run(ticket.execute if ticket else _call, method, request, LaneContext(context),
+                                  on_done=ticket.done if ticket else None)
+
+        return handler
+
+
+def _call(fn, *args):
+    return fn(*args)
@@ -0,0 +1,42 @@
+import asyncio
+import threading
+
+import admission
+import lanes
+
+
+class Servicer:
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def GetMetricsRPC(self, request, context):
+        self.started.set()
+        self.release.wait(5)
+        return request
+
+
+def test_cancelled_calls_hold_their_ticket_until_the_worker_finishes():
+    controller = admission.AdmissionController()
+    servicer = Servicer()
+    handler = lanes.LaneServicer(servicer, controller).GetMetricsRPC
+
+    def pending():
+        return controller.capacity()['GetMetricsRPC']['pending']
+
+    async def scenario():
+        call = asyncio.ensure_future(handler('request', None))
+        while not servicer.started.is_set():
+            await asyncio.sleep(0.01)
+        call.cancel()
+        await asyncio.sleep(0.05)
+        assert call.cancelled()
+        assert pending() == 1  # The worker thread is still running the job
+        servicer.release.set()
+        for _ in range(100):
+            if pending() == 0:
+                break
+            await asyncio.sleep(0.01)
+        assert pending() == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,127 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+# Logging for the server and its modules (instead of print)
+# Each module uses   logger = log.getLogger(__name__)
+# Records are put on a bounded in-memory queue and written to stdout by a background thread, so an RPC never
+# waits for stdout. If the queue is full the record is dropped (and the number dropped is logged later)
+# rather than blocking the caller. Long messages (e.g. whole ffprobe or whisper JSON documents) are cut to
+# LOG_MAX_MESSAGE_CHARS.
+
+# DEBUG, INFO, WARNING, ERROR
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# 'text' or 'json' (one JSON object per line, for log collectors)
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_MAX_MESSAGE_CHARS = int(os.getenv('LOG_MAX_MESSAGE_CHARS', 2000))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+# Attributes of every LogRecord; any other attribute was passed with extra={...} and is included in json lines
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', logging.INFO, '', 0, '', None, None))) | {'message', 'asctime'}
+
+_listener = None
+_lock = threading.Lock()
+
+
+def getLogger(name):
+    return logging.getLogger(name)
+
+
+# Keeps the start and the end of long messages (the end of a traceback is the useful part)
+def truncate(text, limit=None):
+    limit = LOG_MAX_MESSAGE_CHARS if limit is None else limit
+    if limit <= 0 or len(text) <= limit:
+        return text
+    head = limit * 3 // 4
+    tail = limit - head
+    return f"{text[:head]} ...[{len(text) - limit} characters omitted]... {text[len(text) - tail:]}"
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'msg': record.getMessage(),
+        }
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        return json.dumps(entry, default=str)
+
+
+# Formats and truncates the message in the calling thread (so that the arguments are not shared with the
+# writer thread), then queues it without blocking
+class _QueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = truncate(record.getMessage())
+        record.args = None
+        if record.exc_info:
+            record.exc_text = truncate(logging.Formatter().formatException(record.exc_info))
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with _lock:
+                self.dropped += 1
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def __init__(self, q, handler, queueHandler):
+        super().__init__(q, handler)
+        self.queueHandler = queueHandler
+
+    def handle(self, record):
+        with _lock:
+            dropped, self.queueHandler.dropped = self.queueHandler.dropped, 0
+        if dropped:
+            super().handle(logging.makeLogRecord({'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                                                  'msg': f"{dropped} log records dropped (queue full)"}))
+        super().handle(record)
+
+
+# Configures the root logger. Called once by server.py before it starts serving
+# stream defaults to stdout
+def setup(level=None, format=None, stream=None):
+    global _listener
+    if _listener is not None:
+        return
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter() if (format or LOG_FORMAT) == 'json' else logging.Formatter(TEXT_FORMAT))
+    q = queue.Queue(LOG_QUEUE_SIZE)
+    queueHandler = _QueueHandler(q)
+    root = logging.getLogger()
+    root.handlers[:] = [queueHandler]
+    root.setLevel(level or LOG_LEVEL)
+    _listener = _QueueListener(q, output, queueHandler)
+    _listener.start()
+    atexit.register(shutdown)
+
+
+# Writes any queued records and stops the writer thread
+def shutdown():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,22 @@
+import json
+import logging
+
+import log
+
+
+def test_truncate_keeps_start_and_end():
+    text = 'a' * 100 + 'b' * 100
+    short = log.truncate(text, 40)
+    assert short.startswith('a' * 30)
+    assert short.endswith('b' * 10)
+    assert '160 characters omitted' in short
+    assert log.truncate('short', 40) == 'short'
+
+
+def test_json_lines_include_extra_fields():
+    record = logging.LogRecord('server', logging.INFO, __file__, 1, 'took %.1f seconds', (2.0,), None)
+    record.rpc = 'ProcessVideoRPC'
+    entry = json.loads(log.JsonFormatter().format(record))
+    assert entry['level'] == 'INFO'
+    assert entry['msg'] == 'took 2.0 seconds'
+    assert entry['rpc'] == 'ProcessVideoRPC'
@@ -0,0 +1,465 @@
+import mmap
+import os
+import struct
+from array import array
+
+# Reads duration and stream information directly from the headers of MP4/MOV, WAV and MPEG-TS files,
+# without starting ffprobe (starting a process costs more than the probe itself for most of our library).
+# parse() returns the same structure as ffprobe's json output in getMediaInfo's 'fields' mode, or None
+# for anything it does not fully understand, in which case the caller falls back to ffprobe.
+# Only the header boxes/chunks/packets are touched (the file is memory mapped), so the cost does not
+# depend on the size of the file.
+
+MP4_FORMAT_NAME = 'mov,mp4,m4a,3gp,3g2,mj2'
+
+MP4_VIDEO_CODECS = {b'avc1': 'h264', b'avc3': 'h264', b'hvc1': 'hevc', b'hev1': 'hevc', b'av01': 'av1',
+                    b'vp09': 'vp9', b'mp4v': 'mpeg4', b'jpeg': 'mjpeg'}
+MP4_AUDIO_CODECS = {b'Opus': 'opus', b'ac-3': 'ac3', b'ec-3': 'eac3', b'fLaC': 'flac', b'alac': 'alac',
+                    b'.mp3': 'mp3', b'sowt': 'pcm_s16le', b'twos': 'pcm_s16be'}  # mp4a: see _esdsCodec
+# MPEG-4 objectTypeIndication (esds) -> codec
+MP4_OBJECT_TYPES = {0x40: 'aac', 0x66: 'aac', 0x67: 'aac', 0x68: 'aac', 0x69: 'mp3', 0x6B: 'mp3'}
+
+# WAVE format tag -> {bits per sample -> codec}
+WAV_CODECS = {1: {8: 'pcm_u8', 16: 'pcm_s16le', 24: 'pcm_s24le', 32: 'pcm_s32le'},
+              3: {32: 'pcm_f32le', 64: 'pcm_f64le'}}
+WAV_FORMAT_EXTENSIBLE = 0xFFFE
+
+TS_PACKET = 188
+TS_SYNC = 0x47
+# PMT stream_type -> codec. Other stream types (e.g. ID3 metadata) are left to ffprobe
+TS_STREAM_TYPES = {0x1B: ('video', 'h264'), 0x0F: ('audio', 'aac')}
+# Bytes read at each end of a transport stream for the PAT/PMT, the codec parameters and the first/last PTS
+TS_SCAN_BYTES = 2 * 1024 * 1024
+TS_TAIL_PES = 8
+TS_PES_BYTES = 16 * 1024
+
+# chroma_format_idc -> ffmpeg pixel format (full range 'yuvj' formats are reported as their 'yuv' equivalent)
+H264_PIX_FMTS = {0: 'gray', 1: 'yuv420p', 2: 'yuv422p', 3: 'yuv444p'}
+
+AAC_SAMPLE_RATES = [96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000, 11025, 8000, 7350]
+
+
+# Returns ffprobe-style {'format': {...}, 'streams': [...]} for filepath, or None
+def parse(filepath):
+    try:
+        size = os.path.getsize(filepath)
+        if size < 12:
+            return None
+        with open(filepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if buf[4:8] == b'ftyp' or buf[4:8] in (b'moov', b'mdat', b'wide', b'free'):
+                result = _parseMp4(buf, size)
+            elif buf[0:4] == b'RIFF' and buf[8:12] == b'WAVE':
+                result = _parseWav(buf, size)
+            elif size >= 3 * TS_PACKET and buf[0] == TS_SYNC and buf[TS_PACKET] == TS_SYNC and buf[2 * TS_PACKET] == TS_SYNC:
+                result = _parseTs(buf, size)
+            else:
+                return None
+    except (OSError, ValueError, struct.error, IndexError):
+        return None
+    if not result or not result['streams']:
+        return None
+    for index, stream in enumerate(result['streams']):
+        stream['index'] = index
+        stream['disposition'] = {'attached_pic': 0}
+    return result
+
+
+def _format(name, duration, size):
+    return {'format_name': name, 'duration': f'{duration:.6f}', 'bit_rate': str(int(size * 8 / duration))}
+
+
+# ---- MP4 / MOV (ISO base media file format) ----
+
+# Yields (type, payload start, end) for each box between start and end
+def _boxes(buf, start, end):
+    pos = start
+    while pos + 8 <= end:
+        size, kind = struct.unpack_from('>I4s', buf, pos)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', buf, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            return
+        yield kind, pos + header, pos + size
+        pos += size
+
+
+def _child(buf, start, end, *path):
+    for kind, payload, box_end in _boxes(buf, start, end):
+        if kind == path[0]:
+            return (payload, box_end) if len(path) == 1 else _child(buf, payload, box_end, *path[1:])
+    return None
+
+
+# (timescale, duration) of an mvhd or mdhd box
+def _timescaleAndDuration(buf, payload):
+    if buf[payload] == 1:
+        return struct.unpack_from('>IQ', buf, payload + 20)
+    return struct.unpack_from('>II', buf, payload + 12)
+
+
+def _parseMp4(buf, size):
+    moov = _child(buf, 0, size, b'moov')
+    mvhd = moov and _child(buf, moov[0], moov[1], b'mvhd')
+    if not mvhd:
+        return None
+    timescale, duration = _timescaleAndDuration(buf, mvhd[0])
+    if not timescale or not duration:
+        return None  # e.g. fragmented mp4
+    streams = []
+    for kind, payload, end in _boxes(buf, moov[0], moov[1]):
+        if kind == b'trak':
+            stream = _mp4Track(buf, payload, end)
+            if stream is None:
+                return None
+            streams.append(stream)
+    return {'format': _format(MP4_FORMAT_NAME, duration / timescale, size), 'streams': streams}
+
+
+def _mp4Track(buf, start, end):
+    mdia = _child(buf, start, end, b'mdia')
+    hdlr = mdia and _child(buf, mdia[0], mdia[1], b'hdlr')
+    mdhd = mdia and _child(buf, mdia[0], mdia[1], b'mdhd')
+    stbl = mdia and _child(buf, mdia[0], mdia[1], b'minf', b'stbl')
+    stsd = stbl and _child(buf, stbl[0], stbl[1], b'stsd')
+    if not (hdlr and mdhd and stsd):
+        return None
+    handler = buf[hdlr[0] + 8:hdlr[0] + 12]
+    # The first sample entry follows the stsd version/flags and entry count
+    entry = next(_boxes(buf, stsd[0] + 8, stsd[1]), None)
+    if entry is None:
+        return None
+    fourcc, payload, entry_end = entry
+    if handler == b'vide':
+        stream = _mp4Video(buf, fourcc, payload, entry_end)
+    elif handler == b'soun':
+        stream = _mp4Audio(buf, fourcc, payload, entry_end)
+    else:
+        return None
+    if stream is None:
+        return None
+    timescale, duration = _timescaleAndDuration(buf, mdhd[0])
+    total = _sampleBytes(buf, stbl)
+    if timescale and duration and total:
+        stream['bit_rate'] = str(int(total * 8 * timescale / duration))
+    return stream
+
+
+def _mp4Video(buf, fourcc, payload, end):
+    codec = MP4_VIDEO_CODECS.get(fourcc)
+    if codec is None:
+        return None
+    width, height = struct.unpack_from('>HH', buf, payload + 24)
+    stream = {'codec_name': codec, 'codec_type': 'video', 'width': width, 'height': height}
+    avcC = _child(buf, payload + 78, end, b'avcC') if codec == 'h264' else None
+    if avcC and buf[avcC[0] + 5] & 0x1F:
+        length = struct.unpack_from('>H', buf, avcC[0] + 6)[0]
+        sps = parseH264Sps(bytes(buf[avcC[0] + 8:avcC[0] + 8 + length]))
+        if sps and sps.get('pix_fmt'):
+            stream['pix_fmt'] = sps['pix_fmt']
+    return stream
+
+
+def _mp4Audio(buf, fourcc, payload, end):
+    version = struct.unpack_from('>H', buf, payload + 8)[0]
+    if version > 1:
+        return None  # QuickTime v2 sound description
+    channels, _, _, _, rate = struct.unpack_from('>HHHHI', buf, payload + 16)
+    children = payload + (28 if version == 0 else 44)
+    if fourcc == b'mp4a':
+        esds = _child(buf, children, end, b'esds')
+        codec = esds and _esdsCodec(buf, esds[0], esds[1])
+    else:
+        codec = MP4_AUDIO_CODECS.get(fourcc)
+    if codec is None:
+        return None
+    return {'codec_name': codec, 'codec_type': 'audio', 'sample_rate': str(rate >> 16), 'channels': channels}
+
+
+# Reads an MPEG-4 descriptor header; returns (tag, payload start)
+def _descriptor(buf, pos):
+    tag = buf[pos]
+    pos += 1
+    for _ in range(4):
+        byte = buf[pos]
+        pos += 1
+        if not byte & 0x80:
+            break
+    return tag, pos
+
+
+def _esdsCodec(buf, start, end):
+    tag, pos = _descriptor(buf, start + 4)  # After version/flags
+    if tag != 0x03:
+        return None
+    flags = buf[pos + 2]
+    pos += 3
+    if flags & 0x80:
+        pos += 2  # dependsOn_ES_ID
+    if flags & 0x40:
+        pos += 1 + buf[pos]  # URL
+    if flags & 0x20:
+        pos += 2  # OCR_ES_Id
+    tag, pos = _descriptor(buf, pos)
+    if tag != 0x04 or pos >= end:
+        return None
+    return MP4_OBJECT_TYPES.get(buf[pos])
+
+
+# Total bytes of the track's samples (from the stsz or stz2 box), or 0
+def _sampleBytes(buf, stbl):
+    stsz = _child(buf, stbl[0], stbl[1], b'stsz')
+    if not stsz:
+        return 0
+    sample_size, count = struct.unpack_from('>II', buf, stsz[0] + 4)
+    if sample_size:
+        return sample_size * count
+    sizes = array('I')
+    sizes.frombytes(buf[stsz[0] + 12:stsz[0] + 12 + 4 * count])
+    if sizes.itemsize != 4:
+        return 0
+    if struct.pack('=I', 1) != struct.pack('>I', 1):
+        sizes.byteswap()
+    return sum(sizes)
+
+
+# ---- WAV ----
+
+def _parseWav(buf, size):
+    pos = 12
+    fmt = None
+    while pos + 8 <= size:
+        chunk, length = struct.unpack_from('<4sI', buf, pos)
+        if chunk == b'fmt ':
+            fmt = struct.unpack_from('<HHIIHH', buf, pos + 8)
+            if fmt[0] == WAV_FORMAT_EXTENSIBLE and length >= 40:
+                # The real format tag is the start of the SubFormat GUID
+                fmt = (struct.unpack_from('<H', buf, pos + 32)[0],) + fmt[1:]
+        elif chunk == b'data':
+            if fmt is None:
+                return None
+            tag, channels, rate, byte_rate, _, bits = fmt
+            codec = WAV_CODECS.get(tag, {}).get(bits)
+            if codec is None or not byte_rate:
+                return None
+            data = min(length, size - pos - 8)  # Streaming writers may leave the size unset (0xFFFFFFFF)
+            if data <= 0:
+                return None
+            stream = {'codec_name': codec, 'codec_type': 'audio', 'sample_rate': str(rate), 'channels': channels,
+                      'bit_rate': str(byte_rate * 8)}
+            return {'format': _format('wav', data / byte_rate, size), 'streams': [stream]}
+        pos += 8 + length + (length & 1)
+    return None
+
+
+# ---- MPEG transport stream ----
+
+# Yields (pid, payload_unit_start, payload start, payload end) for each packet in buf[start:end] (last first
+# if reverse)
+def _tsPackets(buf, start, end, reverse=False):
+    positions = range(start, end - TS_PACKET + 1, TS_PACKET)
+    for pos in (reversed(positions) if reverse else positions):
+        if buf[pos] != TS_SYNC:
+            return
+        pid = ((buf[pos + 1] & 0x1F) << 8) | buf[pos + 2]
+        control = (buf[pos + 3] >> 4) & 0x3
+        payload = pos + 4
+        if control & 0x2:
+            payload += 1 + buf[payload]
+        if not control & 0x1 or payload >= pos + TS_PACKET:
+            continue
+        yield pid, bool(buf[pos + 1] & 0x40), payload, pos + TS_PACKET
+
+
+# Section payload (after the pointer field) of a PSI packet
+def _section(buf, payload):
+    return payload + 1 + buf[payload]
+
+
+def _pts(buf, pes):
+    if buf[pes:pes + 3] != b'\x00\x00\x01' or not buf[pes + 7] & 0x80:
+        return None
+    b = buf[pes + 9:pes + 14]
+    return ((b[0] >> 1) & 0x7) << 30 | b[1] << 22 | (b[2] >> 1) << 15 | b[3] << 7 | b[4] >> 1
+
+
+def _parseTs(buf, size):
+    head_end = min(size, TS_SCAN_BYTES) // TS_PACKET * TS_PACKET
+    pmt_pid = None
+    streams = None  # pid -> stream type, in PMT order
+    for pid, start, payload, end in _tsPackets(buf, 0, head_end):
+        if pid == 0 and start and pmt_pid is None:
+            s = _section(buf, payload)
+            pmt_pid = ((buf[s + 10] & 0x1F) << 8) | buf[s + 11]  # First program
+        elif pid == pmt_pid and start:
+            streams = _pmtStreams(buf, _section(buf, payload))
+            break
+    if not streams or any(t not in TS_STREAM_TYPES for t in streams.values()):
+        return None
+
+    # The codec parameters come from the start of each stream's first PES packet (the SPS may follow a long
+    # SEI, so the payload is collected up to TS_PES_BYTES or the start of the next PES packet)
+    first_pts, info, pes = {}, {}, {}
+    for pid, start, payload, end in _tsPackets(buf, 0, head_end):
+        if len(info) == len(streams):
+            break
+        if pid not in streams or pid in info:
+            continue
+        if start:
+            pts = _pts(buf, payload)
+            if pts is not None:
+                first_pts.setdefault(pid, pts)
+            data = pes.pop(pid, None)  # The previous PES packet is complete
+            parsed = data and _tsStreamInfo(streams[pid], bytes(data))
+            if parsed:
+                info[pid] = parsed
+                continue
+            pes[pid] = bytearray()
+            payload += 9 + buf[payload + 8]
+        if pid in pes:
+            pes[pid] += buf[payload:end]
+            if len(pes[pid]) >= TS_PES_BYTES:
+                parsed = _tsStreamInfo(streams[pid], bytes(pes.pop(pid)))
+                if parsed:
+                    info[pid] = parsed
+    if len(info) != len(streams) or not first_pts:
+        return None
+
+    # The last PTS, from the last PES packet of each audio stream and the last few of each video stream
+    # (video PTS are out of order with B-frames)
+    tail_start = max(0, size - TS_SCAN_BYTES) // TS_PACKET * TS_PACKET
+    last_pts = None
+    remaining = {pid: TS_TAIL_PES if info[pid]['codec_type'] == 'video' else 1 for pid in streams}
+    for pid, start, payload, end in _tsPackets(buf, tail_start, size, reverse=True):
+        if start and remaining.get(pid):
+            remaining[pid] -= 1
+            pts = _pts(buf, payload)
+            if pts is not None and (last_pts is None or pts > last_pts):
+                last_pts = pts
+            if not any(remaining.values()):
+                break
+    begin = min(first_pts.values())
+    if last_pts is None or last_pts <= begin:
+        return None
+    duration = (last_pts - begin) / 90000.0
+    return {'format': _format('mpegts', duration, size), 'streams': [info[pid] for pid in streams]}
+
+
+def _pmtStreams(buf, s):
+    section_length = ((buf[s + 1] & 0x0F) << 8) | buf[s + 2]
+    end = s + 3 + section_length - 4  # Excluding the CRC
+    pos = s + 12 + (((buf[s + 10] & 0x0F) << 8) | buf[s + 11])
+    streams = {}
+    while pos + 5 <= end:
+        stream_type = buf[pos]
+        pid = ((buf[pos + 1] & 0x1F) << 8) | buf[pos + 2]
+        streams[pid] = stream_type
+        pos += 5 + (((buf[pos + 3] & 0x0F) << 8) | buf[pos + 4])
+    return streams
+
+
+# Codec parameters from the start of the first PES payload of a stream
+def _tsStreamInfo(stream_type, data):
+    codec_type, codec = TS_STREAM_TYPES[stream_type]
+    if codec == 'aac':
+        i = data.find(b'\xff')
+        if i < 0 or i + 4 > len(data) or data[i + 1] & 0xF6 != 0xF0:
+            return None
+        rate_index = (data[i + 2] >> 2) & 0xF
+        channels = ((data[i + 2] & 0x1) << 2) | (data[i + 3] >> 6)
+        if rate_index >= len(AAC_SAMPLE_RATES) or not channels:
+            return None
+        return {'codec_name': 'aac', 'codec_type': 'audio', 'sample_rate': str(AAC_SAMPLE_RATES[rate_index]),
+                'channels': channels}
+    for nal in data.split(b'\x00\x00\x01')[1:]:
+        if nal and nal[0] & 0x1F == 7:
+            sps = parseH264Sps(nal)
+            if sps:
+                return dict({'codec_name': 'h264', 'codec_type': 'video'}, **sps)
+    return None
+
+
+# ---- H.264 sequence parameter set ----
+
+class _Bits:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def u(self, n):
+        value = 0
+        for _ in range(n):
+            byte = self.data[self.pos >> 3]
+            value = (value << 1) | ((byte >> (7 - (self.pos & 7))) & 1)
+            self.pos += 1
+        return value
+
+    def ue(self):
+        zeros = 0
+        while self.u(1) == 0:
+            zeros += 1
+            if zeros > 31:
+                raise ValueError('Invalid exp-Golomb code')
+        return (1 << zeros) - 1 + self.u(zeros)
+
+    def se(self):
+        value = self.ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+
+# Returns {'width', 'height', 'pix_fmt'} from an SPS NAL unit (starting with its NAL header byte), or None
+def parseH264Sps(nal):
+    try:
+        rbsp = nal[1:].replace(b'\x00\x00\x03', b'\x00\x00')  # Remove emulation prevention bytes
+        r = _Bits(rbsp)
+        profile = r.u(8)
+        r.u(16)  # Constraint flags and level
+        r.ue()  # seq_parameter_set_id
+        chroma, bit_depth = 1, 8
+        if profile in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135):
+            chroma = r.ue()
+            if chroma == 3:
+                r.u(1)
+            bit_depth = 8 + r.ue()
+            r.ue()  # bit_depth_chroma_minus8
+            r.u(1)
+            if r.u(1):  # seq_scaling_matrix_present_flag
+                for i in range(8 if chroma != 3 else 12):
+                    if r.u(1):
+                        last, next_scale = 8, 8
+                        for _ in range(16 if i < 6 else 64):
+                            if next_scale:
+                                next_scale = (last + r.se() + 256) % 256
+                            last = next_scale or last
+        r.ue()  # log2_max_frame_num_minus4
+        poc_type = r.ue()
+        if poc_type == 0:
+            r.ue()
+        elif poc_type == 1:
+            r.u(1)
+            r.se()
+            r.se()
+            for _ in range(r.ue()):
+                r.se()
+        r.ue()  # max_num_ref_frames
+        r.u(1)
+        width_mbs = r.ue() + 1
+        height_units = r.ue() + 1
+        frame_mbs_only = r.u(1)
+        if not frame_mbs_only:
+            r.u(1)
+        r.u(1)
+        crop = (r.ue(), r.ue(), r.ue(), r.ue()) if r.u(1) else (0, 0, 0, 0)
+    except (IndexError, ValueError):
+        return None
+    sub_width = 1 if chroma in (0, 3) else 2
+    sub_height = 2 if chroma == 1 else 1
+    crop_x, crop_y = sub_width, sub_height * (2 - frame_mbs_only)
+    result = {'width': width_mbs * 16 - (crop[0] + crop[1]) * crop_x,
+              'height': (2 - frame_mbs_only) * height_units * 16 - (crop[2] + crop[3]) * crop_y}
+    if chroma in H264_PIX_FMTS:
+        result['pix_fmt'] = H264_PIX_FMTS[chroma] + (f'{bit_depth}le' if bit_depth > 8 else '')
+    return result
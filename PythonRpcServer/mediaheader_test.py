@@ -0,0 +1,62 @@
+import struct
+import wave
+
+import mediaheader
+
+
+def box(kind, *children):
+    payload = b''.join(children)
+    return struct.pack('>I4s', 8 + len(payload), kind) + payload
+
+
+# A minimal mp4 with one 48 kHz stereo PCM track of 2 seconds and its 'mdat' before the 'moov'
+def pcm_mp4(path):
+    mvhd = box(b'mvhd', struct.pack('>B3xIIII', 0, 0, 0, 1000, 2000), bytes(80))
+    mdhd = box(b'mdhd', struct.pack('>B3xIIII', 0, 0, 0, 48000, 96000), bytes(4))
+    hdlr = box(b'hdlr', bytes(8), b'soun', bytes(13))
+    sowt = box(b'sowt', bytes(6), struct.pack('>HHHI', 1, 0, 0, 0), struct.pack('>HHHHI', 2, 16, 0, 0, 48000 << 16))
+    stsd = box(b'stsd', struct.pack('>II', 0, 1), sowt)
+    stsz = box(b'stsz', struct.pack('>III', 0, 4, 96000))
+    trak = box(b'trak', box(b'mdia', mdhd, hdlr, box(b'minf', box(b'stbl', stsd, stsz))))
+    with open(path, 'wb') as f:
+        f.write(box(b'ftyp', b'isom', bytes(4)) + box(b'mdat', bytes(1000)) + box(b'moov', mvhd, trak))
+
+
+def test_mp4(tmp_path):
+    path = str(tmp_path / 'pcm.mp4')
+    pcm_mp4(path)
+    info = mediaheader.parse(path)
+    assert info['format']['format_name'] == mediaheader.MP4_FORMAT_NAME
+    assert info['format']['duration'] == '2.000000'
+    assert info['streams'] == [{'codec_name': 'pcm_s16le', 'codec_type': 'audio', 'sample_rate': '48000', 'channels': 2,
+                                'bit_rate': '1536000', 'index': 0, 'disposition': {'attached_pic': 0}}]
+
+
+def test_wav(tmp_path):
+    path = str(tmp_path / 'a.wav')
+    with wave.open(path, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(16000)
+        w.writeframes(bytes(2 * 16000 * 3))
+    info = mediaheader.parse(path)
+    assert info['format']['format_name'] == 'wav'
+    assert info['format']['duration'] == '3.000000'
+    stream = info['streams'][0]
+    assert (stream['codec_name'], stream['sample_rate'], stream['channels']) == ('pcm_s16le', '16000', 1)
+
+
+def test_h264_sps():
+    # 640x360 High profile, cropped from 368 lines
+    sps = bytes.fromhex('6764001eacd940a02ff970110000030001000003003c0f162d96')
+    assert mediaheader.parseH264Sps(sps) == {'width': 640, 'height': 360, 'pix_fmt': 'yuv420p'}
+    # 322x242 4:4:4, cropped from 336x256
+    sps = bytes.fromhex('67f40015919b282a21e3e23011000003000100000300321f142996')
+    assert mediaheader.parseH264Sps(sps) == {'width': 322, 'height': 242, 'pix_fmt': 'yuv444p'}
+
+
+def test_unknown(tmp_path):
+    path = tmp_path / 'x.bin'
+    path.write_bytes(b'not a media file at all')
+    assert mediaheader.parse(str(path)) is None
+    assert mediaheader.parse(str(tmp_path / 'missing.mp4')) is None
@@ -0,0 +1,262 @@
+import json
+import os
+import shutil
+import threading
+from concurrent import futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+import log
+
+logger = log.getLogger(__name__)
+
+# In-process metrics, exposed in the Prometheus text format on http://<host>:METRICS_PORT/metrics
+# (if METRICS_PORT is set) and by GetMetricsRPC (text or json).
+# Used to size NUM_PYTHON_WORKERS and JOB_MAX_THREADS from measurements.
+
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+
+DATA_DIRECTORY = os.getenv('DATA_DIRECTORY')
+TMP_SUBDIR = 'pythonrpc'  # See utils.getTmpFile
+
+# Seconds. Covers 50ms probes to multi-hour transcriptions
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+
+
+def _labelKey(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _formatLabels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in items) + '}'
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = {}
+        REGISTRY.append(self)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _labelKey(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        with self.lock:
+            return self.header() + [f'{self.name}{_formatLabels(k)} {v}' for k, v in self.values.items()]
+
+    def snapshot(self):
+        with self.lock:
+            return [{'labels': dict(k), 'value': v} for k, v in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[_labelKey(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    # Each series is [bucket counts, sum, count]
+    def observe(self, value, **labels):
+        key = _labelKey(labels)
+        with self.lock:
+            series = self.values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                for bound, c in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{_formatLabels(key, [("le", bound)])} {c}')
+                lines.append(f'{self.name}_bucket{_formatLabels(key, [("le", "+Inf")])} {count}')
+                lines.append(f'{self.name}_sum{_formatLabels(key)} {total}')
+                lines.append(f'{self.name}_count{_formatLabels(key)} {count}')
+        return lines
+
+    def snapshot(self):
+        with self.lock:
+            return [{'labels': dict(key), 'count': count, 'sum': total,
+                     'buckets': dict(zip([str(b) for b in self.buckets], counts))}
+                    for key, (counts, total, count) in self.values.items()]
+
+
+REGISTRY = []
+
+RPC_SECONDS = Histogram('pythonrpc_rpc_seconds', 'Execution time of each RPC (excludes queue wait)')
+RPC_IN_FLIGHT = Gauge('pythonrpc_rpc_in_flight', 'RPCs currently executing')
+RPC_ERRORS = Counter('pythonrpc_rpc_errors_total', 'RPCs that raised an exception')
+QUEUE_WAIT_SECONDS = Histogram('pythonrpc_queue_wait_seconds', 'Time between a call arriving and a worker thread starting it')
+SHARED_CALLS = Counter('pythonrpc_shared_calls_total', 'Calls answered with the result of an identical call already in progress')
+ADMISSION_PENDING = Gauge('pythonrpc_admission_pending', 'Admitted calls that are queued or running')
+ADMISSION_FREE = Gauge('pythonrpc_admission_free', 'Calls that can be admitted before new calls are rejected')
+ADMISSION_PENDING_WORK_SECONDS = Gauge('pythonrpc_admission_pending_work_seconds', 'Estimated execution time of the admitted calls')
+ADMISSION_REJECTED = Counter('pythonrpc_admission_rejected_total', 'Calls rejected with RESOURCE_EXHAUSTED')
+DOWNLOADED_BYTES = Counter('pythonrpc_downloaded_bytes_total', 'Bytes of media downloaded, by provider')
+SUBPROCESS_WALL_SECONDS = Histogram('pythonrpc_subprocess_wall_seconds', 'Wall time of ffmpeg/ffprobe/whisper child processes')
+SUBPROCESS_CPU_SECONDS = Counter('pythonrpc_subprocess_cpu_seconds_total', 'User+system CPU time of child processes')
+CANCELLED_JOBS = Counter('pythonrpc_cancelled_jobs_total', 'Child processes stopped because the call was cancelled or its deadline passed')
+FAST_PATH_JOBS = Counter('pythonrpc_fast_path_jobs_total', 'ffmpeg jobs whose input already matched the output profile, by job and method (remux, link)')
+FILECACHE_LOOKUPS = Counter('pythonrpc_filecache_lookups_total', 'File cache lookups, by cache and result (memory, disk, miss)')
+ARTIFACT_STORE_LOOKUPS = Counter('pythonrpc_artifact_store_lookups_total', 'Artifact store lookups (see artifactstore.py), by result (hit, miss)')
+DOWNLOAD_RETRIES = Counter('pythonrpc_download_retries_total', 'Download requests retried after a dropped connection or a server error (see downloader.py)')
+DIGEST_MISMATCHES = Counter('pythonrpc_digest_mismatches_total', 'Verified file digests that differed from the cached digest, by algorithm')
+CPU_BUDGET_THREADS = Gauge('pythonrpc_cpu_budget_threads', 'Threads shared by the ffmpeg and whisper child processes (see cpubudget.py)')
+CPU_LEASED_THREADS = Gauge('pythonrpc_cpu_leased_threads', 'Threads leased by the running jobs (may exceed the budget when the node is busy)')
+TMP_BYTES = Gauge('pythonrpc_tmp_bytes', 'Bytes used by temporary files in DATA_DIRECTORY/pythonrpc')
+DATA_FREE_BYTES = Gauge('pythonrpc_data_directory_free_bytes', 'Free space in DATA_DIRECTORY')
+
+
+# Returns {rpc name: number of calls executing now} for the RPCs with calls in flight
+def inFlight():
+    with RPC_IN_FLIGHT.lock:
+        return {dict(key)['rpc']: value for key, value in RPC_IN_FLIGHT.values.items() if value}
+
+
+# Disk usage is measured when the metrics are read rather than tracked
+def _updateDiskUsage():
+    if not DATA_DIRECTORY:
+        return
+    total = 0
+    try:
+        with os.scandir(os.path.join(DATA_DIRECTORY, TMP_SUBDIR)) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    pass  # Deleted while we were looking at it
+    except FileNotFoundError:
+        pass
+    TMP_BYTES.set(total)
+    try:
+        DATA_FREE_BYTES.set(shutil.disk_usage(DATA_DIRECTORY).free)
+    except OSError:
+        pass
+
+
+# Returns all metrics in the Prometheus text exposition format
+def render():
+    _updateDiskUsage()
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+# extra (optional) items are added to the top level object
+def renderJson(**extra):
+    _updateDiskUsage()
+    result = {metric.name: metric.snapshot() for metric in REGISTRY}
+    result.update(extra)
+    return json.dumps(result)
+
+
+# Records the execution time and outcome of one RPC
+class RpcTimer:
+    def __init__(self, rpc):
+        self.rpc = rpc
+
+    def __enter__(self):
+        self.start = perf_counter()
+        RPC_IN_FLIGHT.inc(rpc=self.rpc)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.elapsed = perf_counter() - self.start
+        RPC_IN_FLIGHT.dec(rpc=self.rpc)
+        RPC_SECONDS.observe(self.elapsed, rpc=self.rpc)
+        if exc_type is not None:
+            RPC_ERRORS.inc(rpc=self.rpc)
+        return False
+
+
+# A ThreadPoolExecutor that records how long each submitted call waited for a free thread,
+# and counts the calls that are waiting and running
+class TimedThreadPoolExecutor(futures.ThreadPoolExecutor):
+    def __init__(self, lane, max_workers, **kwargs):
+        super().__init__(max_workers=max_workers, **kwargs)
+        self.lane = lane
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.running = 0
+
+    def submit(self, fn, *args, **kwargs):
+        queued = perf_counter()
+
+        def timed(*args, **kwargs):
+            QUEUE_WAIT_SECONDS.observe(perf_counter() - queued, lane=self.lane)
+            with self.lock:
+                self.waiting -= 1
+                self.running += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.running -= 1
+
+        with self.lock:
+            self.waiting += 1
+        return super().submit(timed, *args, **kwargs)
+
+    def free_slots(self):
+        with self.lock:
+            return max(0, self.max_workers - self.running - self.waiting)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes are frequent; don't log each one
+
+
+# Starts the http endpoint on a daemon thread if METRICS_PORT is set
+def startHttpServer(port=METRICS_PORT):
+    if not port:
+        return None
+    httpd = ThreadingHTTPServer(('', port), _MetricsHandler)
+    threading.Thread(target=httpd.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f"Metrics available at http://localhost:{port}/metrics")
+    return httpd
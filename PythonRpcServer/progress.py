@@ -0,0 +1,111 @@
+import re
+import threading
+from time import perf_counter
+
+# Progress reporting for long running ffmpeg and whisper jobs (see the *StreamRPC methods in server.py)
+# A callback receives a dict with the keys
+#   percent      0-100, or -1 if the media duration is unknown
+#   mediaSeconds media time processed so far
+#   speed        media seconds processed per wall clock second (e.g. 4.0 means 4x real time)
+#   etaSeconds   estimated seconds until completion, or -1 if unknown
+
+# Avoid flooding the client; at most one update per interval (the final update is always sent)
+MIN_SECONDS_BETWEEN_UPDATES = 1.0
+
+
+class ProgressTracker:
+    def __init__(self, duration, callback):
+        self.duration = duration if duration and duration > 0 else None
+        self.callback = callback
+        self.start_time = perf_counter()
+        self.last_update = None
+        self.mediaSeconds = 0.0
+
+    def update(self, mediaSeconds, percent=None, force=False):
+        now = perf_counter()
+        self.mediaSeconds = max(self.mediaSeconds, mediaSeconds)
+        if not force and self.last_update is not None and now - self.last_update < MIN_SECONDS_BETWEEN_UPDATES:
+            return
+        self.last_update = now
+
+        elapsed = now - self.start_time
+        speed = self.mediaSeconds / elapsed if elapsed > 0 else 0.0
+        if percent is None:
+            percent = min(100.0, 100.0 * self.mediaSeconds / self.duration) if self.duration else -1.0
+        eta = -1.0
+        if self.duration and speed > 0:
+            eta = max(0.0, (self.duration - self.mediaSeconds) / speed)
+        elif 0 < percent < 100:
+            eta = elapsed * (100.0 - percent) / percent
+
+        self.callback({'percent': percent, 'mediaSeconds': self.mediaSeconds, 'speed': speed, 'etaSeconds': eta})
+
+    def finish(self):
+        self.update(self.duration or self.mediaSeconds, percent=100.0, force=True)
+
+
+# Progress of a job whose parts run at the same time (e.g. the segments of ffmpeg.processVideoSegmented)
+# part(key) returns a tracker for one part (e.g. for ffmpegLineHandler); the media time of the whole job is
+# the sum of the media time of its parts
+class PartsTracker:
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.lock = threading.Lock()
+        self.parts = {}
+
+    def part(self, key):
+        return _PartTracker(self, key)
+
+    def updatePart(self, key, mediaSeconds):
+        with self.lock:
+            self.parts[key] = mediaSeconds
+            self.tracker.update(sum(self.parts.values()))
+
+    def finish(self):
+        with self.lock:
+            self.tracker.finish()
+
+
+class _PartTracker:
+    def __init__(self, parts, key):
+        self.parts = parts
+        self.key = key
+
+    def update(self, mediaSeconds, percent=None, force=False):
+        self.parts.updatePart(self.key, mediaSeconds)
+
+
+# ffmpeg '-progress pipe:1' writes blocks of key=value lines, e.g.
+#   out_time_us=12345678
+#   speed=8.52x
+#   progress=continue
+def ffmpegLineHandler(tracker):
+    def on_line(line):
+        key, _, value = line.partition('=')
+        if key == 'out_time_us' and value.strip().isdigit():
+            tracker.update(int(value) / 1000000.0)
+    return on_line
+
+
+# whisper.cpp prints each segment on stdout as it is decoded:
+#   [00:01:02.340 --> 00:01:05.120]   Some text
+# and, with --print-progress, lines like 'whisper_print_progress_callback: progress =  45%' on stderr
+WHISPER_SEGMENT = re.compile(r'^\[(\d+):(\d+):(\d+(?:\.\d+)?) --> (\d+):(\d+):(\d+(?:\.\d+)?)\]')
+WHISPER_PROGRESS = re.compile(r'progress\s*=\s*(\d+)%')
+
+
+def whisperStdoutHandler(tracker):
+    def on_line(line):
+        m = WHISPER_SEGMENT.match(line.strip())
+        if m:
+            h, mi, s = m.group(4, 5, 6)
+            tracker.update(int(h) * 3600 + int(mi) * 60 + float(s))
+    return on_line
+
+
+def whisperStderrHandler(tracker):
+    def on_line(line):
+        m = WHISPER_PROGRESS.search(line)
+        if m and tracker.duration:
+            tracker.update(tracker.duration * int(m.group(1)) / 100.0)
+    return on_line
@@ -0,0 +1,161 @@
+import os
+import signal
+import subprocess
+import threading
+import time
+from collections import deque
+from time import perf_counter
+
+import log
+import metrics
+
+logger = log.getLogger(__name__)
+
+# Runs the ffmpeg and whisper child processes.
+# Unlike FFmpeg.run() (which waits in communicate()) the output is read line by line as it is produced,
+# so that callers can follow the progress of long jobs.
+# If the grpc context of the call is given, the child (and its process group) is killed soon after the
+# client cancels the call or its deadline passes, rather than running to completion for nobody.
+
+# Number of stderr lines kept for the exception message when a process fails
+STDERR_TAIL_LINES = 20
+
+# Program name (e.g. 'ffmpeg') -> time.time() of its most recent successful run; see health.py
+LAST_SUCCESS = {}
+
+# Seconds between checks that the caller is still waiting for the result
+CANCEL_POLL_SECONDS = 0.5
+# Seconds between SIGTERM and SIGKILL when a child is stopped
+KILL_GRACE_SECONDS = 2
+
+
+class ProcessError(Exception):
+    def __init__(self, cmd, returncode, stderr):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.stderr = stderr
+        super().__init__(f"{cmd[0]} exited with status {returncode}:\n{stderr}")
+
+
+class Cancelled(Exception):
+    def __init__(self, cmd, reason):
+        self.cmd = cmd
+        self.reason = reason
+        super().__init__(f"{os.path.basename(cmd[0])} stopped: {reason}")
+
+
+# context is a grpc.ServicerContext (or None). Returns None while the result is still wanted,
+# otherwise 'cancelled' or 'deadline'
+def stopReason(context):
+    if context is None:
+        return None
+    if not context.is_active():
+        return 'cancelled'
+    remaining = context.time_remaining()
+    if remaining is not None and remaining <= 0:
+        return 'deadline'
+    return None
+
+
+def _killGroup(proc, sig):
+    try:
+        os.killpg(proc.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass  # Already gone
+
+
+def _watch(proc, context, finished, stopped):
+    while not finished.wait(CANCEL_POLL_SECONDS):
+        reason = stopReason(context)
+        if reason:
+            stopped.append(reason)
+            _killGroup(proc, signal.SIGTERM)
+            if not finished.wait(KILL_GRACE_SECONDS):
+                _killGroup(proc, signal.SIGKILL)
+            return
+
+
+# Returns the argument list of an ffmpy.FFmpeg object
+# (ff.cmd is quoted for Windows by subprocess.list2cmdline, so it is not split again; ff._cmd is the list it was made of)
+def ffmpegArgs(ff):
+    return list(ff._cmd)
+
+
+# Reaps the child with os.wait4 so that its own CPU usage (rather than that of all children) is known
+# Returns the exit status in the same form as Popen.returncode
+def _waitWithUsage(proc, start_time):
+    program = os.path.basename(proc.args[0])
+    _, status, usage = os.wait4(proc.pid, 0)
+    metrics.SUBPROCESS_WALL_SECONDS.observe(perf_counter() - start_time, program = program)
+    metrics.SUBPROCESS_CPU_SECONDS.inc(usage.ru_utime + usage.ru_stime, program = program)
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return proc.returncode
+
+
+def _readLines(stream, on_line, tail):
+    for line in iter(stream.readline, ''):
+        line = line.rstrip('\n')
+        tail.append(line)
+        if on_line:
+            on_line(line)
+    stream.close()
+
+
+# Runs cmd (a list of arguments) to completion.
+# on_stdout and on_stderr (optional) are called with each line of output (without the newline)
+# context (optional) is the grpc context of the call that wants the result
+# Raises Cancelled if the child was stopped because of the context,
+# or ProcessError if the process exits with a non-zero status
+# Returns the last STDERR_TAIL_LINES lines of stderr
+# lease (optional) is the cpubudget.Lease whose threads cmd uses; the process is re-balanced with the other jobs
+def run(cmd, on_stdout=None, on_stderr=None, context=None, lease=None):
+    reason = stopReason(context)
+    if reason:
+        metrics.CANCELLED_JOBS.inc(program = os.path.basename(cmd[0]), reason = reason)
+        raise Cancelled(cmd, reason)
+
+    start_time = perf_counter()
+    # A new session (and so process group) lets us stop the child together with any processes it started
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            encoding='utf-8', errors='replace', start_new_session=True)
+    if lease is not None:
+        lease.attach(proc.pid)
+    finished = threading.Event()
+    stopped = []
+    if context is not None:
+        threading.Thread(target=_watch, args=(proc, context, finished, stopped), daemon=True).start()
+    stdout_tail = deque(maxlen=STDERR_TAIL_LINES)
+    stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+    stderr_reader = threading.Thread(target=_readLines, args=(proc.stderr, on_stderr, stderr_tail), daemon=True)
+    stderr_reader.start()
+    try:
+        _readLines(proc.stdout, on_stdout, stdout_tail)
+    except BaseException:
+        _killGroup(proc, signal.SIGKILL)
+        raise
+    finally:
+        if lease is not None:
+            lease.detach(proc.pid)  # Before the pid is reaped (and could be reused)
+        returncode = _waitWithUsage(proc, start_time)
+        finished.set()
+        stderr_reader.join()
+
+    stderr = '\n'.join(stderr_tail)
+    if stopped:
+        logger.info(f"{os.path.basename(cmd[0])}: stopped after {perf_counter() - start_time:.1f} seconds ({stopped[0]})")
+        metrics.CANCELLED_JOBS.inc(program = os.path.basename(cmd[0]), reason = stopped[0])
+        raise Cancelled(cmd, stopped[0])
+    if returncode != 0:
+        raise ProcessError(cmd, returncode, stderr)
+    LAST_SUCCESS[os.path.basename(cmd[0])] = time.time()
+    return stderr
+
+
+# Runs cmd to completion and returns its stdout (like subprocess.check_output but with the process metrics)
+def output(cmd, context=None):
+    lines = []
+    run(cmd, on_stdout=lines.append, context=context)
+    return '\n'.join(lines)
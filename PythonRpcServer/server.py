@@ -1,49 +1,198 @@
 from __future__ import print_function
 
+import startup # Imported first so that it can time the other imports
+startup.begin()
+
 import ct_pb2
 import ct_pb2_grpc
 import grpc
 #import time
-import logging
-from concurrent import futures
+import log
 # import scenedetector
 #import echo
-from youtube import YoutubeProvider
-from echo import EchoProvider
-from kaltura import KalturaProvider
 from mediaprovider import InvalidPlaylistInfoException
-from transcribe import transcribe_audio
+from transcribe import transcribe_audio, whisper_segments, whisper_language_and_model
 
 import json
 import hasher 
 import ffmpeg
+import lanes
+import admission
+import background
+import batch
+import downloader
+import health
+import metrics
+import singleflight
+import utils
 # import phrasehinter
 import os
+import asyncio
+import queue
 import signal
 import threading
-import traceback
-from time import perf_counter 
+from time import perf_counter
 # Main entry point for docker container
 
+logger = log.getLogger(__name__)
+
 MAX_SECONDS_TO_SHUTDOWN = 8 # Docker waits 10s before kiling the process anyway 
 
+# 'threads' (default) runs every RPC on one shared thread pool of NUM_PYTHON_WORKERS threads
+# 'aio' uses a grpc.aio server that sends each RPC to a download, cpu or fast lane (see lanes.py)
+# Both reject calls beyond the queue limits of admission.py with RESOURCE_EXHAUSTED
+SERVER_MODE = os.getenv('PYTHON_SERVER_MODE', 'threads')
+
+# In 'threads' mode, calls beyond this number (running + queued, of all RPCs together) are also rejected; 0 = no limit
+MAX_CONCURRENT_RPCS = int(os.getenv('MAX_CONCURRENT_RPCS', 0))
+
+# Longest wait of GetVideoJobRPC for a background job to finish
+MAX_JOB_WAIT_SECONDS = 60
+
+# logId is expected to be of the form RpcName(details); the RpcName part labels the metrics (see metrics.py)
 def LogWorker(logId, worker):
-    start_time = perf_counter()
-    logger = lambda message : print(f"{logId}:{message}")
+    rpc = logId.split('(')[0]
+    timer = metrics.RpcTimer(rpc)
     try:
-        logger("Starting...")
-        result = worker()
-        return result
+        with timer:
+            logger.info(f"{logId}:Starting...", extra = {'rpc': rpc})
+            result = worker()
+            return result
     except Exception as e:
-        logger(f"Exception {e}")
-        traceback.print_exc()
+        logger.exception(f"{logId}:Exception {e}", extra = {'rpc': rpc})
         raise e
     finally:
-        end_time = perf_counter()
-        logger(f"Task returning after {int(end_time - start_time)} seconds.")
+        logger.info(f"{logId}:Task returning after {timer.elapsed:.2f} seconds.", extra = {'rpc': rpc, 'seconds': round(timer.elapsed, 3)})
+
+# Counts the bytes fetched by the Download*RPC methods. Returns the (filePath, ext) result unchanged
+def recordDownload(provider, result):
+    try:
+        metrics.DOWNLOADED_BYTES.inc(os.path.getsize(result[0]), provider = provider)
+    except OSError:
+        pass
+    return result
+
+# The providers import large SDKs (yt_dlp, KalturaClient, requests), so they are loaded on first use
+# rather than at start up. A replica that only converts and transcribes never imports them.
+def kalturaProvider():
+    from kaltura import KalturaProvider
+    return KalturaProvider()
+
+def echoProvider():
+    from echo import EchoProvider
+    return EchoProvider()
+
+def youtubeProvider():
+    from youtube import YoutubeProvider
+    return YoutubeProvider()
+
+# Concurrent identical requests (e.g. TaskEngine retries) share one execution. See singleflight.py
+FLIGHTS = singleflight.SingleFlight()
+
+# key is a tuple whose first item is the RPC name; the remaining items identify the normalized request
+# If context is given, worker is called with a context that stays active while any caller is waiting
+def SharedWorker(key, worker, context=None, copy=None):
+    result, shared = FLIGHTS.do(key, worker, copy, context)
+    if shared:
+        logger.info(f"{key[0]}: shared the result of an identical call already in progress")
+        metrics.SHARED_CALLS.inc(rpc = key[0])
+    return result
+
+# As SharedWorker, for workers that return a (filePath, ext) tuple.
+# Each caller owns its file (the TaskEngine moves it), so every other caller gets its own hard link
+def SharedFileWorker(key, worker, context=None):
+    return SharedWorker(key, worker, context, lambda result: (utils.linkToTmpFile(result[0]), result[1]))
+
+# As SharedFileWorker, for ffmpeg.processMedia results
+def SharedMediaWorker(key, worker, context=None):
+    def link(output):
+        return (utils.linkToTmpFile(output[0]), output[1]) if output else None
+    return SharedWorker(key, worker, context, lambda result: dict(result,
+        video = link(result['video']), wav = link(result['wav']), thumbnails = [link(t) for t in result['thumbnails']]))
+
+def normalizePath(path):
+    return os.path.realpath(path) if path else path
+
+# transcribe_audio for TranscribeAudioRPC, TranscribeAudioResultRPC and TranscribeAudioResultStreamRPC: they share one
+# key, so concurrent calls of any of them for the same file run whisper once, and each converts the (read only) result
+def SharedTranscription(request, context):
+    key = ('TranscribeAudio', normalizePath(request.filePath), request.testing)
+    return SharedWorker(key, lambda jobContext: transcribe_audio(request.filePath, request.testing, context = jobContext), context)
+
+# Yields make_item(index, item, result, error) for each item as fn(item) finishes (see batch.py)
+# A failed item is logged and reported in its own message; the rest of the batch carries on
+def BatchWorker(logId, items, fn, make_item, maxParallel, context):
+    rpc = logId.split('(')[0]
+    failed = 0
+    timer = metrics.RpcTimer(rpc)
+    with timer:
+        logger.info(f"{logId}:Starting {len(items)} items...", extra = {'rpc': rpc})
+        try:
+            for index, result, error in batch.concurrently(items, fn, maxParallel, context):
+                if error is not None:
+                    failed += 1
+                    logger.warning(f"{logId}:{items[index]}: {error}", extra = {'rpc': rpc})
+                yield make_item(index, items[index], result, error)
+        finally:
+            logger.info(f"{logId}:Task returning after {perf_counter() - timer.start:.2f} seconds. {failed} of {len(items)} items failed.",
+                extra = {'rpc': rpc})
+
+# Segments per TranscriptionResult message of TranscribeAudioResultStreamRPC
+SEGMENTS_PER_MESSAGE = int(os.getenv('SEGMENTS_PER_MESSAGE', 500))
+
+# Converts whisper's JSON output into TranscriptionResult messages of at most batchSize segments each
+# (one message if batchSize is None). The first message carries the language and model
+def TranscriptionResults(transcription_result, includeTokens, batchSize=None):
+    segments = [ct_pb2.TranscriptionSegment(**segment) for segment in whisper_segments(transcription_result, includeTokens)]
+    language, model = whisper_language_and_model(transcription_result)
+    batchSize = batchSize or max(1, len(segments))
+    messages = [ct_pb2.TranscriptionResult(segments = segments[i:i + batchSize]) for i in range(0, len(segments), batchSize)]
+    messages = messages or [ct_pb2.TranscriptionResult()]
+    messages[0].language = language
+    messages[0].model = model
+    return messages
+
+
+# Runs worker(progress) on its own thread and yields a JobProgress message for every progress update
+# The worker's return value is converted into the final message by make_final(result)
+def StreamWorker(logId, worker, make_final):
+    updates = queue.Queue()
+    finished = object()
+    outcome = {}
+
+    def run():
+        try:
+            outcome['result'] = LogWorker(logId, lambda: worker(updates.put))
+        except Exception as e:
+            outcome['error'] = e
+        finally:
+            updates.put(finished)
+
+    threading.Thread(target=run, name=logId, daemon=True).start()
+    last = ct_pb2.JobProgress()
+    while True:
+        update = updates.get()
+        if update is finished:
+            break
+        last = ct_pb2.JobProgress(**update)
+        yield last
+
+    if 'error' in outcome:
+        raise outcome['error']
+    final = make_final(outcome['result'])
+    final.mediaSeconds = last.mediaSeconds
+    final.speed = last.speed
+    final.done = True
+    final.percent = 100.0
+    final.etaSeconds = 0.0
+    yield final
 
 
 class PythonServerServicer(ct_pb2_grpc.PythonServerServicer):
+    # pools: the thread pools that run the RPCs, reported by GetCapacityRPC
+    def __init__(self, pools=()):
+        self.pools = list(pools)
+
     # Transcribe it into a json string from the transcribe text
     # Make it returns a json string
     # change name to TranscribeRPC
@@ -67,9 +216,9 @@ class PythonServerServicer(ct_pb2_grpc.PythonServerServicer):
 #        return ct_pb2.PhraseHintResponse(result=res)
     
     def GetKalturaChannelEntriesRPC(self, request, context):
-        kalturaprovider = KalturaProvider()
+        kalturaprovider = kalturaProvider()
         try:
-            res = kalturaprovider.getPlaylistItems(request)
+            res = LogWorker(f"GetKalturaChannelEntriesRPC({request.Url})", lambda: kalturaprovider.getPlaylistItems(request))
             return ct_pb2.JsonString(json = res)
         except InvalidPlaylistInfoException as e:
             context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
@@ -77,14 +226,15 @@ class PythonServerServicer(ct_pb2_grpc.PythonServerServicer):
             return ct_pb2.JsonString()
     
     def DownloadKalturaVideoRPC(self, request, context):
-        kalturaprovider = KalturaProvider()
-        filePath, ext = kalturaprovider.getMedia(request)
+        key = ('DownloadKalturaVideoRPC', request.videoUrl.strip(), request.additionalInfo)
+        filePath, ext = LogWorker("DownloadKalturaVideoRPC()", lambda: SharedFileWorker(key,
+            lambda: recordDownload('kaltura', kalturaProvider().getMedia(request))))
         return ct_pb2.File(filePath = filePath, ext = ext)
         
     def GetEchoPlaylistRPC(self, request, context):
-        echoprovider = EchoProvider()
+        echoprovider = echoProvider()
         try:
-            res = echoprovider.getPlaylistItems(request)
+            res = LogWorker(f"GetEchoPlaylistRPC({request.Url})", lambda: echoprovider.getPlaylistItems(request))
             return ct_pb2.JsonString(json = res)
         except InvalidPlaylistInfoException as e:
             context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
@@ -93,14 +243,15 @@ class PythonServerServicer(ct_pb2_grpc.PythonServerServicer):
         
     
     def DownloadEchoVideoRPC(self, request, context):
-        echoprovider = EchoProvider()
-        filePath, ext = echoprovider.getMedia(request)
+        key = ('DownloadEchoVideoRPC', request.videoUrl.strip(), request.additionalInfo)
+        filePath, ext = LogWorker("DownloadEchoVideoRPC()", lambda: SharedFileWorker(key,
+            lambda: recordDownload('echo', echoProvider().getMedia(request))))
         return ct_pb2.File(filePath = filePath, ext = ext)
     
     def GetYoutubePlaylistRPC(self, request, context):
-        youtubeprovider = YoutubeProvider()
+        youtubeprovider = youtubeProvider()
         try:
-            res = youtubeprovider.getPlaylistItems(request)
+            res = LogWorker(f"GetYoutubePlaylistRPC({request.Url})", lambda: youtubeprovider.getPlaylistItems(request))
             return ct_pb2.JsonString(json = res)
         except InvalidPlaylistInfoException as e:
             context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
@@ -108,37 +259,122 @@ class PythonServerServicer(ct_pb2_grpc.PythonServerServicer):
             return ct_pb2.JsonString()
     
     def DownloadYoutubeVideoRPC(self, request, context):
-        youtubeprovider = YoutubeProvider()
-        filePath, ext = youtubeprovider.getMedia(request)
+        key = ('DownloadYoutubeVideoRPC', request.videoUrl.strip(), request.additionalInfo)
+        filePath, ext = LogWorker(f"DownloadYoutubeVideoRPC({request.videoUrl})", lambda: SharedFileWorker(key,
+            lambda: recordDownload('youtube', youtubeProvider().getMedia(request))))
         return ct_pb2.File(filePath = filePath, ext = ext)
 
     def ConvertVideoToWavRPCWithOffset(self, request, context):
-        filePath, ext = ffmpeg.convertVideoToWavWithOffset(request.file.filePath, request.offset)
+        key = ('ConvertVideoToWavRPCWithOffset', normalizePath(request.file.filePath), request.offset)
+        filePath, ext = LogWorker(f"ConvertVideoToWavRPCWithOffset({request.file.filePath})", lambda: SharedFileWorker(key,
+            lambda jobContext: ffmpeg.convertVideoToWavWithOffset(request.file.filePath, request.offset, context = jobContext), context))
         return ct_pb2.File(filePath = filePath, ext = ext)
 
     def ProcessVideoRPC(self, request, context):
-        filePath, ext = ffmpeg.processVideo(request.filePath)
+        key = ('ProcessVideoRPC', normalizePath(request.filePath))
+        filePath, ext = LogWorker(f"ProcessVideoRPC({request.filePath})", lambda: SharedFileWorker(key,
+            lambda jobContext: ffmpeg.processVideo(request.filePath, context = jobContext), context))
         return ct_pb2.File(filePath = filePath, ext = ext)
 
+    def ProcessMediaRPC(self, request, context):
+        key = ('ProcessMediaRPC', normalizePath(request.filePath), request.video, request.wav, request.wavOffset,
+            request.thumbnails, request.thumbnailWidth)
+        result = LogWorker(f"ProcessMediaRPC({request.filePath})", lambda: SharedMediaWorker(key,
+            lambda jobContext: ffmpeg.processMedia(request.filePath, request.video, request.wav, request.wavOffset,
+                request.thumbnails, request.thumbnailWidth or 320, context = jobContext), context))
+        toFile = lambda output: ct_pb2.File(filePath = output[0], ext = output[1]) if output else None
+        return ct_pb2.ProcessMediaResponse(video = toFile(result['video']), wav = toFile(result['wav']),
+            thumbnails = [toFile(t) for t in result['thumbnails']], mediaInfo = ct_pb2.JsonString(json = result['mediaInfo']))
+
+    # Not shared with concurrent calls (see SharedFileWorker): each call has its own preview and background job
+    def ProcessVideoPreviewRPC(self, request, context):
+        filePath, ext, job = LogWorker(f"ProcessVideoPreviewRPC({request.filePath})",
+            lambda: ffmpeg.processVideoPreview(request.filePath, context = context))
+        return ct_pb2.VideoPreviewResponse(video = ct_pb2.File(filePath = filePath, ext = ext), jobId = job.id if job else '')
+
+    def GetVideoJobRPC(self, request, context):
+        job = background.get(request.jobId)
+        if job is None:
+            return ct_pb2.VideoJobStatus(jobId = request.jobId, state = 'unknown')
+        if request.waitSeconds > 0:
+            job.wait(min(request.waitSeconds, MAX_JOB_WAIT_SECONDS))
+        # The final video belongs to the caller that receives it, so it is handed over once (see background.py)
+        filePath = job.collect()
+        video = ct_pb2.File(filePath = filePath, ext = '.mp4') if filePath else None
+        return ct_pb2.VideoJobStatus(jobId = job.id, state = job.state, video = video, error = job.error or '')
+
+    def AudioFingerprintRPC(self, request, context):
+        import fingerprint # Loaded on first use, as it imports numpy
+        result, matches = LogWorker(f"AudioFingerprintRPC({request.filePath})", lambda: fingerprint.fingerprintAndMatch(
+            request.filePath, request.key or None, request.maxMatches or 5, context))
+        return ct_pb2.FingerprintResponse(hashCount = len(result), durationSeconds = result.duration,
+            matches = [ct_pb2.FingerprintMatch(key = m['key'], score = m['score'], matchedHashes = m['matches'],
+                offsetSeconds = m['offset']) for m in matches])
+
     # Todo Rename to ComputeFileHashRPC and update? or insert new entry in ct.proto
     def ComputeFileHash(self, request, context):
-        hash = hasher.hashFile(request.file, request.algorithms)
-        return ct_pb2.FileHashResponse(result = hash)
+        try:
+            algorithms = hasher.parseAlgorithms(request.algorithms)
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+            return ct_pb2.FileHashResponse()
+        digests = LogWorker(f"ComputeFileHash({request.file})", lambda: hasher.hashFile(request.file, request.algorithms, request.verify))
+        return ct_pb2.FileHashResponse(result = digests[algorithms[0]], digests = digests)
 
     def GetMediaInfoRPC(self, request, context):
-        result = LogWorker(f"GetMediaInfo({request.filePath})", lambda: ffmpeg.getMediaInfo(request.filePath))
+        key = ('GetMediaInfoRPC', normalizePath(request.filePath))
+        result = LogWorker(f"GetMediaInfoRPC({request.filePath})", lambda: SharedWorker(key,
+            lambda: ffmpeg.getMediaInfo(request.filePath)))
         return  ct_pb2.JsonString(json = result)
+
+    def ProbeMediaRPC(self, request, context):
+        mode = request.mode or 'full'
+        if mode not in ffmpeg.MEDIA_INFO_ARGS:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(f"Unknown mode '{mode}'")
+            return ct_pb2.JsonString()
+        key = ('ProbeMediaRPC', normalizePath(request.filePath), mode)
+        result = LogWorker(f"ProbeMediaRPC({request.filePath};{mode})", lambda: SharedWorker(key,
+            lambda: ffmpeg.getMediaInfo(request.filePath, mode = mode)))
+        return ct_pb2.JsonString(json = result)
+
+    def ComputeFileHashBatchRPC(self, request, context):
+        files = list(request.files)
+        try:
+            algorithms = hasher.parseAlgorithms(request.algorithms)
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+            return
+        yield from BatchWorker(f"ComputeFileHashBatchRPC({len(files)} files)", files,
+            lambda file: hasher.hashFile(file, request.algorithms, request.verify),
+            lambda index, file, result, error: ct_pb2.FileHashBatchItem(index = index, file = file,
+                result = result[algorithms[0]] if result else '', digests = result or {},
+                error = str(error) if error else ''),
+            request.maxParallel, context)
+
+    def GetMediaInfoBatchRPC(self, request, context):
+        filePaths = list(request.filePaths)
+        mode = request.mode or 'full'
+        # Each file shares a single flight with ProbeMediaRPC calls for the same file
+        yield from BatchWorker(f"GetMediaInfoBatchRPC({len(filePaths)} files;{mode})", filePaths,
+            lambda filePath: SharedWorker(('ProbeMediaRPC', normalizePath(filePath), mode),
+                lambda: ffmpeg.getMediaInfo(filePath, mode = mode)),
+            lambda index, filePath, result, error: ct_pb2.MediaInfoBatchItem(index = index, filePath = filePath,
+                json = result or '', error = str(error) if error else ''),
+            request.maxParallel, context)
     
     
     def TranscribeAudioRPC(self, request, context):
-        print(f"TranscribeAudioRPC({request.logId};{request.filePath})")
+        logger.info(f"TranscribeAudioRPC({request.logId};{request.filePath})")
         try:
-            logging.info(f"Starting transcription for file: {request.filePath}")
+            logger.info(f"Starting transcription for file: {request.filePath}")
             transcription_result = LogWorker(
                 f"TranscribeAudioRPC({request.filePath})",
-                lambda: transcribe_audio(request.filePath, request.testing)
+                lambda: SharedTranscription(request, context)
             )
-            logging.info(f"Transcription completed successfully for: {request.filePath}")
+            logger.info(f"Transcription completed successfully for: {request.filePath}")
             return ct_pb2.JsonString(json=json.dumps(transcription_result))
 
         except Exception as e:
@@ -146,22 +382,75 @@ class PythonServerServicer(ct_pb2_grpc.PythonServerServicer):
             context.set_details(f"Transcription failed: {str(e)}")
             return ct_pb2.JsonString(json=json.dumps({"error": str(e)}))
 
+    def TranscribeAudioResultRPC(self, request, context):
+        transcription_result = LogWorker(f"TranscribeAudioResultRPC({request.logId};{request.filePath})",
+            lambda: SharedTranscription(request, context))
+        return TranscriptionResults(transcription_result, request.includeTokens)[0]
+
+    def TranscribeAudioResultStreamRPC(self, request, context):
+        transcription_result = LogWorker(f"TranscribeAudioResultStreamRPC({request.logId};{request.filePath})",
+            lambda: SharedTranscription(request, context))
+        messages = TranscriptionResults(transcription_result, request.includeTokens, SEGMENTS_PER_MESSAGE)
+        messages[-1].done = True
+        yield from messages
+
+    def ConvertVideoToWavStreamRPC(self, request, context):
+        yield from StreamWorker(f"ConvertVideoToWavStreamRPC({request.file.filePath})",
+            lambda progress: ffmpeg.convertVideoToWavWithOffset(request.file.filePath, request.offset, progress, context),
+            lambda result: ct_pb2.JobProgress(file = ct_pb2.File(filePath = result[0], ext = result[1])))
+
+    def ProcessVideoStreamRPC(self, request, context):
+        yield from StreamWorker(f"ProcessVideoStreamRPC({request.filePath})",
+            lambda progress: ffmpeg.processVideo(request.filePath, progress, context),
+            lambda result: ct_pb2.JobProgress(file = ct_pb2.File(filePath = result[0], ext = result[1])))
+
+    def TranscribeAudioStreamRPC(self, request, context):
+        yield from StreamWorker(f"TranscribeAudioStreamRPC({request.filePath})",
+            lambda progress: transcribe_audio(request.filePath, request.testing, progress, context),
+            lambda result: ct_pb2.JobProgress(result = ct_pb2.JsonString(json = json.dumps(result))))
+
+    def GetMetricsRPC(self, request, context):
+        if request.format == 'json':
+            return ct_pb2.MetricsResponse(text = metrics.renderJson(admission = admission.CONTROLLER.capacity()))
+        return ct_pb2.MetricsResponse(text = metrics.render())
+
+    def GetCapacityRPC(self, request, context):
+        capacity = health.capacity(self.pools)
+        response = ct_pb2.CapacityResponse(
+            ready = capacity['ready'],
+            lanes = [ct_pb2.LaneCapacity(**lane) for lane in capacity['lanes']],
+            runningJobs = capacity['runningJobs'],
+            dataDirectoryFreeBytes = capacity['dataDirectoryFreeBytes'],
+            loadAverage = capacity['loadAverage'],
+            cpuCount = capacity['cpuCount'],
+            cpuBudget = capacity['cpuBudget'],
+            cpuLeased = capacity['cpuLeased'],
+            tools = [ct_pb2.ToolStatus(**tool) for tool in capacity['tools']],
+            admissionFree = {rpc: state['free'] for rpc, state in admission.CONTROLLER.capacity().items()})
+        return response
+
 def serve():
-    print("Python RPC Server Starting")
+    logger.info("Python RPC Server Starting")
     
     # Until we can ensure no timeouts on remote services, the default here is set to a conservative low number
     # This is to ensure we can still make progress even if every python tasks tries to use all cpu cores.
     max_workers=int(os.getenv('NUM_PYTHON_WORKERS', 3))
-    print(f"max_workers={max_workers}. Starting up grpc server...")
+    logger.info(f"max_workers={max_workers}. Starting up grpc server...")
 
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers))
+    executor = metrics.TimedThreadPoolExecutor('grpc', max_workers)
+    server = grpc.server(executor, maximum_concurrent_rpcs = MAX_CONCURRENT_RPCS or None,
+        interceptors = [admission.AdmissionInterceptor(admission.CONTROLLER)])
     
     ct_pb2_grpc.add_PythonServerServicer_to_server(
-        PythonServerServicer(), server)
+        PythonServerServicer([executor, background.EXECUTOR]), server)
     server.add_insecure_port('[::]:50051')
     
     server.start()
-    print("Python RPC Server Started")
+    logger.info("Python RPC Server Started")
+    startup.report()
+    metrics.startHttpServer()
+    health.startWarmUp()
+    downloader.startCleanup()
     
     done = threading.Event()
     
@@ -174,10 +463,52 @@ def serve():
     signal.signal(signal.SIGINT, on_done) # We only expect thissignal  in local testing
     done.wait()
 
-    print(f"Python RPC Server Stopping. Waiting for up to {MAX_SECONDS_TO_SHUTDOWN} seconds for outstanding requests")
+    logger.info(f"Python RPC Server Stopping. Waiting for up to {MAX_SECONDS_TO_SHUTDOWN} seconds for outstanding requests")
     server.stop(MAX_SECONDS_TO_SHUTDOWN).wait()
-    print("Python RPC Server Stopped")
+    logger.info("Python RPC Server Stopped")
+
+def serve_aio():
+    logger.info("Python RPC Server Starting (aio)")
+    for lane in lanes.LANES.values():
+        logger.info(f"lane {lane.name}: max_workers={lane.max_workers}")
+    asyncio.run(_serve_aio())
+
+async def _serve_aio():
+    server = grpc.aio.server()
+
+    ct_pb2_grpc.add_PythonServerServicer_to_server(
+        lanes.LaneServicer(PythonServerServicer([lane.executor for lane in lanes.LANES.values()] + [background.EXECUTOR]), admission.CONTROLLER), server)
+    server.add_insecure_port('[::]:50051')
+
+    await server.start()
+    logger.info("Python RPC Server Started")
+    startup.report()
+    metrics.startHttpServer()
+    health.startWarmUp()
+    downloader.startCleanup()
+
+    done = asyncio.Event()
+    grace = { 'seconds' : MAX_SECONDS_TO_SHUTDOWN }
+
+    def on_done(signum):
+        if signal.SIGINT == signum:
+            grace['seconds'] = 1
+        done.set()
+
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, on_done, signal.SIGTERM) # Docker sends SIGTERM then waits 10s
+    loop.add_signal_handler(signal.SIGINT, on_done, signal.SIGINT) # We only expect this signal in local testing
+    await done.wait()
+
+    logger.info(f"Python RPC Server Stopping. Waiting for up to {grace['seconds']} seconds for outstanding requests")
+    await server.stop(grace['seconds'])
+    for lane in lanes.LANES.values():
+        lane.shutdown()
+    logger.info("Python RPC Server Stopped")
 
 if __name__ == '__main__':
-    logging.basicConfig()
-    serve()    
+    log.setup()
+    if SERVER_MODE == 'aio':
+        serve_aio()
+    else:
+        serve()    
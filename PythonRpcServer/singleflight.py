@@ -0,0 +1,114 @@
+import threading
+
+# Single-flight execution: while a call for a key is running, further calls with the same key
+# wait for it and share its result instead of repeating the work.
+# (TaskEngine retries and duplicate queue messages often ask for the same download or transcription twice)
+# With grpc contexts, the shared work keeps running while any caller still wants the result;
+# a caller whose call is cancelled stops waiting without affecting the others.
+
+# Seconds between checks that a waiting caller's own call is still active
+FOLLOWER_POLL_SECONDS = 0.5
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.followers = 0
+        self.results = []
+        self.error = None
+        self.context = _SharedContext()
+
+
+# Passed to fn in place of a grpc context: active while any of the callers' calls is active,
+# with the latest deadline among them
+class _SharedContext:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.contexts = []
+
+    def add(self, context):
+        with self.lock:
+            self.contexts.append(context)
+
+    def remove(self, context):
+        with self.lock:
+            self.contexts.remove(context)
+
+    def is_active(self):
+        with self.lock:
+            return any(c.is_active() for c in self.contexts)
+
+    def time_remaining(self):
+        with self.lock:
+            remaining = [c.time_remaining() for c in self.contexts if c.is_active()]
+        if not remaining:
+            return 0
+        if None in remaining:
+            return None
+        return max(remaining)
+
+
+class Abandoned(Exception):
+    pass
+
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    # Returns (result, shared). shared is False for the caller that ran fn.
+    # If copy is given, each waiting caller receives copy(result) instead of the same object;
+    # the copies are made before the first caller returns (e.g. so that it cannot move a shared file first)
+    # Exceptions raised by fn are re-raised in every caller.
+    # If context (a grpc context) is given, fn is called with a context shared by every caller
+    # (see _SharedContext); a waiting caller whose call is no longer active raises Abandoned.
+    def do(self, key, fn, copy=None, context=None):
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                call.followers += 1
+                leader = False
+            else:
+                call = _Call()
+                self.calls[key] = call
+                leader = True
+            if context is not None:
+                call.context.add(context)
+
+        if not leader:
+            while not call.done.wait(FOLLOWER_POLL_SECONDS if context is not None else None):
+                with self.lock:
+                    if not call.done.is_set() and not context.is_active():
+                        call.followers -= 1
+                        call.context.remove(context)
+                        raise Abandoned(f"{key[0]}: call ended while waiting for the shared result")
+            if call.error is not None:
+                raise call.error
+            with self.lock:
+                return call.results.pop(), True
+
+        try:
+            result = fn(call.context) if context is not None else fn()
+        except BaseException as e:
+            with self.lock:
+                del self.calls[key]
+            call.error = e
+            call.done.set()
+            raise
+
+        # The copies are made under the same lock as a waiting caller's check that its call is still active,
+        # so a caller cannot leave after it was counted and leave its copy behind (copies are quick: hard links)
+        with self.lock:
+            del self.calls[key]
+            try:
+                call.results = [copy(result) if copy else result for _ in range(call.followers)]
+            except Exception as e:
+                call.error = e  # The waiting callers fail; this caller still has its result
+            finally:
+                call.done.set()
+        return result, False
+
+    def inFlight(self):
+        with self.lock:
+            return len(self.calls)
@@ -0,0 +1,121 @@
+import threading
+import time
+
+import singleflight
+
+
+def test_concurrent_calls_share_one_execution():
+    flights = singleflight.SingleFlight()
+    runs = []
+    results = []
+
+    def slow():
+        runs.append(1)
+        time.sleep(0.3)
+        return 'done'
+
+    def call():
+        results.append(flights.do('key', slow, copy=lambda r: r + '-copy'))
+
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(runs) == 1
+    assert sorted(results) == [('done', False)] + [('done-copy', True)] * 3
+    assert flights.inFlight() == 0
+
+
+def test_errors_are_raised_in_every_caller():
+    flights = singleflight.SingleFlight()
+    errors = []
+
+    def fail():
+        time.sleep(0.2)
+        raise ValueError('boom')
+
+    def call():
+        try:
+            flights.do('key', fail)
+        except ValueError as e:
+            errors.append(str(e))
+
+    threads = [threading.Thread(target=call) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == ['boom'] * 3
+    # The failed call is forgotten, so the next call runs again
+    assert flights.do('key', lambda: 42) == (42, False)
+
+
+class FakeContext:
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+    def time_remaining(self):
+        return None
+
+
+def test_cancelled_follower_stops_waiting(monkeypatch):
+    monkeypatch.setattr(singleflight, 'FOLLOWER_POLL_SECONDS', 0.05)
+    flights = singleflight.SingleFlight()
+    leader_context, follower_context = FakeContext(), FakeContext()
+    release = threading.Event()
+    seen = []
+    outcomes = []
+
+    def work(jobContext):
+        release.wait()
+        seen.append(jobContext.is_active())
+        return 'done'
+
+    leader = threading.Thread(target=lambda: outcomes.append(flights.do('key', work, context=leader_context)))
+    leader.start()
+    time.sleep(0.1)
+    follower_context.active = False
+    try:
+        flights.do('key', work, context=follower_context)
+    except singleflight.Abandoned:
+        outcomes.append('abandoned')
+    release.set()
+    leader.join()
+
+    # The leader's call is still active, so the shared work saw an active context
+    assert outcomes == ['abandoned', ('done', False)]
+    assert seen == [True]
+
+
+def test_follower_counted_for_a_copy_receives_it(monkeypatch):
+    monkeypatch.setattr(singleflight, 'FOLLOWER_POLL_SECONDS', 0.05)
+    flights = singleflight.SingleFlight()
+    leader_context, follower_context = FakeContext(), FakeContext()
+    copies = []
+    outcomes = []
+
+    def work(jobContext):
+        time.sleep(0.2)
+        return 'done'
+
+    def copy(result):
+        follower_context.active = False  # The follower's call ends while its copy is being made
+        time.sleep(0.2)
+        copies.append(result)
+        return result + '-copy'
+
+    leader = threading.Thread(target=lambda: flights.do('key', work, copy, leader_context))
+    leader.start()
+    time.sleep(0.05)
+    outcomes.append(flights.do('key', work, copy, follower_context))
+    leader.join()
+
+    # The copy was handed over rather than left behind
+    assert copies == ['done']
+    assert outcomes == [('done-copy', True)]
@@ -0,0 +1,91 @@
+import os
+import sys
+from time import perf_counter
+
+import log
+
+logger = log.getLogger(__name__)
+
+# Start up time report for server.py, in the style of 'python -X importtime'
+# server.py calls begin() before its other imports, and report() once it is accepting connections.
+# Heavy provider SDKs (yt_dlp, KalturaClient, requests) are imported on first use, not at start up,
+# so they should not appear in this report.
+
+# Number of slowest modules listed in the report
+REPORT_MODULES = int(os.getenv('STARTUP_REPORT_MODULES', 8))
+
+_begin = None
+_timings = {}  # Top level package name -> cumulative seconds spent importing it
+
+
+class _TimingLoader:
+    def __init__(self, loader, name):
+        self.loader = loader
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(self.loader, attr)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        start = perf_counter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            elapsed = perf_counter() - start
+            _timings[self.name] = _timings.get(self.name, 0.0) + elapsed
+
+
+# A meta path finder that wraps the loader of every top level module so that its import is timed
+# (sub-modules are included in the time of their top level package)
+class _ImportTimer:
+    def find_spec(self, fullname, path=None, target=None):
+        if '.' in fullname:
+            return None
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _TimingLoader(spec.loader, fullname)
+                return spec
+        return None
+
+
+_timer = _ImportTimer()
+
+
+def begin():
+    global _begin
+    _begin = perf_counter()
+    sys.meta_path.insert(0, _timer)
+
+
+# Seconds since the process was started (including interpreter start up), or None if unknown
+def processAge():
+    try:
+        with open('/proc/self/stat') as f:
+            # The process name (field 2) may contain spaces; the remaining fields follow the last ')'
+            fields = f.read().rsplit(')', 1)[1].split()
+        started_ticks = int(fields[19])  # Field 22, starttime
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - started_ticks / os.sysconf('SC_CLK_TCK')
+    except Exception:
+        return None
+
+
+# Stops timing imports and prints the report
+def report():
+    if _timer in sys.meta_path:
+        sys.meta_path.remove(_timer)
+    since_begin = perf_counter() - _begin if _begin is not None else 0.0
+    age = processAge()
+    age_text = f"{age:.2f}s since process start, " if age is not None else ""
+    logger.info(f"Startup: accepting connections {age_text}{since_begin:.2f}s since server.py began importing")
+    slowest = sorted(_timings.items(), key=lambda item: item[1], reverse=True)[:REPORT_MODULES]
+    for name, seconds in slowest:
+        logger.info(f"Startup: import {name:<24} {seconds * 1000:8.1f} ms")
@@ -1,52 +1,118 @@
 import os
-import subprocess
 import json
+import logging
+import wave
 from time import perf_counter 
 from ffmpy import FFmpeg
 import utils
+import runner
+import cpubudget
+import artifactstore
+from progress import ProgressTracker, whisperStdoutHandler, whisperStderrHandler
+import log
+
+logger = log.getLogger(__name__)
 
 # Path to the Whisper executable inside the container
 WHISPER_EXECUTABLE = os.environ.get('WHISPER_EXE','whisper')  # Executable 'main' is assumed to be in the same directory as this script
 MODEL = os.environ.get('WHISPER_MODEL','models/ggml-base.en.bin')
+# whisper's threads come from the CPU budget (cpubudget.py): -t threads per processor, -p processors
+# More than one processor splits the audio into parts that are transcribed separately (faster, but the words at
+# the joins can be lost), so it is only used with at least WHISPER_THREADS_PER_PROCESSOR threads per part
+WHISPER_MAX_PROCESSORS = int(os.environ.get('WHISPER_MAX_PROCESSORS', 1))
+WHISPER_THREADS_PER_PROCESSOR = int(os.environ.get('WHISPER_THREADS_PER_PROCESSOR', 4))
 
-def convert_video_to_wav(input_filepath, offset=None):
+def convert_video_to_wav(input_filepath, offset=None, context=None):
     """
     Converts a video file to WAV format using ffmpy.
     """
-    try:
-        start_time = perf_counter()
-        if offset is None:
-            offset = 0.0
+    output_filepath = None
+    start_time = perf_counter()
+    if offset is None:
+        offset = 0.0
+    ext = '.wav'
+
+    # The same wav as ffmpeg.convertVideoToWavWithOffset (ConvertVideoToWavRPCWithOffset) may already be stored
+    # Looked up before leasing any CPU: the store key is a digest of the whole input, so this is mostly I/O
+    store_key = artifactstore.key(input_filepath, 'wav', {'offset': float(offset)})
+    output_filepath = artifactstore.getFile(store_key, ext)
+    if output_filepath:
+        return output_filepath, ext
 
-        nthreads = utils.getMaxThreads()
-        
-        print(f"Converting video '{input_filepath}' to WAV with offset {offset} using {nthreads} thread(s).")
+    lease = cpubudget.acquire()
+    try:
+        nthreads = lease.threads
+        logger.info(f"Converting video '{input_filepath}' to WAV with offset {offset} using {nthreads} thread(s).")
         output_filepath = utils.getTmpFile()
-        ext = '.wav'
         
         ff = FFmpeg(
             global_options=f"-hide_banner -loglevel error -nostats -threads {nthreads}",
             inputs={input_filepath: f'-ss {offset}'},
             outputs={output_filepath: '-c:a pcm_s16le -ac 1 -y -ar 16000 -f wav'}
         )
-        print(f"Starting conversion. Audio output will be saved in {output_filepath}")
-        ff.run()
+        logger.info(f"Starting conversion. Audio output will be saved in {output_filepath}")
+        runner.run(runner.ffmpegArgs(ff), context=context, lease=lease)
+        artifactstore.putFile(store_key, ext, output_filepath)
         end_time = perf_counter()
-        print(f"Conversion complete. Duration: {int(end_time - start_time)} seconds")
+        logger.info(f"Conversion complete. Duration: {int(end_time - start_time)} seconds")
         return output_filepath, ext
     except Exception as e:
-        print("Exception during conversion:" + str(e))
+        logger.error("Exception during conversion:" + str(e))
+        utils.removeFile(output_filepath) # Partial output
         raise e
-
-def transcribe_audio(media_filepath, testing=False):
+    finally:
+        lease.release()
+
+# Returns whisper's (-t threads, -p processors) for the given number of threads
+def whisper_threads(threads):
+    processors = max(1, min(WHISPER_MAX_PROCESSORS, threads // WHISPER_THREADS_PER_PROCESSOR))
+    return max(1, threads // processors), processors
+
+# Logs a one line summary; the whole result (megabytes for a long lecture) only at DEBUG level
+def logTranscriptionResult(transcription_result):
+    segments = transcription_result.get('transcription', []) if isinstance(transcription_result, dict) else []
+    logger.info(f"Transcription result: {len(segments)} segments")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Transcription result: %s', json.dumps(transcription_result))
+
+# The segments of whisper's JSON output as a list of dicts (the fields of ct_pb2.TranscriptionSegment)
+# include_tokens adds each segment's tokens as parallel lists, without whisper's special tokens (e.g. [_BEG_])
+def whisper_segments(transcription_result, include_tokens=False):
+    segments = []
+    for segment in transcription_result.get('transcription', []):
+        offsets = segment.get('offsets', {})
+        entry = {'startMs': offsets.get('from', 0), 'endMs': offsets.get('to', 0), 'text': segment.get('text', '').strip()}
+        if include_tokens:
+            tokens = [t for t in segment.get('tokens', []) if not t.get('text', '').startswith('[_')]
+            entry['tokenText'] = [t.get('text', '') for t in tokens]
+            entry['tokenStartMs'] = [t.get('offsets', {}).get('from', 0) for t in tokens]
+            entry['tokenEndMs'] = [t.get('offsets', {}).get('to', 0) for t in tokens]
+            entry['tokenP'] = [t.get('p', 0.0) for t in tokens]
+        segments.append(entry)
+    return segments
+
+# Returns (language, model type) of whisper's JSON output
+def whisper_language_and_model(transcription_result):
+    return (transcription_result.get('result', {}).get('language', ''),
+            transcription_result.get('model', {}).get('type', ''))
+
+# Returns the duration of a wav file in seconds, or None if it cannot be read
+def wav_duration(wav_filepath):
+    try:
+        with wave.open(wav_filepath, 'rb') as w:
+            return w.getnframes() / float(w.getframerate())
+    except Exception:
+        return None
+
+# progress (optional) is a callback that receives whisper's progress (see progress.py)
+# context (optional) is the grpc context; whisper is stopped if the call is cancelled (see runner.py)
+def transcribe_audio(media_filepath, testing=False, progress=None, context=None):
     if testing:
         json_output_path = f"/PythonRpcServer/transcribe_hellohellohello.wav.json"
         with open(json_output_path, 'r') as json_file:
             transcription_result = json.load(json_file)
         
-        # Print the transcription result (testing purpose)
-        print("Transcription result:")
-        print(json.dumps(transcription_result, indent=4))
+        logTranscriptionResult(transcription_result)
 
         return transcription_result
     
@@ -60,10 +126,16 @@ def transcribe_audio(media_filepath, testing=False):
     if not os.path.exists(media_filepath):
         raise FileNotFoundError(f"Media file not found: {media_filepath}")
 
+    # The same contents may have been transcribed with the same model (see artifactstore.py)
+    store_key = artifactstore.key(media_filepath, 'whisper', {'model': MODEL})
+    stored = artifactstore.getText(store_key)
+    if stored is not None:
+        return json.loads(stored)
+
     # convert video to wav if needed
     wav_created = False  # Track if WAV was created
     if not media_filepath.endswith('.wav'):
-        media_filepath, _ = convert_video_to_wav(media_filepath)
+        media_filepath, _ = convert_video_to_wav(media_filepath, context=context)
         wav_created = True  # WAV file was created
 
 
@@ -80,17 +152,35 @@ def transcribe_audio(media_filepath, testing=False):
         '-m', MODEL
     ]
 
-    print("Running Whisper transcription inside the container...")
+    lease = cpubudget.acquire()
+    threads, processors = whisper_threads(lease.threads)
+    whisper_command += ['-t', str(threads), '-p', str(processors)]
+    logger.info(f"Running Whisper transcription inside the container ({threads} threads, {processors} processors)...")
     
     # Execute the Whisper command
-    result = subprocess.run(whisper_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-    # Handle command failure
-    if result.returncode != 0:
-        raise Exception(f"Whisper failed with error:\n{result.stderr.decode('utf-8')}")
+    on_stdout, on_stderr, tracker = None, None, None
+    if progress:
+        tracker = ProgressTracker(wav_duration(media_filepath), progress)
+        on_stdout, on_stderr = whisperStdoutHandler(tracker), whisperStderrHandler(tracker)
+        whisper_command.append('--print-progress')
+    try:
+        runner.run(whisper_command, on_stdout=on_stdout, on_stderr=on_stderr, context=context, lease=lease)
+    except Exception as e:
+        # Remove the partial output and the wav file that we created
+        utils.removeFile(json_output_path)
+        if wav_created:
+            utils.removeFile(media_filepath)
+        # Handle command failure
+        if isinstance(e, runner.ProcessError):
+            raise Exception(f"Whisper failed with error:\n{e.stderr}")
+        raise
+    finally:
+        lease.release()
+    if tracker:
+        tracker.finish()
 
     # Check if the output JSON file was generated
-    print(f"Checking for JSON output at: {json_output_path}")
+    logger.info(f"Checking for JSON output at: {json_output_path}")
     if not os.path.exists(json_output_path):
         raise FileNotFoundError(f"Expected JSON output file not found: {json_output_path}")
 
@@ -98,20 +188,20 @@ def transcribe_audio(media_filepath, testing=False):
     with open(json_output_path, 'r') as json_file:
         transcription_result = json.load(json_file)
     
-    # Print the transcription result (testing purpose)
-    print("Transcription result:")
-    print(json.dumps(transcription_result, indent=4))
+    logTranscriptionResult(transcription_result)
+
+    artifactstore.putText(store_key, json.dumps(transcription_result))
 
     # Delete the JSON file after reading it
     os.remove(json_output_path)
-    print(f"Deleted the JSON file: {json_output_path}")
+    logger.info(f"Deleted the JSON file: {json_output_path}")
 
     if wav_created:
         try:
             os.remove(media_filepath)
-            print(f"Deleted the WAV file: {media_filepath}")
+            logger.info(f"Deleted the WAV file: {media_filepath}")
         except Exception as e:
-            print(f"Error deleting WAV file: {str(e)}")
+            logger.warning(f"Error deleting WAV file: {str(e)}")
 
     return transcription_result
 
@@ -0,0 +1,27 @@
+import json
+
+import transcribe
+from transcribe import whisper_segments, whisper_language_and_model, whisper_threads
+
+
+def test_whisper_segments():
+    with open('transcribe_example_result.json') as f:
+        result = json.load(f)
+    assert whisper_language_and_model(result) == ('en', 'base')
+
+    segments = whisper_segments(result)
+    assert len(segments) == len(result['transcription'])
+    assert segments[0] == {'startMs': 0, 'endMs': 7320,
+                           'text': 'Reading homeworks are due early Tuesday at 9pm unless announced otherwise.'}
+
+    first = whisper_segments(result, include_tokens=True)[0]
+    assert first['tokenText'][:2] == [' Reading', ' hom']  # [_BEG_] is left out
+    assert first['tokenStartMs'][:2] == [0, 750]
+    assert len(first['tokenP']) == len(first['tokenText'])
+
+
+def test_whisper_threads(monkeypatch):
+    assert whisper_threads(8) == (8, 1)
+    monkeypatch.setattr(transcribe, 'WHISPER_MAX_PROCESSORS', 4)
+    assert whisper_threads(8) == (4, 2)
+    assert whisper_threads(3) == (3, 1)
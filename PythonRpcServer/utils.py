@@ -2,25 +2,25 @@ import pickle
 import codecs
 import string
 import random
-import requests
 import os
-import requests
 import mimetypes
+import shutil
+
+import cpubudget
+import log
+
+logger = log.getLogger(__name__)
 
 ## CAUTION ##
 # When imported this file seeds the RNG with random bytes from the os.urandom() - see below
 
-# Max number of threads this process should use. Be careful about setting this value too high
-# Unless you enjoy bringing a production machine to a crawl and debugging timeouts
-# Recommended values 1-4
-DEFAULT_JOB_MAX_THREAD = 4
-
 DATA_DIRECTORY = os.getenv('DATA_DIRECTORY')
 
 
-# Returns the preferred maximum number of threads to use
+# Returns the most threads one job may use: JOB_MAX_THREADS (default 4), or fewer if the CPU budget is smaller
+# Jobs lease the threads they actually use from cpubudget.py, based on what the other jobs are using
 def getMaxThreads():
-    return int(os.getenv('JOB_MAX_THREADS', DEFAULT_JOB_MAX_THREAD))
+    return min(cpubudget.JOB_MAX_THREADS or cpubudget.BUDGET.total, cpubudget.BUDGET.total)
 
 
 def encode(obj):
@@ -59,7 +59,28 @@ def getTmpFile(subdir="pythonrpc"):
             return candidate
         # We wil never print this, and if we do, no-one will read it.
         # The loop exists purely for reasoning about the code
-        print("This loop so precious; Unrun unlogged yet forces; The bug is elsewhere.")
+        logger.warning("This loop so precious; Unrun unlogged yet forces; The bug is elsewhere.")
+
+# Returns a new temporary file path (see getTmpFile) that refers to the same contents as filepath
+# A hard link is used when possible so that no data is copied
+def linkToTmpFile(filepath, subdir="pythonrpc"):
+    candidate = getTmpFile(subdir)
+    try:
+        os.link(filepath, candidate)
+    except OSError:
+        shutil.copyfile(filepath, candidate)
+    return candidate
+
+# Deletes filepath if it exists (e.g. the partial output of a failed or cancelled job)
+def removeFile(filepath):
+    if not filepath:
+        return
+    try:
+        os.remove(filepath)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"removeFile({filepath}): {e}")
 
 # See https://www.garykessler.net/library/file_sigs.html
 # Todo extension for Apple new HEIV format?
@@ -80,6 +101,7 @@ def extension_from_magic_bytes(filepath):
 
     if skip4.startswith('6674797071742020'): return '.mov'   
     if first4[:7] == '000001B' : return '.mpg'
+    if bytes.startswith(b'RIFF'.hex()) and bytes[16:24] == b'WAVE'.hex(): return '.wav'
     
     return ''
 
@@ -87,27 +109,15 @@ def extension_from_magic_bytes(filepath):
 # Filepath and cookies may be specified
 # Returns a two tuple, [filepath,  extension]
 # An appropriate Extension is guessed based on the mimetype in the 'content-type' response header
+# Ranged, parallel and resumable when the server supports it (see downloader.py)
 def download_file(url, filepath=None, cookies=None, timeout=60):
-    # NOTE the stream=True parameter below
-    if not filepath:
-        filepath = getTmpFile()
+    import downloader
+    filepath, contentType = downloader.download(url, filepath, cookies=cookies, timeout=timeout)
+
     extension = None
-    with requests.get(url, stream=True, allow_redirects=True, cookies=cookies, timeout=timeout) as r:
-        
-        
-        r.raise_for_status()
-
-        extension = ''
-        if 'content-type' in r.headers:
-            extension = mimetypes.guess_extension(r.headers['content-type'])
-        
-        with open(filepath, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                if chunk:  # filter out keep-alive new chunks
-                    f.write(chunk)
-                    # f.flush()
-
-        if extension == '':
-            extension = extension_from_magic_bytes(filepath)
-    
+    if contentType:
+        extension = mimetypes.guess_extension(contentType.split(';')[0].strip())
+    if not extension:
+        extension = extension_from_magic_bytes(filepath)
+
     return filepath, extension
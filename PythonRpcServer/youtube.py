@@ -15,6 +15,10 @@ import datetime
 
 from mediaprovider import MediaProvider, InvalidPlaylistInfoException
 
+import log
+
+logger = log.getLogger(__name__)
+
 DATA_DIRECTORY = os.getenv('DATA_DIRECTORY')
 assert( DATA_DIRECTORY )
 
@@ -27,7 +31,7 @@ YOUTUBE_CHANNEL_BASE_URL='https://www.youtube.com/channel/'
 class YoutubeProvider(MediaProvider):
 
     def getPlaylistItems(self, request):
-        print(f'getPlaylistItems({request})')
+        logger.info(f'getPlaylistItems({request})')
         isChannel = False
         
         try:
@@ -44,7 +48,7 @@ class YoutubeProvider(MediaProvider):
         return self.download_youtube_video(request.videoUrl)
 
     def get_youtube_channel(self, identifier):
-        print(f'get_youtube_channel({identifier})')
+        logger.info(f'get_youtube_channel({identifier})')
 
         url = YOUTUBE_CHANNEL_BASE_URL+ identifier
         # Use yt_dlp to create a channel,
@@ -54,7 +58,7 @@ class YoutubeProvider(MediaProvider):
 
         playlist_id = channel.playlist_id
         #according to one StackOver and one test, channels-to-playlists can also be converted with string replace  UCXXXX to UUXXXX
-        print(f"channel {identifier}-> playlist {playlist_id}")
+        logger.info(f"channel {identifier}-> playlist {playlist_id}")
         return self.get_youtube_playlist(playlist_id)
 
     def get_youtube_playlist(self, identifier):
@@ -62,7 +66,7 @@ class YoutubeProvider(MediaProvider):
             start_time = perf_counter()
             
             url= YOUTUBE_PLAYLIST_BASE_URL + identifier
-            print(f"get_youtube_playlist(identifier): {url}")
+            logger.info(f"get_youtube_playlist(identifier): {url}")
             
             ydl_opts = {
                 'quiet': True,
@@ -75,7 +79,7 @@ class YoutubeProvider(MediaProvider):
             with yt_dlp.YoutubeDL(ydl_opts) as ydl:
                 info_dict = ydl.extract_info(url, download=False)
                 for entry in info_dict.get( 'entries', []):
-                    print(entry)
+                    logger.debug('%s', entry)
                     published_at = entry.get('upload_date', now)
                     media = {
                         "channelId": entry['channel_id'],
@@ -89,15 +93,15 @@ class YoutubeProvider(MediaProvider):
                     }
                     medias.append(media)
             end_time = perf_counter()
-            print(f'Youtube playlist {identifier}: Returning {len(medias)} items. Processing time {end_time - start_time :.2f} seconds')
+            logger.info(f'Youtube playlist {identifier}: Returning {len(medias)} items. Processing time {end_time - start_time :.2f} seconds')
             return medias
         except Exception as e:
-            print(f"get_youtube_playlist({identifier}) Exception:" + str(e))
+            logger.error(f"get_youtube_playlist({identifier}) Exception:" + str(e))
             raise e        
 
     def download_youtube_video(self, youtubeUrl):
         try:
-            print(f"download_youtube_video({youtubeUrl}): Starting")
+            logger.info(f"download_youtube_video({youtubeUrl}): Starting")
             start_time = perf_counter()
             extension = '.mp4'
             filename = getRandomString(8)
@@ -114,11 +118,11 @@ class YoutubeProvider(MediaProvider):
             }
             with yt_dlp.YoutubeDL(ydl_opts) as ydl:
                 x = ydl.download([youtubeUrl])
-                print(x)
+                logger.debug(f"yt_dlp download returned {x}")
                 #filepath = yt_dlp.YoutubeDL(ydl_opts).streams.filter(subtype='mp4').get_highest_resolution().download(output_path = DATA_DIRECTORY, filename = filename)
             end_time = perf_counter()
-            print(f"download_youtube_video({youtubeUrl}): Done. Downloaded in {end_time - start_time :.2f} seconds")
+            logger.info(f"download_youtube_video({youtubeUrl}): Done. Downloaded in {end_time - start_time :.2f} seconds")
             return filepath, extension
         except Exception as e:
-            print(f"download_youtube_video({youtubeUrl}) Exception:" + str(e))
+            logger.error(f"download_youtube_video({youtubeUrl}) Exception:" + str(e))
             raise e